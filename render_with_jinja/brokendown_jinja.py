@@ -3,57 +3,411 @@
 
 import io
 import os
+import re
 import sys
+import ast
 import json
 import time
+import hashlib
 import sqlite3
+import threading
 import xml.etree.ElementTree as etree
-from jinja2 import Undefined, environment, FunctionLoader
+import gibson
+from database import ConnectionManager, decompress_body, load_template_body
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import jinja2
+from jinja2 import Undefined, environment, meta, BaseLoader, TemplateNotFound, TemplateSyntaxError
+from jinja2.bccache import BytecodeCache
 from jinja2.utils import missing, object_type_repr
 
 database_cursor = None
 
+BatchRenderResult = namedtuple('BatchRenderResult', ['index', 'output', 'error'])
+
+
+# The test case delimiters, so jinja blocks don't collide with what's in the payloads.
+DELIMITERS = dict(block_start_string='{~',
+                  block_end_string='~}',
+                  comment_start_string='{!',
+                  comment_end_string='!}')
+
+EMBEDDED_TEMPLATE_NAME = 'Embedded Test Case Template'
+
+# Compiled embedded templates, keyed by a hash of their source and the delimiters they were lexed with.
+# The analyses of those templates are kept the same way.
+_compiled_templates = OrderedDict()
+_template_analyses = OrderedDict()
+_embedded_cache_lock = threading.Lock()
+COMPILED_TEMPLATE_CACHE_SIZE = 256
+
+TemplateAnalysis = namedtuple('TemplateAnalysis', ['variables', 'references'])
+
+
+def make_environment(loader=None, bytecode_cache=None):
+    """Makes an Environment with the test case delimiters and KeepUndefined.
+    It's meant to be made once and shared, so its caches last between renders.
+    """
+    return Environment(loader=loader, undefined=KeepUndefined, bytecode_cache=bytecode_cache, **DELIMITERS)
+
+
+def _embedded_key(jinja_env, source):
+    delimiters = (jinja_env.block_start_string, jinja_env.block_end_string,
+                  jinja_env.variable_start_string, jinja_env.variable_end_string,
+                  jinja_env.comment_start_string, jinja_env.comment_end_string)
+    key = hashlib.blake2b(repr((delimiters, source)).encode('utf-8'), digest_size=16).digest()
+    # The environment is part of the key too, since a Template is bound to the one that compiled it.
+    return id(jinja_env), key
+
+
+def _cache_get(cache, key):
+    with _embedded_cache_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+
+def _cache_set(cache, key, value):
+    with _embedded_cache_lock:
+        cache[key] = value
+        while len(cache) > COMPILED_TEMPLATE_CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+def get_embedded_template(jinja_env, source):
+    """Returns the compiled Template for a test case body, compiling it only
+    the first time a given source is seen with jinja_env's delimiters.
+
+    Templates from the loader are cached by jinja_env itself, but embedded
+    ones don't have a name to cache them under, so they're cached here by
+    content instead, least recently used first out.
+    """
+    key = _embedded_key(jinja_env, source)
+    template = _cache_get(_compiled_templates, key)
+    if template is not None and template.environment is jinja_env:
+        return template
+
+    # Same as Environment.from_string, but named like the embedded templates always have been,
+    # and going through the bytecode cache the way templates from the loader do.
+    bytecode_cache = jinja_env.bytecode_cache
+    code = None
+    if bytecode_cache is not None:
+        # Every embedded template has the same name, so the content hash stands in for the filename.
+        bucket = bytecode_cache.get_bucket(jinja_env, EMBEDDED_TEMPLATE_NAME, key[1].hex(), source)
+        code = bucket.code
+    if code is None:
+        code = jinja_env.compile(source, EMBEDDED_TEMPLATE_NAME)
+        if bytecode_cache is not None:
+            bucket.code = code
+            bytecode_cache.set_bucket(bucket)
+    template = jinja_env.template_class.from_code(jinja_env, code, jinja_env.make_globals(None), None)
+    _cache_set(_compiled_templates, key, template)
+    return template
+
+
+def analyze_template(jinja_env, source):
+    """Finds the variables a template takes from its context, and the templates
+    it includes, extends or imports, from its AST.
+
+    Returns a TemplateAnalysis of the sorted variable names, and the template
+    names, where a None is a name only known at render time.
+    Raises TemplateSyntaxError if the template won't parse.
+    """
+    ast = jinja_env.parse(source)
+    return TemplateAnalysis(sorted(meta.find_undeclared_variables(ast)), list(meta.find_referenced_templates(ast)))
+
+
+def get_used_variables(jinja_env, analysis):
+    """Returns the set of variables a template with this analysis can use, taking in
+    everything it includes, extends or imports, and everything they do in turn.
+
+    The referenced templates' analyses come from jinja_env.loader's
+    get_analysis. Returns None if they can't all be found, or one of them is
+    only named at render time, since then any variable could be used.
+    """
+    used = set(analysis.variables)
+    get_analysis = getattr(jinja_env.loader, 'get_analysis', None)
+    seen = set()
+    to_visit = list(analysis.references)
+    while to_visit:
+        name = to_visit.pop()
+        if name is None or get_analysis is None:
+            return None
+        if name in seen:
+            continue
+        seen.add(name)
+        referenced = get_analysis(jinja_env, name)
+        if referenced is None:
+            return None
+        used.update(referenced.variables)
+        to_visit.extend(referenced.references)
+    return used
+
+
+def prune_map(jinja_env, source, jinja_map):
+    """Returns (analysis, jinja_map with only the keys source, or anything it
+    references, can use). A map that can't be pruned comes back as it was.
+    """
+    key = _embedded_key(jinja_env, source)
+    analysis = _cache_get(_template_analyses, key)
+    if analysis is None:
+        analysis = analyze_template(jinja_env, source)
+        _cache_set(_template_analyses, key, analysis)
+    if isinstance(jinja_map, dict):
+        used = get_used_variables(jinja_env, analysis)
+        if used is not None:
+            jinja_map = {name: jinja_map[name] for name in used if name in jinja_map}
+    return analysis, jinja_map
+
+
+BYTECODE_CACHE_SCHEMA = """create table if not exists bytecode_cache (
+    key text not null,
+    checksum text not null,
+    jinja_version text not null,
+    bytecode blob not null,
+    size integer not null,
+    created real not null,
+    last_used real not null,
+    primary key (key, checksum, jinja_version)
+)"""
+
+
+class SqliteBytecodeCache(BytecodeCache):
+    """Stores compiled template bytecode in a table of the sqlite database,
+    so it's shared by every worker process and survives restarts.
+
+    Rows are keyed by the bucket key, the checksum of the template source,
+    and the jinja version, so a changed template or an upgraded jinja never
+    loads stale code. Whenever something new is stored, rows not used in
+    max_age seconds are dropped, then the least recently used ones until
+    the table holds at most max_size bytes of bytecode.
+    """
+
+    def __init__(self, database, max_size=64 * 1024 * 1024, max_age=7 * 24 * 60 * 60):
+        self.database = database
+        self.max_size = max_size
+        self.max_age = max_age
+        self._connections = ConnectionManager(database, row_factory=None)
+        with self._connection() as conn:
+            conn.execute(BYTECODE_CACHE_SCHEMA)
+
+    def _connection(self):
+        return self._connections.connection()
+
+    def load_bytecode(self, bucket):
+        conn = self._connection()
+        try:
+            with conn:
+                row = conn.execute('select bytecode from bytecode_cache '
+                                   'where key = ? and checksum = ? and jinja_version = ?',
+                                   (bucket.key, bucket.checksum, jinja2.__version__)).fetchone()
+                if row is not None:
+                    conn.execute('update bytecode_cache set last_used = ? '
+                                 'where key = ? and checksum = ? and jinja_version = ?',
+                                 (time.time(), bucket.key, bucket.checksum, jinja2.__version__))
+        except sqlite3.OperationalError:
+            # Another worker holding the database too long only costs a compile.
+            return
+        if row is not None:
+            bucket.bytecode_from_string(bytes(row[0]))
+
+    def dump_bytecode(self, bucket):
+        bytecode = bucket.bytecode_to_string()
+        now = time.time()
+        conn = self._connection()
+        try:
+            with conn:
+                conn.execute('insert or replace into bytecode_cache '
+                             '(key, checksum, jinja_version, bytecode, size, created, last_used) '
+                             'values (?, ?, ?, ?, ?, ?, ?)',
+                             (bucket.key, bucket.checksum, jinja2.__version__, sqlite3.Binary(bytecode),
+                              len(bytecode), now, now))
+                self._evict(conn, now)
+        except sqlite3.OperationalError:
+            pass
+
+    def _evict(self, conn, now):
+        conn.execute('delete from bytecode_cache where last_used < ?', (now - self.max_age,))
+        total, = conn.execute('select coalesce(sum(size), 0) from bytecode_cache').fetchone()
+        if total <= self.max_size:
+            return
+        # Walk from the most recently used down, keeping rows until max_size is used up.
+        kept = 0
+        doomed = []
+        for rowid, size in conn.execute('select rowid, size from bytecode_cache order by last_used desc'):
+            kept += size
+            if kept > self.max_size:
+                doomed.append((rowid,))
+        conn.executemany('delete from bytecode_cache where rowid = ?', doomed)
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute('delete from bytecode_cache')
+
 
 def render_string_with_jinja(string_value, jinja_env, jinja_map):
     print(type(string_value), string_value)
-    if isinstance(string_value, str):
-        bytes_template = io.BytesIO()
-        bytes_template.write(string_value.encode('utf-8'))
-        bytes_template.seek(0)
-    else:
+    if isinstance(string_value, io.BytesIO):
         print('bytes templ', string_value)
-        bytes_template = string_value
-    template = jinja_env.get_template(bytes_template)
+        string_value = string_value.getvalue().decode()
+    template = get_embedded_template(jinja_env, string_value)
+    # Only pass on what the template can actually use, which is often a lot less than was given.
+    _, jinja_map = prune_map(jinja_env, string_value, jinja_map)
     rendered_string = template.render(jinja_map)
     print('rendered string is: {}'.format(rendered_string))
     return rendered_string
 
 
-# figure out how to default this stupid db
-def db_connect(db_url='G:\\ext\\code\\jinja_play\\flask_version\\render_with_jinja\\render.db'):
-    print(db_url)
-    conn = sqlite3.connect(db_url)
-    cursor = conn.cursor()
-    return cursor
+def generate_string_with_jinja(string_value, jinja_env, jinja_map):
+    """Like render_string_with_jinja, but returns an iterator over the
+    rendered output in chunks, so it never has to be held in memory whole.
+    The template is compiled straight away; errors while rendering come out
+    of the iterator.
+    """
+    if isinstance(string_value, io.BytesIO):
+        string_value = string_value.getvalue().decode()
+    template = get_embedded_template(jinja_env, string_value)
+    _, jinja_map = prune_map(jinja_env, string_value, jinja_map)
+    return template.generate(jinja_map)
 
 
-def db_loader(template):
-    mtime = time.time()
-    if isinstance(template, io.BytesIO):
-        template_str = template.getvalue().decode()
-        contents = template_str
-        print('decded string value', template.getvalue().decode())
-        filename = 'Embedded Test Case Template'  # could be a temp file name, None seemed apt enough. maybe the uid of test case?
-        return contents, filename, mtime
-    try:
-        cursor = db_connect()
-        cursor.execute("select filename, contents from templates where filename='{0}'".format(template))
-        result = cursor.fetchone()
-        cursor.close()
-        print('using_db on result : {0}'.format(result[1]))
-        return str(result[1]), str(result[0]), mtime
-    except Exception:
-        raise
+def render_batch(maps, string_value=None, template_name=None, string_type=None, database=None, processes=None,
+                 chunksize=16):
+    """Renders one template against many maps across a pool of worker processes.
+
+    The template is either string_value, or template_name looked up in the
+    database. It's compiled here first, so a syntax error raises straight
+    away, and with a database the workers load that bytecode from its
+    SqliteBytecodeCache rather than compiling it again. Each worker gets the
+    template once, when it starts, and after that only maps go across.
+
+    maps is consumed lazily, chunksize at a time, with only a couple of chunks
+    per process in flight. Each map is a JSON string, parsed in the worker.
+    With string_type set to 'JSON' or 'XML' the output is validated and
+    pretty printed, as /render does.
+
+    Results are yielded in completion order, so use their index to tie them
+    back to their maps. A map that fails to parse, render, or validate gets
+    a result with error set, and whatever output there was, instead of raising.
+    So does every map in a chunk whose worker failed, e.g. died, or couldn't
+    set up the template.
+    """
+    jinja_env = _make_batch_environment(database)
+    if template_name is not None:
+        jinja_env.get_template(template_name)
+    else:
+        get_embedded_template(jinja_env, string_value)
+
+    processes = processes or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_render_worker,
+                             initargs=(string_value, template_name, database)) as executor:
+        for result in gibson.iter_chunked_results(executor, 2 * processes, enumerate(maps), chunksize,
+                                                  _render_error_result, _render_chunk, string_type):
+            yield result
+
+
+def _make_batch_environment(database):
+    if database is None:
+        return make_environment()
+    return make_environment(DatabaseLoader(database), SqliteBytecodeCache(database))
+
+
+# The template each render_batch worker renders, set up by _init_render_worker.
+_batch_template = None
+
+
+def _init_render_worker(string_value, template_name, database):
+    global _batch_template
+    jinja_env = _make_batch_environment(database)
+    if template_name is not None:
+        _batch_template = jinja_env.get_template(template_name)
+    else:
+        _batch_template = get_embedded_template(jinja_env, string_value)
+
+
+def _render_chunk(chunk, string_type):
+    """Worker side of render_batch. Renders a list of (index, map JSON) items."""
+    results = []
+    for index, jinja_map in chunk:
+        output = None
+        try:
+            output = _batch_template.render(json.loads(jinja_map) if jinja_map else {})
+            if string_type == 'JSON':
+                output = check_then_dump_json([output])[0]
+            elif string_type == 'XML':
+                output = pretty_print_xml_tostring(output).decode()
+        except Exception as exc:
+            # broad for a reason, one bad map shouldn't take down the rest of the batch.
+            results.append(BatchRenderResult(index, output, '{0}: {1}'.format(type(exc).__name__, exc)))
+        else:
+            results.append(BatchRenderResult(index, output, None))
+    return results
+
+
+def _render_error_result(index, exc):
+    return BatchRenderResult(index, None, '{0}: {1}'.format(type(exc).__name__, exc))
+
+
+class DatabaseLoader(BaseLoader):
+    """Loads templates from the templates table of the app's database.
+
+    Every template row has a version that goes up whenever it's edited, and
+    the uptodate callable handed back to jinja just checks that version, so
+    stored templates, and whatever they include or extend, are compiled once
+    and only reloaded after an edit. Each thread reuses its own WAL mode
+    connection from a database.ConnectionManager.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self._connections = ConnectionManager(database, row_factory=None)
+
+    def _connection(self):
+        return self._connections.connection()
+
+    def get_source(self, environment, template):
+        row = self._connection().execute('select b.codec, b.data, t.version from templates t '
+                                         'join template_blobs b on b.hash = t.content_hash '
+                                         'where t.filename = ?', (template,)).fetchone()
+        if row is None:
+            raise TemplateNotFound(template)
+        codec, data, version = row
+        contents = decompress_body(codec, bytes(data))
+
+        def uptodate():
+            current = self._connection().execute('select version from templates where filename = ?',
+                                                 (template,)).fetchone()
+            return current is not None and current[0] == version
+
+        return contents, template, uptodate
+
+    def get_analysis(self, environment, template):
+        """Returns the stored TemplateAnalysis of a template, or None if it's missing or won't parse.
+        Templates stored before they were analyzed on upload are analyzed, and saved, now.
+        """
+        conn = self._connection()
+        row = conn.execute('select content_hash, variables, referenced_templates from templates where filename = ?',
+                           (template,)).fetchone()
+        if row is None:
+            return None
+        content_hash, variables, references = row
+        if variables is not None:
+            return TemplateAnalysis(json.loads(variables), json.loads(references))
+        try:
+            # Only now is the body needed, so only now is it decompressed.
+            analysis = analyze_template(environment, load_template_body(conn, content_hash))
+        except TemplateSyntaxError:
+            return None
+        with conn:
+            conn.execute('update templates set variables = ?, referenced_templates = ? '
+                         'where filename = ? and variables is null',
+                         (json.dumps(analysis.variables), json.dumps(analysis.references), template))
+        return analysis
+
+    def list_templates(self):
+        return sorted(row[0] for row in self._connection().execute('select filename from templates'))
+
 
 ############ BEGIN THE SAD COPY-PASTE. PACKAGE PYNET THEN GET RID OF THIS ############
 
@@ -82,12 +436,37 @@ class KeepUndefined(Undefined):
 
 
 
-def return_exc_printed_nice(string, exc_line_number):
-    """ base for the pretty printing of exceptions"""
-    string = string.split(os.linesep) if os.linesep in string else string.split('\n')
-    string[exc_line_number - 1] = '>>>>>>' + string[exc_line_number - 1].strip()
-    string = os.linesep.join(string)
-    return string
+def return_exc_printed_nice(string, exc_line_number, context=3):
+    """ base for the pretty printing of exceptions. Only the failing line, marked with >>>>>>, and
+    the context lines either side of it are returned, so a huge document isn't copied around whole.
+    """
+    # Walk to the first line wanted with find, rather than splitting up the whole string.
+    first_line = max(1, exc_line_number - context)
+    start = 0
+    line = 1
+    while line < first_line:
+        newline = string.find('\n', start)
+        if newline == -1:
+            break
+        start = newline + 1
+        line += 1
+    end = start
+    for _ in range(exc_line_number - line + context + 1):
+        newline = string.find('\n', end)
+        if newline == -1:
+            end = len(string)
+            break
+        end = newline + 1
+
+    lines = string[start:end].splitlines()
+    failing = exc_line_number - line
+    if 0 <= failing < len(lines):
+        lines[failing] = '>>>>>>' + lines[failing].strip()
+    if start > 0:
+        lines.insert(0, '...')
+    if end < len(string):
+        lines.append('...')
+    return os.linesep.join(lines)
 
 
 def pretty_print_xml_tostring(xml_string):
@@ -97,65 +476,237 @@ def pretty_print_xml_tostring(xml_string):
     :return: Pretty-printed XML string
     """
     root = etree.fromstring(xml_string)
-    _indent_xml(root)
+    etree.indent(root, space='    ')
 
     return etree.tostring(root, encoding='utf-8')
 
 
-def python_to_json(string):
-    # This hurts my soul a little bit. depending on where these values are rendered, they may or may not be
-    # python or json friendly. pass through the string, make it dump-able by the json module.
-    # if anyone has a better idea... I'm around and usually not cranky.
-    python_to_json_dict = {'True,': 'true,', 'False,': 'false,', 'None,': 'null,'}
-    for from_python, to_json in python_to_json_dict.items():
-        string = string.replace(from_python, to_json)
-    return string
+_PYTHON_JSON_TOKEN = re.compile(r"""
+    (?P<space>\s+)
+    |(?P<punct>[{}\[\]:,])
+    |(?P<double>"(?:[^"\\]|\\.)*")
+    |(?P<single>'(?:[^'\\]|\\.)*')
+    |(?P<number>-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?(?![\w.]))
+    |(?P<word>-?[A-Za-z_]\w*)
+""", re.VERBOSE | re.DOTALL)
+
+# The start of a number or word that a chunk ended in the middle of, e.g. "1." or "-".
+_PARTIAL_TOKEN = re.compile(r'[-+.\w]*\Z')
+
+_PLAIN_JSON_STRING = re.compile(r'"[ !#-\[\]-~]*"$')
+_PLAIN_PYTHON_STRING = re.compile(r"'[ !#-&(-\[\]-~]*'$")
+
+# Python reprs and JSON spell these differently, the rest of the words json.loads takes are the same in both.
+_PYTHON_JSON_WORDS = {'True': 'true', 'False': 'false', 'None': 'null', 'true': 'true', 'false': 'false',
+                      'null': 'null', 'NaN': 'NaN', 'Infinity': 'Infinity', '-Infinity': '-Infinity'}
+
+# What the parser is waiting for next.
+_VALUE, _VALUE_OR_END, _KEY, _KEY_OR_END, _COLON, _COMMA_OR_END = range(6)
+
+
+def python_to_json(string, indent=None):
+    """Turns a string of JSON, or of Python reprs of dicts and lists, into JSON text in one pass.
+
+    True/False/None become true/false/null and single quoted strings become
+    double quoted ones, but only outside of strings, so a value like
+    "True, or not" comes through untouched. The structure is checked along
+    the way, and a json.JSONDecodeError raised where it goes wrong.
+
+    The output is written straight from the tokens, laid out the same as
+    json.dumps of the parsed value would, with indent as its indent. Strings
+    and numbers are re-encoded the way json.dumps encodes them.
+    """
+    return ''.join(iter_python_to_json((string,), indent))
+
+
+def iter_python_to_json(chunks, indent=None):
+    """python_to_json for a string that comes in chunks, e.g. while it's rendered.
+    Yields the JSON for each chunk as soon as it's been read, holding back
+    only a token that might carry on into the next chunk.
+
+    A json.JSONDecodeError's pos, lineno and colno are from the start of
+    the whole string, but its doc is only what was left in the buffer.
+    """
+    chunks = iter(chunks)
+    parts = []
+    stack = []  # True for an object, False for an array.
+    expect = _VALUE
+    just_opened = False
+    buf = ''
+    pos = 0
+    eof = False
+    need_more = False
+    # Where buf starts in the whole string, for errors: (offset, newlines before it, column it starts at).
+    dropped = [0, 0, 0]
+    item_separator, key_separator = (',', ': ') if indent is not None else (', ', ': ')
+    if isinstance(indent, int):
+        indent = ' ' * indent
+
+    while True:
+        if (need_more or pos >= len(buf)) and not eof:
+            if parts:
+                yield ''.join(parts)
+                parts = []
+            chunk = next(chunks, None)
+            eof = chunk is None
+            _drop_json_text(dropped, buf, pos)
+            buf = buf[pos:] + (chunk or '')
+            pos = 0
+            need_more = False
+            continue
+        if pos >= len(buf):
+            break
+        match = _PYTHON_JSON_TOKEN.match(buf, pos)
+        if not eof and (match.end() >= len(buf) and match.lastgroup in ('space', 'number', 'word')
+                        if match is not None else buf[pos] in '"\'' or _PARTIAL_TOKEN.match(buf, pos)):
+            # Cut off by the end of the chunk, or could be.
+            need_more = True
+            continue
+        if match is None:
+            raise _json_error('Expecting value', buf, pos, dropped)
+        kind = match.lastgroup
+        token = match.group()
+        if kind == 'space':
+            pos = match.end()
+            continue
+        if not stack and expect == _COMMA_OR_END:
+            raise _json_error('Extra data', buf, pos, dropped)
+
+        if kind == 'punct':
+            if token == ',' and expect == _COMMA_OR_END:
+                expect = _KEY if stack[-1] else _VALUE
+                parts.append(item_separator)
+                if indent is not None:
+                    parts.append('\n' + indent * len(stack))
+            elif token == ':' and expect == _COLON:
+                expect = _VALUE
+                parts.append(key_separator)
+            elif token in '}]' and stack and stack[-1] == (token == '}') and (
+                    expect == _COMMA_OR_END or expect == (_KEY_OR_END if token == '}' else _VALUE_OR_END)):
+                stack.pop()
+                if indent is not None and not just_opened:
+                    parts.append('\n' + indent * len(stack))
+                parts.append(token)
+                expect = _COMMA_OR_END
+                just_opened = False
+            elif token in '{[' and expect in (_VALUE, _VALUE_OR_END):
+                if just_opened and indent is not None:
+                    parts.append('\n' + indent * len(stack))
+                stack.append(token == '{')
+                expect = _KEY_OR_END if token == '{' else _VALUE_OR_END
+                parts.append(token)
+                just_opened = True
+            else:
+                raise _json_error('Unexpected {0!r}'.format(token), buf, pos, dropped)
+            pos = match.end()
+            continue
+
+        if expect in (_KEY, _KEY_OR_END):
+            if kind not in ('double', 'single'):
+                raise _json_error('Expecting property name enclosed in quotes', buf, pos, dropped)
+            next_expect = _COLON
+        elif expect in (_VALUE, _VALUE_OR_END):
+            next_expect = _COMMA_OR_END
+        else:
+            raise _json_error("Expecting ',' delimiter" if expect == _COMMA_OR_END
+                              else "Expecting ':' delimiter", buf, pos, dropped)
+
+        if kind == 'double' and _PLAIN_JSON_STRING.match(token):
+            # Nothing in it json.dumps would escape, so it's already what json.dumps would write.
+            pass
+        elif kind == 'double':
+            try:
+                token = json.dumps(json.decoder.scanstring(token, 1)[0])
+            except ValueError:
+                # Not a JSON string, but it can still be a Python one, e.g. "it's \x41".
+                token = json.dumps(_python_string(token, buf, pos, dropped))
+        elif kind == 'single' and _PLAIN_PYTHON_STRING.match(token):
+            token = '"' + token[1:-1] + '"'
+        elif kind == 'single':
+            token = json.dumps(_python_string(token, buf, pos, dropped))
+        elif kind == 'number':
+            if '.' in token or 'e' in token or 'E' in token:
+                token = json.dumps(float(token))
+            elif token == '-0':
+                token = '0'
+        else:
+            if token not in _PYTHON_JSON_WORDS:
+                raise _json_error('Expecting value', buf, pos, dropped)
+            token = _PYTHON_JSON_WORDS[token]
+
+        if just_opened and indent is not None:
+            parts.append('\n' + indent * len(stack))
+        just_opened = False
+        parts.append(token)
+        expect = next_expect
+        pos = match.end()
+
+    if stack or expect != _COMMA_OR_END:
+        raise _json_error('Expecting value', buf, pos, dropped)
+    yield ''.join(parts)
+
+
+def _drop_json_text(dropped, buf, pos):
+    # Moves where iter_python_to_json's buffer starts along by pos characters of buf.
+    newlines = buf.count('\n', 0, pos)
+    if newlines:
+        dropped[1] += newlines
+        dropped[2] = pos - buf.rindex('\n', 0, pos) - 1
+    else:
+        dropped[2] += pos
+    dropped[0] += pos
+
+
+def _json_error(msg, buf, pos, dropped):
+    exc = json.JSONDecodeError(msg, buf, pos)
+    offset, newlines, column = dropped
+    if offset:
+        if exc.lineno == 1:
+            exc.colno += column
+        exc.lineno += newlines
+        exc.pos += offset
+        exc.args = ('{0}: line {1:d} column {2:d} (char {3:d})'.format(msg, exc.lineno, exc.colno, exc.pos),)
+    return exc
+
+
+def _python_string(token, buf, pos, dropped):
+    try:
+        value = ast.literal_eval(token)
+    except (ValueError, SyntaxError):
+        value = None
+    if not isinstance(value, str):
+        raise _json_error('Invalid string', buf, pos, dropped)
+    return value
 
 
 def check_then_dump_json(strings):
     # TODO: there must be a better way to handle empty values. this is uglier than I want it to be
     safe_values = []
     for possible_danger_string in strings:
-        # If item in list of strings is not emtpy, try to make it json-friendly and dump it.
+        # If item in list of strings is not emtpy, make it json-friendly and pretty print it in one go.
         # If that fails, return failure and string with indicator of where the exception occurred.
         if possible_danger_string:
-            possible_danger_string = python_to_json(possible_danger_string)
             try:
-                json_dict = json.loads(possible_danger_string, cls=UselessJsonDecoderClass)
+                safe_json_string = python_to_json(possible_danger_string, indent=4)
             except ValueError as err:
                 # override text of value error with something more useful
                 err.args = ('Invalid JSON and content type indicates application/json! \n %s'
-                            % return_line_no_of_json_value_exc(possible_danger_string),)
+                            % return_line_no_of_json_value_exc(possible_danger_string, err),)
                 raise
             else:
-                safe_json_string = json.dumps(json_dict, indent=4)
                 safe_values.append(safe_json_string)
         else:
             safe_values.append(possible_danger_string)
     return safe_values
 
 
-def return_line_no_of_json_value_exc(string):
-    """ returns the string that caused the exception with indicators of where the error is."""
-    if sys.version_info < (3, 5):
-        last_error_pos = error_pos[0]
-    else:
-        exc_type, exc_obj, exc_tb = sys.exc_info()
-        last_error_pos = exc_obj.lineno
-    string = return_exc_printed_nice(string, last_error_pos)
-    return 'JSON Error! Look for >>>>>> \nLine: %s\n%s' % (last_error_pos, string)
-
-if sys.version_info < (3, 5):
-    original_errmsg = json.decoder.errmsg
-
+def return_line_no_of_json_value_exc(string, exc=None):
+    """ returns the lines around where the string caused the exception with indicators of where the error is.
 
-def custom_errmsg(msg, doc, pos, end=None):
-    global error_pos
-    error_pos = json.decoder.linecol(doc, pos)
-    return original_errmsg(msg, doc, pos, end)
-
-
-class UselessJsonDecoderClass(json.JSONDecoder):
-    json.decoder.errmsg = custom_errmsg
-    if sys.version_info < (3, 5):
-        json.decoder.errmsg = custom_errmsg
+    exc is the json.JSONDecodeError, which knows where it happened. Leave it out
+    in an except block to use the exception being handled.
+    """
+    if exc is None:
+        exc = sys.exc_info()[1]
+    string = return_exc_printed_nice(string, exc.lineno)
+    return 'JSON Error! Look for >>>>>> \nLine: %s Column: %s\n%s' % (exc.lineno, exc.colno, string)
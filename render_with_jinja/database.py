@@ -0,0 +1,372 @@
+"""Connections to, and schema migrations for, the template database.
+
+The schema version lives in sqlite's user_version pragma. Each entry in
+MIGRATIONS is the script that takes the database from that index to the
+next, so a new change to the schema is just a new script on the end.
+Migrations that need more than SQL can be functions taking the connection.
+
+Template bodies are stored compressed in template_blobs, keyed by the
+SHA-256 of their text, so identical bodies are only stored once, and
+templates just point at the hash of theirs.
+
+Every version of a template is kept in template_revisions, mostly as a
+delta against the version before it, with a full snapshot every so often
+so rebuilding an old one never has to apply too many deltas. The latest
+version is still just the template's blob.
+"""
+
+import json
+import zlib
+import difflib
+import hashlib
+import time
+import sqlite3
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def compress_body(contents, codec='zlib', level=6):
+    """Returns contents compressed by codec, 'zlib' or 'zstd', at level."""
+    data = contents.encode('utf-8')
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd template compression needs the zstandard package')
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise ValueError('Unknown template codec', codec)
+
+
+def decompress_body(codec, data):
+    if codec == 'zlib':
+        data = zlib.decompress(data)
+    elif codec == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compressed template bodies need the zstandard package')
+        data = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        raise ValueError('Unknown template codec', codec)
+    return data.decode('utf-8')
+
+
+def store_template_body(conn, contents, codec='zlib', level=6):
+    """Stores a template body, unless the same one is already stored, and returns its hash.
+    Nothing is compressed for a body that's already there.
+    """
+    encoded = contents.encode('utf-8')
+    content_hash = hashlib.sha256(encoded).hexdigest()
+    if conn.execute('select 1 from template_blobs where hash = ?', (content_hash,)).fetchone() is None:
+        conn.execute('insert or ignore into template_blobs (hash, codec, size, data) values (?, ?, ?, ?)',
+                     (content_hash, codec, len(encoded),
+                      sqlite3.Binary(compress_body(contents, codec, level))))
+    return content_hash
+
+
+def load_template_body(conn, content_hash):
+    """Returns the decompressed template body stored under content_hash, or None."""
+    row = conn.execute('select codec, data from template_blobs where hash = ?', (content_hash,)).fetchone()
+    if row is None:
+        return None
+    return decompress_body(row[0], bytes(row[1]))
+
+
+def drop_unused_body(conn, content_hash):
+    """Deletes a stored body once no template points at it any more."""
+    conn.execute('delete from template_blobs where hash = ? '
+                 'and not exists (select 1 from templates where content_hash = ?)', (content_hash, content_hash))
+
+
+def _move_contents_to_blobs(conn):
+    # sqlite can't drop the contents column in place, so the table is rebuilt without it.
+    conn.execute("""create table if not exists template_blobs (
+        hash text primary key,
+        codec text not null,
+        size integer not null,
+        data blob not null
+    )""")
+    conn.execute('drop table if exists templates_new')
+    conn.execute("""create table templates_new (
+        id integer primary key autoincrement,
+        filename text not null,
+        content_hash text not null references template_blobs (hash),
+        size integer not null default 0,
+        version integer not null default 1,
+        updated_at real not null default 0,
+        variables text,
+        referenced_templates text
+    )""")
+    rows = conn.execute('select id, filename, contents, size, version, updated_at, variables, referenced_templates '
+                        'from templates')
+    for row in rows.fetchall():
+        content_hash = store_template_body(conn, row[2])
+        conn.execute('insert into templates_new (id, filename, content_hash, size, version, updated_at, '
+                     'variables, referenced_templates) values (?, ?, ?, ?, ?, ?, ?, ?)',
+                     (row[0], row[1], content_hash) + tuple(row[3:]))
+    conn.execute('drop table templates')
+    conn.execute('alter table templates_new rename to templates')
+    conn.execute('create unique index if not exists templates_filename on templates (filename)')
+    conn.execute('create index if not exists templates_content_hash on templates (content_hash)')
+
+
+def _make_delta(old_lines, new_lines):
+    """Returns what turns old_lines into new_lines, as a list of [start, end] slices
+    of old_lines to copy, and strings of new text, to be put together in order.
+    """
+    delta = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            delta.append([i1, i2])
+        elif tag != 'delete':
+            delta.append(''.join(new_lines[j1:j2]))
+    return delta
+
+
+def _apply_delta(old_text, delta):
+    old_lines = old_text.splitlines(True)
+    return ''.join(''.join(old_lines[op[0]:op[1]]) if isinstance(op, list) else op for op in delta)
+
+
+def record_revision(conn, template_id, revision, contents, previous_contents=None, snapshot_every=10,
+                    level=6):
+    """Adds revision of a template to its history.
+
+    It's stored as a delta against previous_contents, which has to be
+    revision - 1, unless there isn't one, revision is a multiple of
+    snapshot_every, or the delta wouldn't be any smaller, in which case it's
+    a full snapshot. Either way it's zlib compressed.
+    """
+    kind = 'snapshot'
+    data = zlib.compress(contents.encode('utf-8'), level)
+    if previous_contents is not None and revision % snapshot_every:
+        delta = _make_delta(previous_contents.splitlines(True), contents.splitlines(True))
+        delta_data = zlib.compress(json.dumps(delta, separators=(',', ':')).encode('utf-8'), level)
+        if len(delta_data) < len(data):
+            kind, data = 'delta', delta_data
+    conn.execute('insert or replace into template_revisions (template_id, revision, kind, data, size, created_at) '
+                 'values (?, ?, ?, ?, ?, ?)',
+                 (template_id, revision, kind, sqlite3.Binary(data), len(contents.encode('utf-8')), time.time()))
+
+
+def get_revision(conn, template_id, revision=None):
+    """Returns the body of a template as of revision, or None if there's no such revision.
+
+    The latest revision, which is what leaving revision out gets, is read
+    straight from the template's blob. Older ones are rebuilt from the last
+    snapshot at or before them, plus the deltas after it.
+    """
+    row = conn.execute('select version, content_hash from templates where id = ?', (template_id,)).fetchone()
+    if row is None:
+        return None
+    if revision is None or revision == row[0]:
+        return load_template_body(conn, row[1])
+    rows = conn.execute('select revision, kind, data from template_revisions '
+                        'where template_id = ? and revision <= ? and revision >= '
+                        '(select max(revision) from template_revisions '
+                        "where template_id = ? and revision <= ? and kind = 'snapshot') "
+                        'order by revision', (template_id, revision, template_id, revision)).fetchall()
+    if not rows or rows[-1][0] != revision:
+        return None
+    contents = None
+    for _, kind, data in rows:
+        data = zlib.decompress(bytes(data)).decode('utf-8')
+        contents = data if kind == 'snapshot' else _apply_delta(contents, json.loads(data))
+    return contents
+
+
+def list_revisions(conn, template_id):
+    """Returns (revision, kind, size, created_at) rows for each revision of a template, newest first."""
+    return conn.execute('select revision, kind, size, created_at from template_revisions where template_id = ? '
+                        'order by revision desc', (template_id,)).fetchall()
+
+
+def diff_revisions(conn, template_id, from_revision, to_revision, filename='template'):
+    """Returns a unified diff, as a list of lines, from one revision of a template to another,
+    or None if either one doesn't exist.
+    """
+    from_contents = get_revision(conn, template_id, from_revision)
+    to_contents = get_revision(conn, template_id, to_revision)
+    if from_contents is None or to_contents is None:
+        return None
+    return list(difflib.unified_diff(from_contents.splitlines(True), to_contents.splitlines(True),
+                                     '{0}@{1}'.format(filename, from_revision),
+                                     '{0}@{1}'.format(filename, to_revision)))
+
+
+def _add_revisions(conn):
+    conn.execute("""create table if not exists template_revisions (
+        template_id integer not null references templates (id),
+        revision integer not null,
+        kind text not null,
+        data blob not null,
+        size integer not null,
+        created_at real not null,
+        primary key (template_id, revision)
+    )""")
+    # What's there now is the only history there is, so it starts off as a snapshot.
+    for template_id, version, content_hash in conn.execute('select id, version, content_hash from templates'
+                                                           ).fetchall():
+        record_revision(conn, template_id, version, load_template_body(conn, content_hash))
+
+
+MIGRATIONS = [
+    # 0 -> 1: versioned templates, so the template loader can tell when one has been edited.
+    """
+    alter table templates add column version integer not null default 1;
+    alter table templates add column updated_at real not null default 0;
+    create index if not exists templates_filename on templates (filename);
+    """,
+    # 1 -> 2: what each template uses, as JSON lists, so renders can be given only that. null if not analyzed yet.
+    """
+    alter table templates add column variables text;
+    alter table templates add column referenced_templates text;
+    """,
+    # 2 -> 3: one row per filename, and sizes, so the template list never has to read contents.
+    """
+    drop index if exists templates_filename;
+    create unique index if not exists templates_filename on templates (filename);
+    alter table templates add column size integer not null default 0;
+    update templates set size = length(cast(contents as blob));
+    """,
+    # 3 -> 4: bodies move to template_blobs, compressed and deduplicated by hash.
+    _move_contents_to_blobs,
+    # 4 -> 5: a history of every template, as deltas with periodic snapshots.
+    _add_revisions,
+]
+
+
+def has_schema(conn):
+    """Whether conn's database has been created, by schema.sql or an older version of it."""
+    cur = conn.execute("select 1 from sqlite_master where type = 'table' and name = 'templates'")
+    return cur.fetchone() is not None
+
+
+def get_schema_version(conn):
+    return conn.execute('pragma user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """Runs whatever migrations conn's database hasn't had yet, in order, in one transaction.
+    Returns the (old, new) schema versions.
+
+    The version is read after taking the write lock, so when two processes
+    start on the same database at once, the second one waits for the first
+    and then finds there's nothing left to do.
+    """
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute('begin immediate')
+    try:
+        old_version = get_schema_version(conn)
+        for version in range(old_version, len(MIGRATIONS)):
+            migration = MIGRATIONS[version]
+            if callable(migration):
+                migration(conn)
+            else:
+                # Not executescript, which would commit first and let go of the lock.
+                for statement in _script_statements(migration):
+                    conn.execute(statement)
+            # Pragmas can't take parameters.
+            conn.execute('pragma user_version = {0:d}'.format(version + 1))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return old_version, len(MIGRATIONS)
+
+
+def _script_statements(script):
+    statement = ''
+    for line in script.splitlines(True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ''
+    if statement.strip():
+        yield statement
+
+
+def init_db(conn, schema):
+    """Creates the database afresh from schema, the script in schema.sql, which
+    drops anything that was there. Then runs whatever migrations schema is
+    behind on, which should be none. Safe to run again on a database it made.
+    """
+    conn.executescript(schema)
+    conn.commit()
+    return migrate(conn)
+
+
+class ConnectionManager(object):
+    """Hands out one long-lived connection to the database per thread.
+
+    Every connection is put in WAL mode, so readers don't wait on writers,
+    with synchronous=NORMAL, which is safe under WAL and spares a sync per
+    commit, and a bigger page cache. Keeping them open means their page
+    caches stay warm and their statement caches get reused, as long as the
+    SQL is parameterized rather than formatted.
+
+    Connections are only kept for threads that are still running. A thread's
+    connection is closed once the thread has finished, the next time another
+    connection is made or released, so a server that starts a thread per
+    request doesn't pile them up.
+
+    :param cache_size: Page cache per connection, in KiB.
+    :param cached_statements: How many prepared statements each connection keeps.
+    """
+
+    def __init__(self, database, cache_size=16384, cached_statements=256, timeout=30, row_factory=sqlite3.Row):
+        self.database = database
+        self.cache_size = cache_size
+        self.cached_statements = cached_statements
+        self.timeout = timeout
+        self.row_factory = row_factory
+        self._local = threading.local()
+        # Thread -> its connection, so close_all can get at them all, and the dead threads' ones can be dropped.
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Only ever used by this thread, but closed by whichever one notices this one has finished.
+            conn = sqlite3.connect(self.database, timeout=self.timeout, cached_statements=self.cached_statements,
+                                   check_same_thread=False)
+            conn.row_factory = self.row_factory
+            conn.execute('pragma journal_mode = wal')
+            conn.execute('pragma synchronous = normal')
+            # Negative means KiB rather than pages.
+            conn.execute('pragma cache_size = {0:d}'.format(-self.cache_size))
+            self._local.conn = conn
+            with self._lock:
+                self._drop_finished()
+                self._connections[threading.current_thread()] = conn
+        return conn
+
+    def release(self):
+        """Ends whatever transaction this thread's connection was left in, keeping the connection.
+        Also drops the connections of threads that have finished since the last time.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._drop_finished()
+
+    def _drop_finished(self):
+        for thread in [thread for thread in self._connections if not thread.is_alive()]:
+            self._connections.pop(thread).close()
+
+    def __len__(self):
+        """How many connections are being kept."""
+        return len(self._connections)
+
+    def close_all(self):
+        with self._lock:
+            connections, self._connections = list(self._connections.values()), {}
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
@@ -7,15 +7,120 @@
 .. moduleauthor:: Emily Langer <emily.langer@expeditors.com>
 """
 
+import os
 import re
+import hashlib
 import logging
+import threading
+import xml.etree.ElementTree as etree
 from dateutil import parser
 import datetime
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 
 logger = logging.getLogger('PynetServer')
 
+BatchDiffResult = namedtuple('BatchDiffResult', ['index', 'mo_money', 'differences', 'error'])
 
-def diff_xml(expected_xml, live_xml, validate_strict_order, xpaths_to_ignore=None):
+
+_NO_ATTRIB_KEY = frozenset()
+
+
+class ElementPath(object):
+    """
+    A parent-linked representation of an element and its ancestors.
+
+    Every element in a document gets exactly one ElementPath, which points at
+    the ElementPath of its parent, so siblings share their ancestry instead
+    of each carrying a copy of it. Its node is the (tag, attrib) tuple for
+    elements with children, or (tag, attrib, text) for childless ones.
+
+    ElementPaths still behave like the old lists of tuples: iterating yields
+    the nodes root first, path[-1] is the element's own node, and slicing
+    returns a list. The hash is built from the parent's cached hash, so it
+    costs O(1) per element, and paths built with the same path_cache (see
+    make_element_path) share ancestor objects, so equality is usually
+    decided by an identity check on the parents.
+    """
+    __slots__ = ('parent', 'node', 'key', '_hash')
+
+    def __init__(self, parent, node):
+        self.parent = parent
+        self.node = node
+        # Element.attrib is a dict, so freeze it to get something hashable. Most are empty.
+        self.key = (node[0], frozenset(node[1].items()) if node[1] else _NO_ATTRIB_KEY) + node[2:]
+        self._hash = hash((parent._hash if parent is not None else None, self.key))
+
+    def __iter__(self):
+        nodes = []
+        path = self
+        while path is not None:
+            nodes.append(path.node)
+            path = path.parent
+        return reversed(nodes)
+
+    def __len__(self):
+        length = 0
+        path = self
+        while path is not None:
+            length += 1
+            path = path.parent
+        return length
+
+    def __getitem__(self, index):
+        if index == -1:
+            return self.node
+        return list(self)[index]
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, ElementPath):
+            if isinstance(other, list):
+                return list(self) == other
+            return NotImplemented
+        a, b = self, other
+        while a is not b:
+            if a is None or b is None or a._hash != b._hash or a.key != b.key:
+                return False
+            a, b = a.parent, b.parent
+        return True
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def make_element_path(parent, node, path_cache=None):
+    """
+    Builds an ElementPath, reusing an identical one from path_cache if possible.
+
+    Sharing a path_cache dict between the two documents of a diff interns
+    their common ancestries, so comparing two equal paths only walks up as
+    far as the first shared ancestor.
+
+    :param parent: ElementPath of the parent element, or None for the root.
+    :type parent: None, ElementPath
+    :param node: (tag, attrib) or (tag, attrib, text) tuple.
+    :type node: tuple
+    :param path_cache: Dict used to intern ElementPaths.
+    :type path_cache: None, dict
+    :rtype: ElementPath
+    """
+    path = ElementPath(parent, node)
+    if path_cache is None:
+        return path
+    return path_cache.setdefault(path, path)
+
+
+def diff_xml(expected_xml, live_xml, validate_strict_order, xpaths_to_ignore=None, prune_identical=False,
+             plan=None):
     """
     Diffs two ElementTree Elements.
 
@@ -27,6 +132,85 @@ def diff_xml(expected_xml, live_xml, validate_strict_order, xpaths_to_ignore=Non
     xpaths_to_ignore takes a list of strings which is passed to
     get_comparison_objects. Elements that match are ignored and not validated.
 
+    prune_identical runs find_identical_subtrees first, so subtrees that are
+    the same in both documents are never flattened or compared, and the work
+    scales with the size of the change rather than the size of the documents.
+    It is only used when validate_strict_order is False, since taking matched
+    subtrees out of order could change how the remaining leaves line up.
+
+    plan takes a ComparisonPlan, which replaces xpaths_to_ignore with ignore
+    XPaths and number/date tolerances compiled ahead of time.
+
+    :param expected_xml: XML containing the expected data.
+    :type expected_xml: xml.etree.ElementTree.Element
+    :param live_xml: XML containing the live response data.
+    :type live_xml: xml.etree.ElementTree.Element
+    :param xpaths_to_ignore: List of XPath strings which should be used
+        to filter elements that should not be diffed.
+    :type xpaths_to_ignore: None, list
+    :param prune_identical: If True, skip subtrees that are identical in both documents.
+    :type prune_identical: bool
+    :param plan: Compiled ignore XPaths and tolerances for this comparison.
+    :type plan: None, ComparisonPlan
+    :returns: List of tuples: (Parsed variables dict, non-matching elements from expected_xml,
+        non-matching elements from live_xml)
+    :rtype: tuple
+    """
+    if plan is not None and xpaths_to_ignore:
+        raise ValueError('xpaths_to_ignore has to be compiled into the ComparisonPlan')
+    path_cache = {}
+    expected_skip = live_skip = None
+    if prune_identical and validate_strict_order is not True:
+        if plan is None:
+            expected_ignored = get_ignored_elements(expected_xml, xpaths_to_ignore)
+            live_ignored = get_ignored_elements(live_xml, xpaths_to_ignore)
+        else:
+            expected_ignored = plan.get_ignored_elements(expected_xml)
+            live_ignored = plan.get_ignored_elements(live_xml)
+        identical = find_identical_subtrees(expected_xml, live_xml, expected_ignored, live_ignored)
+        if identical is None:
+            return {}, [], []
+        expected_skip, live_skip = identical
+        if plan is None:
+            # The ignored elements are already found, no need to findall() again.
+            expected_skip.update(expected_ignored)
+            live_skip.update(live_ignored)
+            xpaths_to_ignore = None
+
+    if plan is None:
+        expected_xml_objects = get_comparison_objects(expected_xml, xpaths_to_ignore, path_cache, expected_skip)
+        live_xml_objects = get_comparison_objects(live_xml, xpaths_to_ignore, path_cache, live_skip)
+    else:
+        expected_xml_objects, live_xml_objects = plan.get_comparison_objects(expected_xml, live_xml, path_cache,
+                                                                             expected_skip, live_skip)
+
+    expected_xml_objects, live_xml_objects = compare_lists_strict(expected_xml_objects, live_xml_objects,
+                                                                  validate_strict_order)
+
+    mo_money_dict, expected_xml_objects, live_xml_objects = get_mo_money(expected_xml_objects, live_xml_objects)
+
+    return mo_money_dict, expected_xml_objects, live_xml_objects
+
+
+def diff_xml_limited(expected_xml, live_xml, validate_strict_order, xpaths_to_ignore=None, max_differences=None,
+                     match_only=False, plan=None):
+    """
+    Diffs two ElementTree Elements, giving up once there are too many differences.
+
+    Works like diff_xml, but stops as soon as it's certain there are more
+    than max_differences differences. match_only is the same as a budget of
+    0, for when all that matters is whether the documents match.
+
+    Without validate_strict_order, the live document is flattened lazily and
+    counted against the expected leaves, and the walk of the live document
+    stops once more than max_differences live leaves are left over that no
+    expected mo money variable could match. With it, the alignment gives up
+    once it needs more edits than the budget, plus two for every expected
+    mo money variable, since each one might still cancel out a deletion and
+    an insertion.
+
+    The mo money dict is only filled in when the comparison ran to the end.
+
     :param expected_xml: XML containing the expected data.
     :type expected_xml: xml.etree.ElementTree.Element
     :param live_xml: XML containing the live response data.
@@ -34,12 +218,110 @@ def diff_xml(expected_xml, live_xml, validate_strict_order, xpaths_to_ignore=Non
     :param xpaths_to_ignore: List of XPath strings which should be used
         to filter elements that should not be diffed.
     :type xpaths_to_ignore: None, list
+    :param max_differences: Most differences to return. None means no limit.
+    :type max_differences: None, int
+    :param match_only: If True, only find out whether the documents match.
+    :type match_only: bool
+    :param plan: Compiled ignore XPaths and tolerances for this comparison.
+    :type plan: None, ComparisonPlan
+    :returns: (Parsed variables dict, non-matching elements from expected_xml,
+        non-matching elements from live_xml, True if there were more differences
+        than returned)
+    :rtype: tuple
+    """
+    if match_only:
+        max_differences = 0
+    if max_differences is None:
+        return diff_xml(expected_xml, live_xml, validate_strict_order, xpaths_to_ignore, plan=plan) + (False,)
+    if plan is not None and xpaths_to_ignore:
+        raise ValueError('xpaths_to_ignore has to be compiled into the ComparisonPlan')
+
+    path_cache = {}
+    if plan is None:
+        expected_xml_objects = get_comparison_objects(expected_xml, xpaths_to_ignore, path_cache)
+        live_xml_objects = _iter_element_paths(live_xml, get_ignored_elements(live_xml, xpaths_to_ignore),
+                                               path_cache)
+    else:
+        # Tolerances can only be decided once both documents have been walked.
+        expected_xml_objects, live_xml_objects = plan.get_comparison_objects(expected_xml, live_xml, path_cache)
+
+    # Expected leaves with mo money variables might still match a difference.
+    variable_leaves = [o for o in expected_xml_objects if _has_mo_money(o)]
+    variable_ancestries = set(_ancestry_key(o) for o in variable_leaves)
+
+    if validate_strict_order is True:
+        live_xml_objects = list(live_xml_objects)
+        ids = {}
+        a_ids = [ids.setdefault(leaf_key(a_obj), len(ids)) for a_obj in expected_xml_objects]
+        b_ids = [ids.setdefault(leaf_key(b_obj), len(ids)) for b_obj in live_xml_objects]
+        aligned = align_sequences(a_ids, b_ids, max_differences + 2 * len(variable_leaves))
+        if aligned is None:
+            return {}, [], [], True
+        expected_xml_objects = [expected_xml_objects[i] for i in aligned[0]]
+        live_xml_objects = [live_xml_objects[i] for i in aligned[1]]
+    else:
+        available = {}
+        for a_obj in expected_xml_objects:
+            key = leaf_key(a_obj)
+            available[key] = available.get(key, 0) + 1
+        matched = {}
+        live_leftovers = []
+        certain = []
+        for b_obj in live_xml_objects:
+            key = leaf_key(b_obj)
+            if available.get(key, 0) > 0:
+                available[key] -= 1
+                matched[key] = matched.get(key, 0) + 1
+                continue
+            live_leftovers.append(b_obj)
+            # Nothing in the expected document can match this one any more.
+            if _ancestry_key(b_obj) not in variable_ancestries:
+                certain.append(b_obj)
+                if len(certain) > max_differences:
+                    return {}, [], certain[:max_differences], True
+        expected_leftovers = []
+        for a_obj in expected_xml_objects:
+            key = leaf_key(a_obj)
+            if matched.get(key, 0) > 0:
+                matched[key] -= 1
+            else:
+                expected_leftovers.append(a_obj)
+        expected_xml_objects, live_xml_objects = expected_leftovers, live_leftovers
+
+    mo_money_dict, expected_xml_objects, live_xml_objects = get_mo_money(expected_xml_objects, live_xml_objects)
+
+    truncated = len(expected_xml_objects) + len(live_xml_objects) > max_differences
+    if truncated:
+        expected_xml_objects = expected_xml_objects[:max_differences]
+        live_xml_objects = live_xml_objects[:max_differences - len(expected_xml_objects)]
+    return mo_money_dict, expected_xml_objects, live_xml_objects, truncated
+
+
+def diff_xml_stream(expected_source, live_source, validate_strict_order, xpaths_to_ignore=None):
+    """
+    Diffs two XML documents read from files or byte streams.
+
+    Works exactly like diff_xml, but the comparison objects are built with
+    iter_comparison_objects, so neither document is ever held in memory as
+    a whole ElementTree.
+
+    :param expected_source: File name or binary file object containing the
+        expected data.
+    :type expected_source: str, file
+    :param live_source: File name or binary file object containing the live
+        response data.
+    :type live_source: str, file
+    :param xpaths_to_ignore: List of XPath strings which should be used
+        to filter elements that should not be diffed. See
+        iter_comparison_objects for the supported subset.
+    :type xpaths_to_ignore: None, list
     :returns: List of tuples: (Parsed variables dict, non-matching elements from expected_xml,
         non-matching elements from live_xml)
     :rtype: tuple
     """
-    expected_xml_objects = get_comparison_objects(expected_xml, xpaths_to_ignore)
-    live_xml_objects = get_comparison_objects(live_xml, xpaths_to_ignore)
+    path_cache = {}
+    expected_xml_objects = list(iter_comparison_objects(expected_source, xpaths_to_ignore, path_cache))
+    live_xml_objects = list(iter_comparison_objects(live_source, xpaths_to_ignore, path_cache))
 
     expected_xml_objects, live_xml_objects = compare_lists_strict(expected_xml_objects, live_xml_objects,
                                                                   validate_strict_order)
@@ -49,9 +331,144 @@ def diff_xml(expected_xml, live_xml, validate_strict_order, xpaths_to_ignore=Non
     return mo_money_dict, expected_xml_objects, live_xml_objects
 
 
-def get_comparison_objects(xml_element, xpaths_to_ignore=None):
+def diff_xml_batch(jobs, validate_strict_order=False, processes=None, chunksize=16, parse=etree.fromstring,
+                   prune_identical=True, indexed=False):
+    """
+    Diffs many expected/live pairs across a pool of worker processes.
+
+    jobs is consumed lazily in chunks of chunksize, and only a couple of
+    chunks per process are ever in flight, so a huge (or endless) iterable of
+    jobs doesn't pile up in memory. The documents are sent to the workers as
+    the raw strings and parsed there, and only the pretty printed differences
+    come back, which keeps pickling cheap.
+
+    The chunks are handed out by iter_chunked_results. Results are yielded
+    in completion order, so use their index to tie them back to their jobs.
+    A job that fails in any way, e.g. to parse, or because its mo money
+    can't be matched, gets a result with error set instead of raising, and
+    so does every job of a chunk whose worker died.
+
+    :param jobs: Iterable of (expected, live, xpaths_to_ignore) tuples, where
+        expected and live are strings or bytes for parse, and
+        xpaths_to_ignore is None or a list of XPath strings.
+    :type jobs: iterable
+    :param validate_strict_order: Passed to diff_xml.
+    :type validate_strict_order: bool
+    :param processes: Number of worker processes. Defaults to the CPU count.
+    :type processes: None, int
+    :param chunksize: Number of jobs sent to a worker at once.
+    :type chunksize: int
+    :param parse: Picklable, module level function turning a job's document
+        into an Element, e.g. jsondiff.json_to_xml for JSON.
+    :type parse: function
+    :param prune_identical: Passed to diff_xml.
+    :type prune_identical: bool
+    :param indexed: If set, each job is (index, expected, live,
+        xpaths_to_ignore), and its result gets that index instead of the
+        job's position in jobs, e.g. a line number.
+    :type indexed: bool
+    :returns: Generator of BatchDiffResult(index, mo_money, differences, error)
+    :rtype: generator
     """
-    Builds list-of-tuples representations of each element and its ancestors.
+    processes = processes or os.cpu_count() or 1
+    jobs = (tuple(job) for job in jobs) if indexed else ((index,) + tuple(job) for index, job in enumerate(jobs))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for result in iter_chunked_results(executor, 2 * processes, jobs, chunksize, _batch_error_result,
+                                           _diff_xml_chunk, validate_strict_order, parse, prune_identical):
+            yield result
+
+
+def iter_chunked_results(executor, max_pending, items, chunksize, error_result, worker, *args):
+    """
+    Feeds items to worker on executor a chunk at a time, and yields what comes back.
+
+    items is consumed lazily, chunksize at a time, with at most max_pending
+    chunks in flight, so a huge (or endless) iterable of them doesn't pile
+    up in memory. Each chunk is sent as worker(chunk, *args), which returns
+    a list of results. Those are yielded in completion order.
+
+    If a chunk can't be sent, or its worker fails, e.g. because the process
+    died, every item in it gets error_result(index, exception) instead, so
+    one bad chunk never cuts the rest short.
+
+    :param executor: Executor to submit the chunks to.
+    :type executor: concurrent.futures.Executor
+    :param max_pending: Most chunks to have in flight at once.
+    :type max_pending: int
+    :param items: Iterable of tuples, each starting with its index.
+    :type items: iterable
+    :param chunksize: Number of items sent to a worker at once.
+    :type chunksize: int
+    :param error_result: Makes the result for an item whose chunk failed.
+    :type error_result: function
+    :param worker: Picklable, module level function taking a list of items.
+    :type worker: function
+    :returns: Generator of whatever worker and error_result return.
+    :rtype: generator
+    """
+    # Future -> the indexes of the items in its chunk, to report them all if it fails.
+    pending = {}
+    items = iter(items)
+    exhausted = False
+    while not exhausted or pending:
+        # Top the pool back up, a chunk at a time.
+        while not exhausted and len(pending) < max_pending:
+            chunk = []
+            for item in items:
+                chunk.append(item)
+                if len(chunk) == chunksize:
+                    break
+            else:
+                exhausted = True
+            if not chunk:
+                continue
+            try:
+                pending[executor.submit(worker, chunk, *args)] = [item[0] for item in chunk]
+            except Exception as exc:
+                # A broken pool refuses new work too.
+                for item in chunk:
+                    yield error_result(item[0], exc)
+        if not pending:
+            break
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            indexes = pending.pop(future)
+            try:
+                results = future.result()
+            except Exception as exc:
+                results = [error_result(index, exc) for index in indexes]
+            for result in results:
+                yield result
+
+
+def _diff_xml_chunk(chunk, validate_strict_order, parse, prune_identical):
+    """Worker side of diff_xml_batch. Diffs a list of (index, expected, live, xpaths_to_ignore) jobs."""
+    results = []
+    for index, expected, live, xpaths_to_ignore in chunk:
+        try:
+            mo_money, expected_leftovers, live_leftovers = diff_xml(parse(expected), parse(live),
+                                                                    validate_strict_order, xpaths_to_ignore,
+                                                                    prune_identical=prune_identical)
+            differences = pretty_print_differences(expected_leftovers, live_leftovers)
+        except Exception as exc:
+            # Anything one job does wrong is that job's error, not the whole chunk's.
+            results.append(_batch_error_result(index, exc))
+        else:
+            results.append(BatchDiffResult(index, mo_money, differences, None))
+    return results
+
+
+def _batch_error(exc):
+    return '{0}: {1}'.format(type(exc).__name__, exc)
+
+
+def _batch_error_result(index, exc):
+    return BatchDiffResult(index, {}, [], _batch_error(exc))
+
+
+def get_comparison_objects(xml_element, xpaths_to_ignore=None, path_cache=None, skip=None):
+    """
+    Builds ElementPath representations of each element and its ancestors.
 
     Python's xml.etree.ElementTree module does not offer Element objects
     whose contents can be directly compared. To address this issue in an
@@ -61,71 +478,540 @@ def get_comparison_objects(xml_element, xpaths_to_ignore=None):
     Each childless Element is represented by a (tag, attrib, text) tuple,
     and each of its ancestors is represented only by (tag, attrib), as
     the text attribute of those Elements is typically whitespace, which
-    we want to ignore for our purposes.
+    we want to ignore for our purposes. The tuples are chained together
+    by ElementPath, so ancestors are shared between their descendants.
 
     xpaths_to_ignore takes a list of strings to use as args for
     Element.findall(). Elements that match are discarded (not returned)
     as they are not to be validated.
 
-    :param xml_element: The XML object to be broken into a list of tuples.
+    :param xml_element: The XML object to be broken into a list of ElementPaths.
     :type xml_element: xml.etree.ElementTree.Element
     :param xpaths_to_ignore: List of XPath strings which should be used
         to filter elements in xml_element.
     :type xpaths_to_ignore: None, list
-    :returns: List of tuples that represent xml_element and its children.
+    :param path_cache: Dict used to intern ElementPaths, see make_element_path.
+    :type path_cache: None, dict
+    :param skip: Set of Elements to leave out along with their descendants,
+        just like the ones matched by xpaths_to_ignore.
+    :type skip: None, set
+    :returns: List of ElementPaths that represent xml_element's childless elements.
     :rtype: list
     """
-    # Build dict of {child: parent} relationships
-    parent_map = {child: parent for parent in xml_element.iter() for child in parent}
+    # Generate a set of all elements which match the xpaths_to_ignore.
+    ignore_set = get_ignored_elements(xml_element, xpaths_to_ignore)
+    if skip:
+        ignore_set.update(skip)
+
     # This is where all of our childless nodes go for later comparison.
-    compare_list = []
+    return list(_iter_element_paths(xml_element, ignore_set, path_cache))
 
-    # Generate a set of all elements which match the xpaths_to_ignore.
-    ignore_set = set()
-    if xpaths_to_ignore:
-        for xpath in xpaths_to_ignore:
-            ignore_set.update(xml_element.findall(xpath))
 
-    # Handling the root by itself lets us bypass the check for None after .get()ting
-    # from the ancestor_map in the loop below. Root has no parent_info.
-    ancestor_map = {}
-    if xml_element not in ignore_set:
-        ancestor_map[xml_element] = [(xml_element.tag, xml_element.attrib)]
-    # If there are no children, we want to compare everything.
-    if not list(xml_element):
-        compare_list.append([(xml_element.tag, xml_element.attrib, xml_element.text)])
-
-    xml_element_iter = xml_element.iter()
-    next(xml_element_iter)  # Skip the root, because we've already handled it.
-    for elem in xml_element_iter:
-        parent = parent_map.get(elem)
-        parent_info = ancestor_map.get(parent)
-        # No parent info means the parent was ignored, and elem should be too.
+def _iter_element_paths(xml_element, ignore_set, path_cache=None):
+    """Generator doing the walk for get_comparison_objects, so the leaves can also be consumed lazily."""
+    return walk_comparison_objects(element_node(xml_element), path_cache=path_cache, ignore_set=ignore_set)
+
+
+def element_node(xml_element):
+    """The walk_comparison_objects node for an Element, with its children walked straight off the tree."""
+    return (xml_element.tag, xml_element.attrib, xml_element.text,
+            _iter_element_nodes(xml_element) if len(xml_element) else None, xml_element)
+
+
+def _iter_element_nodes(xml_element):
+    for child in xml_element:
+        yield child.tag, child.attrib, child.text, _iter_element_nodes(child) if len(child) else None, child
+
+
+def walk_comparison_objects(root, ignore_steps=(), path_cache=None, ignore_set=None, watches=(), texts=None,
+                            covered=None):
+    """
+    Walks a tree of nodes into the ElementPaths get_comparison_objects makes.
+
+    This is the one walk behind every way of building comparison objects.
+    Each front end describes its document as nodes: get_comparison_objects
+    and ComparisonPlan use element_node, iter_comparison_objects reads them
+    off iterparse, and jsondiff makes them from parsed or streamed JSON.
+
+    A node is a (tag, attrib, text, children, key) tuple. children is None
+    for a childless node, and otherwise an iterable of its child nodes,
+    which is only consumed as the walk reaches them, so a front end can
+    produce them while it reads its document. key is whatever ignore_set
+    and watches recognize the node by, e.g. its Element.
+
+    Nodes matching ignore_steps, or whose key is in ignore_set, are left
+    out along with their descendants. A childless root is always compared,
+    ignored or not, and an ignored root with children leaves nothing.
+
+    Each watch is compiled steps, or a set of keys, to find values in the
+    same walk, like ComparisonPlan's tolerances do. texts[i] is set to the
+    text of the first node watches[i] matches ('' if it has none), unless it
+    is already set, and covered[i] gets the index of every leaf yielded at or
+    under a node it matches. Ignored subtrees are still walked into, without
+    yielding anything, while a watch has yet to find its text.
+
+    :param root: Node for the root of the document.
+    :type root: tuple
+    :param ignore_steps: List of compile_streaming_xpath steps to ignore.
+    :type ignore_steps: list
+    :param path_cache: Dict used to intern ElementPaths, see make_element_path.
+    :type path_cache: None, dict
+    :param ignore_set: Keys of nodes to leave out.
+    :type ignore_set: None, set
+    :param watches: List of compile_streaming_xpath steps or sets of keys.
+    :type watches: list
+    :param texts: List with an entry per watch, None until found.
+    :type texts: None, list
+    :param covered: List with a set per watch.
+    :type covered: None, list
+    :returns: Generator of ElementPaths for the document's childless nodes.
+    :rtype: generator
+    """
+    tag, attrib, text, children, key = root
+    ignore_set = ignore_set or ()
+    states = [{0} for _ in ignore_steps]
+    ignored = key in ignore_set or any(len(steps) in state for steps, state in zip(ignore_steps, states))
+    watch_states = [None if type(watch) == set else {0} for watch in watches]
+    active = _match_watches(watches, watch_states, key, text, texts)
+
+    if children is None:
+        for i in active:
+            covered[i].add(0)
+        yield make_element_path(None, (tag, attrib, text), path_cache)
+        return
+
+    if not ignore_steps and not ignore_set and not watches:
+        # Nothing to match, so nothing to keep track of but the ancestry.
+        stack = [(iter(children), make_element_path(None, (tag, attrib), path_cache))]
+        while stack:
+            children, parent_path = stack[-1]
+            for tag, attrib, text, grandchildren, _ in children:
+                break
+            else:
+                stack.pop()
+                continue
+            if grandchildren is None:
+                yield make_element_path(parent_path, (tag, attrib, text), path_cache)
+            else:
+                # Don't track the text of a node with children. 99% of the time, it's just
+                # the whitespace between elements, which we don't want to validate.
+                stack.append((iter(grandchildren), make_element_path(parent_path, (tag, attrib), path_cache)))
+        return
+
+    # Each frame is (iterator over the children, ElementPath, ignore states, watch states,
+    # indexes of the watches covering it, ignored). Ignored frames have no ElementPath or ignore states.
+    stack = [(iter(children), None if ignored else make_element_path(None, (tag, attrib), path_cache),
+              states, watch_states, active, ignored)]
+    count = 0
+    while stack:
+        children, parent_path, parent_states, parent_watch_states, active, ignored = stack[-1]
+        for tag, attrib, text, grandchildren, key in children:
+            break
+        else:
+            stack.pop()
+            continue
         # TODO: This implementation ignores cases where an element whose contents
         # we don't care about goes missing entirely, which might not be what we
         # what we want. We might want to make sure the element is at least present.
         # This complicates the ignore process, but is possible. Evaluate how
         # important that might be and implement if necessary.
-        if elem in ignore_set or parent_info is None:
+        if not ignored:
+            ignored = key in ignore_set
+            if ignore_steps:
+                states = [advance_xpath_states(steps, state, tag, attrib) if state else state
+                          for steps, state in zip(ignore_steps, parent_states)]
+                ignored = ignored or any(len(steps) in state for steps, state in zip(ignore_steps, states))
+        watch_states = parent_watch_states
+        if watches:
+            watch_states = [advance_xpath_states(watch, state, tag, attrib) if state else state
+                            for watch, state in zip(watches, parent_watch_states)]
+            active += _match_watches(watches, watch_states, key, text, texts)
+
+        if grandchildren is None:
+            if not ignored:
+                for i in active:
+                    covered[i].add(count)
+                count += 1
+                yield make_element_path(parent_path, (tag, attrib, text), path_cache)
+            continue
+        if ignored and (not watches or None not in texts):
+            continue
+        stack.append((iter(grandchildren),
+                      None if ignored else make_element_path(parent_path, (tag, attrib), path_cache),
+                      None if ignored else states, watch_states, active, ignored))
+
+
+def _match_watches(watches, watch_states, key, text, texts):
+    """Returns the indexes of the watches a node matches, and records the text of their first match."""
+    matched = ()
+    for i, (watch, state) in enumerate(zip(watches, watch_states)):
+        if key in watch if state is None else len(watch) in state:
+            matched += (i,)
+            if texts[i] is None:
+                # Same as findtext(): the first match's text, '' if it has none.
+                texts[i] = text or ''
+    return matched
+
+
+def get_ignored_elements(xml_element, xpaths_to_ignore=None):
+    """
+    Finds the elements matching any of xpaths_to_ignore.
+
+    :param xml_element: The XML object to search.
+    :type xml_element: xml.etree.ElementTree.Element
+    :param xpaths_to_ignore: List of XPath strings to use as args for Element.findall().
+    :type xpaths_to_ignore: None, list
+    :returns: Set of matching Elements.
+    :rtype: set
+    """
+    ignore_set = set()
+    if xpaths_to_ignore:
+        for xpath in xpaths_to_ignore:
+            ignore_set.update(xml_element.findall(xpath))
+    return ignore_set
+
+
+def get_subtree_hashes(xml_element, ignore_set=()):
+    """
+    Computes a Merkle-style structural hash for every element in a tree.
+
+    Hashes are built bottom up from an element's tag, attrib, its text if it
+    is childless, and the hashes of its children. The children's hashes are
+    sorted first, since the unordered diff doesn't care about their order.
+    Ignored elements all hash the same, whatever is inside them, so two
+    subtrees with equal hashes produce exactly the same comparison objects.
+
+    :param xml_element: Root of the tree to hash.
+    :type xml_element: xml.etree.ElementTree.Element
+    :param ignore_set: Elements that are ignored for the diff.
+    :type ignore_set: set
+    :returns: Dict of {element: digest}.
+    :rtype: dict
+    """
+    hashes = {}
+    # Post-order walk. Each element is visited once on the way down,
+    # and hashed on the way back up once all of its children are.
+    stack = [(xml_element, False)]
+    while stack:
+        elem, children_done = stack.pop()
+        if elem in ignore_set:
+            hashes[elem] = b'ignored'
             continue
-        if list(elem):  # See if the elem has children
-            # If so, don't track the element's text. 99% of the time, it's just
-            # the whitespace between elements, which we don't want to validate.
-            elem_info = [(elem.tag, elem.attrib)]
-            elem_info.extend(parent_info)
-            ancestor_map[elem] = elem_info
+        if not children_done and len(elem):
+            stack.append((elem, True))
+            stack.extend((child, False) for child in elem)
+            continue
+        if len(elem):
+            node = (elem.tag, sorted(elem.attrib.items()), sorted(hashes[child] for child in elem))
         else:
-            # If there are no children, track everything
-            elem_info = [(elem.tag, elem.attrib, elem.text)]
-            elem_info.extend(parent_info)
-            compare_list.append(elem_info)
+            node = (elem.tag, sorted(elem.attrib.items()), elem.text)
+        hashes[elem] = hashlib.blake2b(repr(node).encode('utf-8'), digest_size=16).digest()
+    return hashes
 
-    # Reorders things to be more XPath-like, like a person would expect.
-    # We should probably do this at the end, when there isn't much left to reverse.
-    for item in compare_list:
-        item.reverse()
 
-    return compare_list
+def find_identical_subtrees(expected_xml, live_xml, expected_ignored=(), live_ignored=()):
+    """
+    Pairs up subtrees that are identical in both documents.
+
+    Starting from the roots, the children of each pair of matching elements
+    are matched by their get_subtree_hashes hash. Matched children are
+    identical subtrees with identical ancestries, so their leaves would only
+    match each other in the diff anyway, and can be skipped on both sides.
+    Children that don't match, but share a tag and attrib, are paired up and
+    searched the same way.
+
+    :param expected_xml: XML containing the expected data.
+    :type expected_xml: xml.etree.ElementTree.Element
+    :param live_xml: XML containing the live response data.
+    :type live_xml: xml.etree.ElementTree.Element
+    :param expected_ignored: Elements of expected_xml that are ignored.
+    :type expected_ignored: set
+    :param live_ignored: Elements of live_xml that are ignored.
+    :type live_ignored: set
+    :returns: None if the whole documents are identical, otherwise
+        (identical expected Elements, identical live Elements)
+    :rtype: None, tuple
+    """
+    expected_hashes = get_subtree_hashes(expected_xml, expected_ignored)
+    live_hashes = get_subtree_hashes(live_xml, live_ignored)
+    if expected_hashes[expected_xml] == live_hashes[live_xml]:
+        return None
+
+    expected_identical = set()
+    live_identical = set()
+    if (expected_xml.tag != live_xml.tag or expected_xml.attrib != live_xml.attrib
+            or expected_xml in expected_ignored or live_xml in live_ignored):
+        # Every ancestry is different, so nothing can match anyway.
+        return expected_identical, live_identical
+
+    pairs = [(expected_xml, live_xml)]
+    while pairs:
+        expected_elem, live_elem = pairs.pop()
+        live_by_hash = {}
+        for child in live_elem:
+            live_by_hash.setdefault(live_hashes[child], deque()).append(child)
+        unmatched = []
+        for child in expected_elem:
+            candidates = live_by_hash.get(expected_hashes[child])
+            if candidates:
+                expected_identical.add(child)
+                live_identical.add(candidates.popleft())
+            else:
+                unmatched.append(child)
+        if not unmatched:
+            continue
+
+        # Pair up the leftovers with children and the same tag and attrib,
+        # and look for identical subtrees further down.
+        live_by_node = {}
+        for child in live_elem:
+            if len(child) and child not in live_identical and child not in live_ignored:
+                live_by_node.setdefault((child.tag, frozenset(child.attrib.items())), deque()).append(child)
+        for child in unmatched:
+            if not len(child) or child in expected_ignored:
+                continue
+            candidates = live_by_node.get((child.tag, frozenset(child.attrib.items())))
+            if candidates:
+                pairs.append((child, candidates.popleft()))
+    return expected_identical, live_identical
+
+
+def xml_fingerprint(xml_element):
+    """
+    Computes a canonical fingerprint of a whole XML document.
+
+    This is the get_subtree_hashes hash of the root, so attribute order, the
+    whitespace between elements, and tails don't change it, while a leaf's
+    text, whitespace included, does. Two documents with the same fingerprint
+    have the same comparison objects, so an unordered diff_xml of them finds
+    no differences. The reverse doesn't hold: documents that don't line up
+    exactly, such as those using mo money variables, still need a diff.
+
+    :param xml_element: Root of the document.
+    :type xml_element: xml.etree.ElementTree.Element
+    :rtype: bytes
+    """
+    return get_subtree_hashes(xml_element)[xml_element]
+
+
+class FingerprintCache(object):
+    """
+    A bounded, thread safe LRU of fingerprints, keyed by a hash of the raw payload.
+
+    Templates get compared against over and over, so caching their
+    fingerprints means a repeat comparison can be decided without parsing
+    either side. Raw payloads are hashed rather than stored, so a cache full
+    of large documents stays small.
+
+    :param maxsize: How many fingerprints to keep before the least recently used one is dropped.
+    :type maxsize: int
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._fingerprints = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(payload):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        return hashlib.blake2b(payload, digest_size=16).digest()
+
+    def get(self, payload):
+        """
+        Looks up the fingerprint cached for a raw payload.
+
+        :param payload: The raw document.
+        :type payload: str, bytes
+        :returns: The fingerprint, or None if it isn't cached.
+        """
+        key = self._key(payload)
+        with self._lock:
+            fingerprint = self._fingerprints.get(key)
+            if fingerprint is not None:
+                self._fingerprints.move_to_end(key)
+        return fingerprint
+
+    def set(self, payload, fingerprint):
+        """
+        Caches the fingerprint of a raw payload, dropping the least recently used one if full.
+
+        :param payload: The raw document.
+        :type payload: str, bytes
+        :param fingerprint: Its fingerprint, e.g. from xml_fingerprint.
+        :returns: fingerprint
+        """
+        key = self._key(payload)
+        with self._lock:
+            self._fingerprints[key] = fingerprint
+            self._fingerprints.move_to_end(key)
+            while len(self._fingerprints) > self.maxsize:
+                self._fingerprints.popitem(last=False)
+        return fingerprint
+
+    def clear(self):
+        with self._lock:
+            self._fingerprints.clear()
+
+
+def iter_comparison_objects(source, xpaths_to_ignore=None, path_cache=None):
+    """
+    Streams the get_comparison_objects representation of an XML document.
+
+    The document is read with iterparse, and every element is cleared and
+    detached from its parent as soon as its end tag has been processed, so
+    memory use is bounded by the depth of the document rather than its size.
+    The leaves come out in the same order and format as they would from
+    get_comparison_objects.
+
+    Because there is never a whole tree to run Element.findall() against,
+    xpaths_to_ignore is limited to the paths compile_streaming_xpath
+    understands: tag names, '*', '.', '//' and [@attr] or [@attr='value']
+    predicates.
+
+    :param source: File name or binary file object containing XML.
+    :type source: str, file
+    :param xpaths_to_ignore: List of XPath strings which should be used
+        to filter elements in the document.
+    :type xpaths_to_ignore: None, list
+    :param path_cache: Dict used to intern ElementPaths, see make_element_path.
+    :type path_cache: None, dict
+    :returns: Generator of ElementPaths that represent the document's
+        childless elements.
+    :rtype: generator
+    :raises: ValueError if one of xpaths_to_ignore can't be streamed.
+    """
+    matchers = [compile_streaming_xpath(xpath) for xpath in xpaths_to_ignore or []]
+    events = etree.iterparse(source, events=('start', 'end'))
+    _, root = next(events)
+    event, elem = next(events)
+    # Copy the attribs, since clear() empties the dicts we were handed.
+    if event == 'end':
+        node = (root.tag, dict(root.attrib), root.text, None, None)
+    else:
+        node = (root.tag, dict(root.attrib), None, _iter_parsed_nodes(events, root, elem), None)
+    for element_path in walk_comparison_objects(node, matchers, path_cache):
+        yield element_path
+    root.clear()
+
+
+def _iter_parsed_nodes(events, parent, child):
+    """
+    Yields the walk_comparison_objects nodes for parent's children, reading
+    iterparse events up to parent's end tag. child is parent's first child,
+    whose start tag has just been read.
+
+    Whether an element has children is only known once the event after its
+    start tag is read. Each child is cleared and detached as soon as it's
+    done, and whatever the walk skipped of it is read past first.
+    """
+    while True:
+        event, elem = next(events)
+        if event == 'end':
+            yield child.tag, dict(child.attrib), child.text, None, None
+        else:
+            grandchildren = _iter_parsed_nodes(events, child, elem)
+            yield child.tag, dict(child.attrib), None, grandchildren, None
+            for _ in grandchildren:
+                pass
+        child.clear()
+        parent.remove(child)
+        event, child = next(events)
+        if event == 'end':
+            return
+
+
+_STREAMING_XPATH_TOKENS = re.compile(r"//|/|\[[^\]]*\]|\{[^}]*\}[^/\[]*|[^/\[{]+")
+_STREAMING_XPATH_PREDICATE = re.compile(r"""\[@([^=!\]'"]+)(?:=(['"])(.*)\2)?\]$""")
+
+
+def compile_streaming_xpath(xpath):
+    """
+    Compiles an XPath into steps that can be matched while streaming.
+
+    Supports the subset of ElementTree's XPath syntax that only depends on
+    an element's ancestors: tag names (including {namespace}tag), '*', '.',
+    '//' and [@attr] or [@attr='value'] predicates. Paths are relative to the
+    root, just like Element.findall() on the root element.
+
+    :param xpath: XPath string to compile.
+    :type xpath: str
+    :returns: List of (descendant, tag, predicates) steps.
+    :rtype: list
+    :raises: ValueError if the XPath uses anything outside the subset above.
+    """
+    steps = []
+    descendant = False
+    expect_step = True
+    for token in _STREAMING_XPATH_TOKENS.findall(xpath):
+        if token in ('/', '//'):
+            if expect_step:
+                raise ValueError('Unsupported XPath for streaming', xpath)
+            descendant = token == '//'
+            expect_step = True
+        elif token.startswith('['):
+            match = _STREAMING_XPATH_PREDICATE.match(token)
+            if not steps or expect_step or not match:
+                raise ValueError('Unsupported XPath for streaming', xpath)
+            steps[-1][2].append((match.group(1), match.group(3)))
+        elif token == '.':
+            if steps or not expect_step:
+                raise ValueError('Unsupported XPath for streaming', xpath)
+            expect_step = False
+        elif token == '..' or not expect_step or token.startswith('{*}'):
+            raise ValueError('Unsupported XPath for streaming', xpath)
+        else:
+            steps.append((descendant, token, []))
+            descendant = False
+            expect_step = False
+    if expect_step:
+        raise ValueError('Unsupported XPath for streaming', xpath)
+    return steps
+
+
+def advance_xpath_states(steps, parent_states, tag, attrib):
+    """
+    Works out which compiled XPath steps a child element has matched.
+
+    A state n means "the first n steps have matched an ancestor-or-self".
+    States waiting on a '//' step carry over to every descendant.
+    """
+    states = set()
+    for state in parent_states:
+        if state == len(steps):
+            continue
+        descendant, step_tag, predicates = steps[state]
+        if descendant:
+            states.add(state)
+        if step_tag != '*' and step_tag != tag:
+            continue
+        for name, value in predicates:
+            if name not in attrib or (value is not None and attrib[name] != value):
+                break
+        else:
+            states.add(state + 1)
+    return states
+
+
+def leaf_key(leaf):
+    """
+    Builds a hashable, canonical key for a get_comparison_objects leaf.
+
+    ElementPaths are already hashable and are returned as they are. For the
+    older list-of-tuples format, Element.attrib is a dict, which means the
+    (tag, attrib, text) tuples can't be hashed. The attrib dicts are frozen
+    so the whole leaf can be used as a dict key, with two keys comparing
+    equal exactly when the leaves they came from do.
+
+    :param leaf: A leaf representation from get_comparison_objects.
+    :type leaf: ElementPath, list
+    :returns: The ElementPath, or a tuple of (tag, frozen attrib[, text]) tuples.
+    :rtype: ElementPath, tuple
+    """
+    if isinstance(leaf, ElementPath):
+        return leaf
+    return tuple((node[0], frozenset(node[1].items())) + tuple(node[2:]) for node in leaf)
 
 
 def compare_lists_strict(list_a, list_b, validate_strict_order=False):
@@ -137,10 +1023,23 @@ def compare_lists_strict(list_a, list_b, validate_strict_order=False):
     possibility that there may be perfect duplicates of list members, and we
     need to make sure the correct number of each are present.
 
+    The unordered comparison counts the members of list_b by their leaf_key,
+    so each lookup is a dict hit instead of a scan of list_b. The leftovers
+    are the same ones the old remove()-based matching produced: the unmatched
+    members of list_a in order, and list_b minus the first occurrence of each
+    member that was matched.
+
+    With validate_strict_order, the lists are aligned with a linear-space
+    Myers diff (see align_sequences), so the leftovers are only the members
+    that were really deleted from list_a or inserted into list_b, rather than
+    everything after the first mismatch.
+
     :param list_a: First list to compare
     :type list_a: list
     :param list_b: Second list to compare
     :type list_b: list
+    :param validate_strict_order: If True, the order of the members matters.
+    :type validate_strict_order: bool
     :returns: Tuple containing the elements of the respective lists which were
         not found in the opposing list.
     :rtype: tuple
@@ -152,25 +1051,237 @@ def compare_lists_strict(list_a, list_b, validate_strict_order=False):
         return [], []
     else:
         if validate_strict_order is True:
-            for i in range(len(list_a)):
-                if list_a[i] != list_b[i]:
-                    list_a_leftovers = list_a[i:]
-                    list_b = list_b[i:]
-                    break
+            # Swap each leaf for a small int, so the alignment only ever
+            # compares ints. Equal leaves get equal ints.
+            ids = {}
+            a_ids = [ids.setdefault(leaf_key(a_obj), len(ids)) for a_obj in list_a]
+            b_ids = [ids.setdefault(leaf_key(b_obj), len(ids)) for b_obj in list_b]
+            a_only, b_only = align_sequences(a_ids, b_ids)
+            list_a_leftovers = [list_a[i] for i in a_only]
+            list_b = [list_b[i] for i in b_only]
         else:
-        # Can't modify the list we're iterating over, and
-        # this is the fastest way to shallow copy a list
-            list_a_leftovers = list_a[:]
+            # Count how many of each leaf list_b has to give out.
+            b_keys = [leaf_key(b_obj) for b_obj in list_b]
+            available = {}
+            for key in b_keys:
+                available[key] = available.get(key, 0) + 1
+
+            list_a_leftovers = []
+            matched = {}
             for a_obj in list_a:
-                if a_obj in list_b:
-                    # We can't modify the list we iterate over, so we modify the copy.
-                    list_a_leftovers.remove(a_obj)
-                    # But we can modify this one. Makes our final list at the
-                    # same time it shrinks the comparison pool!
-                    list_b.remove(a_obj)
+                key = leaf_key(a_obj)
+                if available.get(key, 0) > 0:
+                    available[key] -= 1
+                    matched[key] = matched.get(key, 0) + 1
+                else:
+                    list_a_leftovers.append(a_obj)
+
+            # The matched members of list_b are the first occurrences of each
+            # key, which is what list.remove() would have taken out.
+            list_b_leftovers = []
+            for key, b_obj in zip(b_keys, list_b):
+                if matched.get(key, 0) > 0:
+                    matched[key] -= 1
+                else:
+                    list_b_leftovers.append(b_obj)
+            list_b = list_b_leftovers
     return list_a_leftovers, list_b
 
 
+# How many steps _middle_snake takes looking for the middle snake before it settles for the furthest point reached.
+ALIGN_TOO_EXPENSIVE = 64
+
+
+def align_sequences(seq_a, seq_b, max_differences=None, too_expensive=ALIGN_TOO_EXPENSIVE):
+    """
+    Finds the shortest edit script between two sequences.
+
+    This is Myers' O(ND) difference algorithm in its linear-space form: each
+    range is trimmed of its common prefix and suffix, then split at the middle
+    snake found by walking forward and reverse paths towards each other, and
+    the two halves are handled the same way. Time grows with the size of the
+    sequences times the number of differences, and memory only with the size.
+
+    Like GNU diff's TOO_EXPENSIVE heuristic, a range whose middle snake
+    hasn't been found after too_expensive steps is split at the furthest
+    point either path got to instead. That keeps the time close to linear
+    in the size when there are lots of differences, e.g. a timestamp in
+    every record, or nothing in common at all, at the cost of an edit script
+    that can be a bit longer than the shortest one in those cases.
+
+    :param seq_a: First sequence. Members must support ==.
+    :type seq_a: list
+    :param seq_b: Second sequence.
+    :type seq_b: list
+    :param max_differences: If given, give up as soon as it's clear there are
+        more deletions and insertions than this. The cost then only grows
+        with max_differences rather than with the real number of differences.
+    :type max_differences: None, int
+    :param too_expensive: Most steps to look for each middle snake. None
+        always finds the shortest edit script, however long it takes.
+    :type too_expensive: None, int
+    :returns: (indexes of seq_a deleted, indexes of seq_b inserted), both
+        sorted, or None if there are more than max_differences of them.
+    :rtype: None, tuple
+    """
+    deleted = []
+    inserted = []
+    # Ranges still to be diffed. The later half is pushed first, so the
+    # deletions and insertions come out in order.
+    ranges = [(0, len(seq_a), 0, len(seq_b))]
+    while ranges:
+        a_lo, a_hi, b_lo, b_hi = ranges.pop()
+        # Trim the common prefix and suffix. For a typical document this is
+        # almost everything.
+        while a_lo < a_hi and b_lo < b_hi and seq_a[a_lo] == seq_b[b_lo]:
+            a_lo += 1
+            b_lo += 1
+        while a_lo < a_hi and b_lo < b_hi and seq_a[a_hi - 1] == seq_b[b_hi - 1]:
+            a_hi -= 1
+            b_hi -= 1
+        limit = None
+        if max_differences is not None:
+            limit = max_differences - len(deleted) - len(inserted)
+            # The difference in length is the least number of edits it could take.
+            if abs((a_hi - a_lo) - (b_hi - b_lo)) > limit:
+                return None
+        if a_lo == a_hi:
+            inserted.extend(range(b_lo, b_hi))
+            continue
+        if b_lo == b_hi:
+            deleted.extend(range(a_lo, a_hi))
+            continue
+        split = _middle_snake(seq_a, a_lo, a_hi, seq_b, b_lo, b_hi, limit, too_expensive)
+        if split is False:
+            return None
+        if split is None:
+            # Nothing in common at all.
+            deleted.extend(range(a_lo, a_hi))
+            inserted.extend(range(b_lo, b_hi))
+            if max_differences is not None and len(deleted) + len(inserted) > max_differences:
+                return None
+            continue
+        x, y = split
+        ranges.append((a_lo + x, a_hi, b_lo + y, b_hi))
+        ranges.append((a_lo, a_lo + x, b_lo, b_lo + y))
+    return deleted, inserted
+
+
+def _middle_snake(seq_a, a_lo, a_hi, seq_b, b_lo, b_hi, limit=None, too_expensive=None):
+    """
+    Finds where the forward and reverse Myers paths meet for one range.
+
+    Returns the (x, y) offsets into the range to split it at, None if the
+    two ranges have nothing in common, or False if it would take more than
+    limit edits. After too_expensive steps without meeting, returns the
+    furthest point either path has got to.
+    """
+    len_a = a_hi - a_lo
+    len_b = b_hi - b_lo
+    max_d = (len_a + len_b + 1) // 2
+    steps = max_d
+    give_up = False
+    if limit is not None and (limit + 1) // 2 + 1 < steps:
+        # Not meeting by step d means more than 2 * d - 1 edits.
+        steps = (limit + 1) // 2 + 1
+        give_up = True
+    if too_expensive is not None and too_expensive < steps:
+        steps = too_expensive
+        give_up = False
+    # Only as many diagonals as the paths can get to in steps.
+    v_offset = steps
+    v_length = 2 * steps + 2
+    # Furthest x reached on each diagonal, forwards and in reverse.
+    v_forward = [-1] * v_length
+    v_forward[v_offset + 1] = 0
+    v_reverse = v_forward[:]
+    delta = len_a - len_b
+    # If the total number of characters is odd, then the front path will collide with the reverse path.
+    front = delta % 2 != 0
+    # Offsets for the start and end of the diagonals still inside the edit graph.
+    k1_start = k1_end = k2_start = k2_end = 0
+    for d in range(steps):
+        # Walk the forward path one step.
+        for k1 in range(-d + k1_start, d + 1 - k1_end, 2):
+            k1_offset = v_offset + k1
+            if k1 == -d or (k1 != d and v_forward[k1_offset - 1] < v_forward[k1_offset + 1]):
+                x1 = v_forward[k1_offset + 1]
+            else:
+                x1 = v_forward[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < len_a and y1 < len_b and seq_a[a_lo + x1] == seq_b[b_lo + y1]:
+                x1 += 1
+                y1 += 1
+            v_forward[k1_offset] = x1
+            if x1 > len_a:
+                # Ran off the right of the graph.
+                k1_end += 2
+            elif y1 > len_b:
+                # Ran off the bottom of the graph.
+                k1_start += 2
+            elif front:
+                k2_offset = v_offset + delta - k1
+                if 0 <= k2_offset < v_length and v_reverse[k2_offset] != -1:
+                    # Mirror the reverse x onto the forward coordinates.
+                    if x1 >= len_a - v_reverse[k2_offset]:
+                        return x1, y1
+
+        # Walk the reverse path one step.
+        for k2 in range(-d + k2_start, d + 1 - k2_end, 2):
+            k2_offset = v_offset + k2
+            if k2 == -d or (k2 != d and v_reverse[k2_offset - 1] < v_reverse[k2_offset + 1]):
+                x2 = v_reverse[k2_offset + 1]
+            else:
+                x2 = v_reverse[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < len_a and y2 < len_b and seq_a[a_hi - x2 - 1] == seq_b[b_hi - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            v_reverse[k2_offset] = x2
+            if x2 > len_a:
+                # Ran off the left of the graph.
+                k2_end += 2
+            elif y2 > len_b:
+                # Ran off the top of the graph.
+                k2_start += 2
+            elif not front:
+                k1_offset = v_offset + delta - k2
+                if 0 <= k1_offset < v_length and v_forward[k1_offset] != -1:
+                    x1 = v_forward[k1_offset]
+                    y1 = v_offset + x1 - k1_offset
+                    if x1 >= len_a - x2:
+                        return x1, y1
+    if steps == max_d:
+        return None
+    if give_up:
+        return False
+    return _furthest_point(v_forward, v_reverse, v_offset, len_a, len_b)
+
+
+def _furthest_point(v_forward, v_reverse, v_offset, len_a, len_b):
+    """
+    The point on either path of _middle_snake that's got the furthest from where it started.
+    Any point splits a range into two that can be aligned on their own, this one just
+    keeps as much of what the paths found as it can.
+    """
+    best, best_x, best_y = 0, 0, 0
+    for k_offset, x in enumerate(v_forward):
+        y = x - (k_offset - v_offset)
+        if 0 <= x <= len_a and 0 <= y <= len_b and x + y > best:
+            best, best_x, best_y = x + y, x, y
+    for k_offset, x in enumerate(v_reverse):
+        y = x - (k_offset - v_offset)
+        if 0 <= x <= len_a and 0 <= y <= len_b and x + y > best:
+            best, best_x, best_y = x + y, len_a - x, len_b - y
+    if best == 0 or best == len_a + len_b:
+        # Splitting at either end wouldn't get anywhere.
+        return None
+    return best_x, best_y
+
+
+_MO_MONEY_VARIABLE = re.compile(r'\$\$\{\s*([\w\_]+)\s*\}')
+
+
 def get_mo_money(expected_xml_extras, live_xml_extras):
     """
     Parses out "mo money" variables and removes "matched" diff remainders.
@@ -178,12 +1289,19 @@ def get_mo_money(expected_xml_extras, live_xml_extras):
     Checks two lists of objects returned from get_comparison_objects for
     "mo money" variables (in the $${variable} format). If an expected XML
     element's text contains a mo money variable, get_mo_money tries to find
-    its corresponding element in the live XML.
+    its corresponding element in the live XML: the first live leftover with
+    the same ancestry, tag and attrib, looked up through an index keyed on
+    exactly that.
 
     If successful, the value from the live element is saved to a dictionary
     with the variable name as its key. The two elements are now considered
     matched, and are thus removed from their respective lists of differences.
 
+    A text node that is nothing but one variable captures the whole live
+    text. Text mixing literals and variables, like "ID-$${id}-$${rev}", is
+    matched positionally: the literal parts have to match the live text,
+    and each variable captures the text between them.
+
     :param expected_xml_extras: The list of remaining element representations
         in the expected XML that were left after comparing to the live XML.
     :type expected_xml_extras: list
@@ -197,41 +1315,117 @@ def get_mo_money(expected_xml_extras, live_xml_extras):
     :rtype: tuple
     """
     mo_money = {}
-    # Can't modify the list we're iterating over, and
-    # this is the fastest way to shallow copy a list
-    leftover_expected_extras = expected_xml_extras[:]
+    leftover_expected_extras = []
+    # Built on first use, most diffs never have a mo money variable in them.
+    live_index = None
+    matched_live = set()
     for expected_extra in expected_xml_extras:
         # Go to the last element (the childless node) and
         # expand the (tag, attribute, text) tuple.
-        expected_tag, expected_attrib, expected_text = expected_extra[-1]
-        if expected_text is None:
-            expected_text = ''  # Element.text returns None, not '', if there's no text.
+        expected_text = expected_extra[-1][2]
+        if expected_text is None or expected_text.find('$${') == -1:
+            # Element.text returns None, not '', if there's no text.
+            # Didn't find the opening bracket. Move along.
+            leftover_expected_extras.append(expected_extra)
+            continue
 
-        if expected_text.find('$${') == -1:
-            continue  # Didn't find the opening bracket. Move along.
+        keys, pattern = _mo_money_matcher(expected_text)
+        if not keys:
+            # False positive during find. There's no closing bracket.
+            leftover_expected_extras.append(expected_extra)
+            continue
 
-        match = re.search('\$\$\{\s*([\w\_]+)\s*\}', expected_text)
-        if not match:
-            continue  # False positive during find. There's no closing bracket.
+        if live_index is None:
+            live_index = {}
+            for i, live_extra in enumerate(live_xml_extras):
+                live_index.setdefault(_ancestry_key(live_extra), []).append(i)
 
-        key = match.group(1)
-        # Compare the ancestry by slicing the childless element off the end.
-        live_matches = [l for l in live_xml_extras if l[:-1] == expected_extra[:-1]]
         found_match = False  # Using a flag instead of a for/else for you old-timey Java folks... :)
-        for live_match in live_matches:
-            live_tag, live_attrib, live_text = live_match[-1]  # Expand just the childless element part.
-            if live_tag == expected_tag and live_attrib == expected_attrib:
-                mo_money[key] = live_text
-                leftover_expected_extras.remove(expected_extra)  # These are now "matches".
-                live_xml_extras.remove(live_match)
-                found_match = True
-                break
+        candidates = live_index.get(_ancestry_key(expected_extra), [])
+        for i in candidates:
+            if i in matched_live:
+                continue
+            live_text = live_xml_extras[i][-1][2]
+            if pattern is None:
+                # The whole text is the variable, so it gets the whole live text.
+                mo_money[keys[0]] = live_text
+            else:
+                match = pattern.fullmatch(live_text or '')
+                if not match:
+                    continue
+                mo_money.update(zip(keys, match.groups()))
+            matched_live.add(i)  # These are now "matches".
+            found_match = True
+            break
         if found_match is False:
-            raise ValueError('Could not find expected $${} match in live response! Missing variable', key)
+            raise ValueError('Could not find expected $${} match in live response! Missing variable', keys[0])
 
+    if matched_live:
+        live_xml_extras = [l for i, l in enumerate(live_xml_extras) if i not in matched_live]
     return mo_money, leftover_expected_extras, live_xml_extras
 
 
+def _has_mo_money(leaf):
+    """True if a leaf's text has a mo money variable in it."""
+    text = leaf[-1][2]
+    return bool(text) and text.find('$${') != -1 and bool(_mo_money_matcher(text)[0])
+
+
+def _ancestry_key(leaf):
+    """Key for everything about a leaf except its text, used to pair up mo money candidates."""
+    key = leaf_key(leaf)
+    if isinstance(key, ElementPath):
+        return key.parent, key.key[:2]
+    return key[:-1] + (key[-1][:2],)
+
+
+_mo_money_matchers = {}
+
+
+def _mo_money_matcher(text):
+    """
+    Compiles the variables in a mo money text node into a matcher.
+
+    Returns (variable names, pattern). The pattern is None when the text is
+    a single variable, optionally surrounded by whitespace, which captures
+    the live text as-is. Otherwise it is a compiled regex with one group per
+    variable and the literal parts escaped; a variable used twice in the
+    same text has to capture the same value both times.
+    """
+    try:
+        return _mo_money_matchers[text]
+    except KeyError:
+        pass
+    matches = list(_MO_MONEY_VARIABLE.finditer(text))
+    keys = [match.group(1) for match in matches]
+    if not keys or (len(matches) == 1 and not text[:matches[0].start()].strip()
+                    and not text[matches[0].end():].strip()):
+        result = keys, None
+    else:
+        pattern_parts = []
+        group_for_key = {}
+        group_keys = []
+        position = 0
+        for match in matches:
+            pattern_parts.append(re.escape(text[position:match.start()]))
+            key = match.group(1)
+            if key in group_for_key:
+                pattern_parts.append('(?:\\%d)' % group_for_key[key])
+            else:
+                group_keys.append(key)
+                group_for_key[key] = len(group_keys)
+                pattern_parts.append('(.*?)')
+            position = match.end()
+        pattern_parts.append(re.escape(text[position:]))
+        result = group_keys, re.compile(''.join(pattern_parts), re.DOTALL)
+    # Templates only have so many distinct variable texts, but don't let a
+    # pathological one grow this forever.
+    if len(_mo_money_matchers) >= 1024:
+        _mo_money_matchers.clear()
+    _mo_money_matchers[text] = result
+    return result
+
+
 def pretty_print_differences(expected_xml_leftovers, live_xml_leftovers, verbose=False, sort_result=True):
     """
     Pretty prints differences output by diff_xml().
@@ -292,6 +1486,185 @@ def pretty_print_differences(expected_xml_leftovers, live_xml_leftovers, verbose
     return result_strings
 
 
+_Tolerance = namedtuple('_Tolerance', ['xpath', 'steps', 'number_range', 'date_range'])
+
+
+class ComparisonPlan(object):
+    """
+    Ignore XPaths and number/date tolerances, compiled once per test case.
+
+    A test case is validated over and over with the same ignore XPaths and
+    testXPathAndRangeForNum ranges. A plan parses them once: the XPaths are
+    compiled with compile_streaming_xpath wherever possible, and the ranges
+    are turned into ints and timedeltas up front. Diffing with a plan (see
+    diff_xml) then finds the ignored elements, and the values the tolerances
+    check, in the same walk that builds the comparison objects.
+
+    XPaths outside of what compile_streaming_xpath supports still work, they
+    just fall back to Element.findall() and findtext() on each document.
+
+    :param xpaths_to_ignore: List of XPath strings of elements not to diff.
+    :type xpaths_to_ignore: None, list
+    :param xpaths_range_for_num_date: List of "XPath,range" strings, in the
+        format get_num_date_ignore_xpaths takes.
+    :type xpaths_range_for_num_date: None, list
+    :raises: ValueError if a range is missing, or is neither a number nor a date range.
+    """
+
+    def __init__(self, xpaths_to_ignore=None, xpaths_range_for_num_date=None):
+        self.ignore_steps = []
+        self.fallback_xpaths = []
+        for xpath in xpaths_to_ignore or []:
+            steps = _compile_or_none(xpath)
+            if steps is None:
+                self.fallback_xpaths.append(xpath)
+            else:
+                self.ignore_steps.append(steps)
+
+        self.tolerances = []
+        for m in xpaths_range_for_num_date or []:
+            xpath, acceptable_range = m.split(',', 1)
+            if not acceptable_range:
+                raise ValueError('Element or value missing from "testXPathAndRangeForNum" element group')
+            tolerance = _Tolerance(xpath, _compile_or_none(xpath), _parse_number_range(acceptable_range),
+                                   _parse_date_range(acceptable_range))
+            # Checked now, since a diff that never looks at the values (e.g. of identical documents) wouldn't.
+            if tolerance.number_range is None and tolerance.date_range is None:
+                raise ValueError('Invalid number or date range for XPath', xpath)
+            self.tolerances.append(tolerance)
+
+    def get_ignored_elements(self, xml_element):
+        """
+        Finds the elements matching the plan's ignore XPaths.
+
+        :param xml_element: The XML object to search.
+        :type xml_element: xml.etree.ElementTree.Element
+        :returns: Set of matching Elements.
+        :rtype: set
+        """
+        ignore_set = get_ignored_elements(xml_element, self.fallback_xpaths)
+        if not self.ignore_steps:
+            return ignore_set
+        stack = [(xml_element, [{0} for _ in self.ignore_steps])]
+        while stack:
+            elem, states = stack.pop()
+            if any(len(steps) in state for steps, state in zip(self.ignore_steps, states)):
+                ignore_set.add(elem)
+                continue
+            for child in elem:
+                stack.append((child, [advance_xpath_states(steps, state, child.tag, child.attrib) if state else state
+                                      for steps, state in zip(self.ignore_steps, states)]))
+        return ignore_set
+
+    def get_comparison_objects(self, expected_xml, live_xml, path_cache=None, expected_skip=None, live_skip=None):
+        """
+        Builds the comparison objects for both documents and applies the tolerances.
+
+        Every tolerance whose live value is in range of its expected value
+        has the elements its XPath matches ignored, in both documents.
+
+        :param expected_xml: XML containing the expected data.
+        :type expected_xml: xml.etree.ElementTree.Element
+        :param live_xml: XML containing the live response data.
+        :type live_xml: xml.etree.ElementTree.Element
+        :param path_cache: Dict used to intern ElementPaths, see make_element_path.
+        :type path_cache: None, dict
+        :param expected_skip: Extra elements of expected_xml to leave out.
+        :type expected_skip: None, set
+        :param live_skip: Extra elements of live_xml to leave out.
+        :type live_skip: None, set
+        :returns: (expected ElementPaths, live ElementPaths)
+        :rtype: tuple
+        :raises: ValueError if a tolerance's value is missing from expected_xml.
+        """
+        expected_objects, expected_texts, expected_covered = self._walk(expected_xml, path_cache, expected_skip)
+        live_objects, live_texts, live_covered = self._walk(live_xml, path_cache, live_skip)
+
+        dropped = [i for i, tolerance in enumerate(self.tolerances)
+                   if self._in_tolerance(tolerance, expected_texts[i], live_texts[i])]
+        if dropped:
+            expected_drop = set().union(*(expected_covered[i] for i in dropped))
+            live_drop = set().union(*(live_covered[i] for i in dropped))
+            expected_objects = [o for i, o in enumerate(expected_objects) if i not in expected_drop]
+            live_objects = [o for i, o in enumerate(live_objects) if i not in live_drop]
+        return expected_objects, live_objects
+
+    def _walk(self, xml_element, path_cache, skip):
+        """
+        Does the work of get_comparison_objects for one document, in one walk.
+
+        Returns (ElementPaths, the findtext() value of each tolerance's XPath,
+        the indexes of the ElementPaths under each tolerance's elements).
+        """
+        ignore_set = get_ignored_elements(xml_element, self.fallback_xpaths)
+        if skip:
+            ignore_set.update(skip)
+        # Tolerance XPaths that can't be streamed are looked up the old way.
+        watches = []
+        texts = []
+        for tolerance in self.tolerances:
+            if tolerance.steps is None:
+                watches.append(set(xml_element.findall(tolerance.xpath)))
+                texts.append(xml_element.findtext(tolerance.xpath))
+            else:
+                watches.append(tolerance.steps)
+                texts.append(None)
+        covered = [set() for _ in self.tolerances]
+        compare_list = list(walk_comparison_objects(element_node(xml_element), self.ignore_steps, path_cache,
+                                                    ignore_set, watches, texts, covered))
+        return compare_list, texts, covered
+
+    @staticmethod
+    def _in_tolerance(tolerance, expected_text, live_text):
+        """Checks a live value against an expected value, like get_num_date_ignore_xpaths does."""
+        if not expected_text:
+            raise ValueError('Element or value missing from "testXPathAndRangeForNum" element group')
+        if expected_text.isdigit():
+            if tolerance.number_range is None:
+                raise ValueError('Invalid number range for XPath', tolerance.xpath)
+            expected_number = int(expected_text)
+            return (expected_number - tolerance.number_range <= int(live_text or '')
+                    <= expected_number + tolerance.number_range)
+
+        if tolerance.date_range is None:
+            raise ValueError('Invalid date range for XPath', tolerance.xpath)
+        if not live_text:
+            return False
+        expected_datetime = parser.parse(expected_text)
+        try:
+            return (expected_datetime - tolerance.date_range <= parser.parse(live_text)
+                    <= expected_datetime + tolerance.date_range)
+        except TypeError:
+            logger.error("Error: type is not same for expected time and real time")
+            return False
+
+
+def _compile_or_none(xpath):
+    """compile_streaming_xpath, but returns None instead of raising for XPaths it can't handle."""
+    try:
+        return compile_streaming_xpath(xpath)
+    except ValueError:
+        return None
+
+
+def _parse_number_range(range_no):
+    """Parses the number out of a testXPathAndRangeForNum range, the same way num_compare does."""
+    numbers = re.findall(r'\d+', range_no)
+    if not numbers:
+        return None
+    return int(numbers[0])
+
+
+def _parse_date_range(range_no):
+    """Parses a testXPathAndRangeForNum date range into a timedelta, the same way date_compare does."""
+    try:
+        range_day, range_1 = range_no.strip()[5:].split('T')
+        hour2, minute2, second2_1 = range_1.split(':')
+        return datetime.timedelta(int(range_day), int(float(second2_1)), 0, 0, int(minute2), int(hour2), 0)
+    except ValueError:
+        return None
+
+
 def get_num_date_ignore_xpaths(xpaths_range_for_num_date, test_xml, live_xml, xpaths_ignore_num_date):
     """Finds test case level xpaths that are date/number ranges, grabs the range and uses the number to validate
     whether the expected response is in acceptable range of the live response. if so, adds that xpath to xpaths
@@ -331,7 +1704,7 @@ def get_num_date_ignore_xpaths(xpaths_range_for_num_date, test_xml, live_xml, xp
 
 
 def num_compare(range_no, num_date, live_response_xml, xpath):
-    range_1 = re.findall('\d+', range_no)[0]
+    range_1 = re.findall(r'\d+', range_no)[0]
     big = int(num_date) + int(range_1)
     small = int(num_date) - int(range_1)
     num_live = live_response_xml.findtext(xpath)
@@ -1,13 +1,18 @@
 import os, sys
-import sqlite3
+import time
 import json
-from flask import Flask, request, session, g, redirect, render_template, flash
+import click
+from flask import Flask, Response, abort, jsonify, request, session, redirect, render_template, flash, \
+    stream_with_context
 from werkzeug import secure_filename
 from collections import ChainMap
-from jinja2 import FunctionLoader, TemplateSyntaxError, UndefinedError
+from jinja2 import TemplateNotFound, TemplateSyntaxError, UndefinedError
 import xml.etree.ElementTree as etree
+from collections import deque
+from itertools import chain
 
 import brokendown_jinja as jinj
+import database
 import gibson
 import jsondiff
 
@@ -19,39 +24,47 @@ app.config.update(dict(
     DATABASE=os.path.join(app.root_path, 'render.db'),
     SECRET_KEY='dev key',
     USERNAME='admin',
-    PASSWORD='default'
+    PASSWORD='default',
+    BYTECODE_CACHE_MAX_SIZE=64 * 1024 * 1024,
+    BYTECODE_CACHE_MAX_AGE=7 * 24 * 60 * 60,
+    DATABASE_CACHE_SIZE=16384,
+    DATABASE_CACHED_STATEMENTS=256,
+    TEMPLATES_PER_PAGE=100,
+    TEMPLATE_CODEC='zlib',
+    TEMPLATE_COMPRESSION_LEVEL=6,
+    TEMPLATE_SNAPSHOT_EVERY=10
 ))
 app.config.from_envvar('FLASKR_SETTINGS', silent=True)
 
+# One environment for the whole process, so compiled templates outlive the request that compiled them.
+# Its bytecode is kept in the database, so other workers and restarts don't compile it again.
+jinja_env = jinj.make_environment(jinj.DatabaseLoader(app.config['DATABASE']),
+                                  jinj.SqliteBytecodeCache(app.config['DATABASE'],
+                                                           app.config['BYTECODE_CACHE_MAX_SIZE'],
+                                                           app.config['BYTECODE_CACHE_MAX_AGE']))
 
-def connect_db():
-    """Connects to the specific database."""
-    rv = sqlite3.connect(app.config['DATABASE'])
-    rv.row_factory = sqlite3.Row
-    return rv
+
+# One connection per thread, kept open for the life of the process, instead of one per request.
+connections = database.ConnectionManager(app.config['DATABASE'],
+                                         app.config['DATABASE_CACHE_SIZE'],
+                                         app.config['DATABASE_CACHED_STATEMENTS'])
 
 
 def get_db():
-    """Opens a new database connection if there is none yet for the
-    current application context.
-    """
-    if not hasattr(g, 'sqlite_db'):
-        g.sqlite_db = connect_db()
-    return g.sqlite_db
+    """Returns this thread's database connection."""
+    return connections.connection()
 
 
 @app.teardown_appcontext
 def close_db(error):
-    """Closes the database again at the end of the request."""
-    if hasattr(g, 'sqlite_db'):
-        g.sqlite_db.close()
+    """Rolls back anything left uncommitted at the end of the request.
+    The connection stays open for the thread's next request."""
+    connections.release()
 
 
 def init_db():
-    db = get_db()
     with app.open_resource('schema.sql', mode='r') as f:
-        db.cursor().executescript(f.read())
-    db.commit()
+        database.init_db(get_db(), f.read())
 
 @app.cli.command('initdb')
 def initdb_command():
@@ -59,6 +72,67 @@ def initdb_command():
     init_db()
     print('Initialized the database.')
 
+
+def run_migrations():
+    """Brings the database up to the current schema. Needs an app context.
+    A database without any tables yet is left for initdb to create.
+
+    Nothing runs it on import. Run flask migratedb before starting the app
+    under a WSGI server; running this file directly does it on startup.
+    """
+    db = get_db()
+    if not database.has_schema(db):
+        return 0, 0
+    return database.migrate(db)
+
+
+@app.cli.command('migratedb')
+def migratedb_command():
+    """Runs any migrations the database hasn't had yet."""
+    old_version, new_version = run_migrations()
+    print('Migrated the database from version {0} to {1}.'.format(old_version, new_version))
+
+
+@app.cli.command('batch-diff')
+@click.argument('jobs', type=click.File('r'))
+@click.option('--output', type=click.File('w'), default='-', help='Where to write the results. Defaults to stdout.')
+@click.option('--choice', type=click.Choice(['JSON', 'XML']), default='XML', help='Content type of the documents.')
+@click.option('--strict-order', is_flag=True, help='Validate the order of the elements too.')
+@click.option('--processes', type=int, default=None, help='Number of worker processes. Defaults to the CPU count.')
+@click.option('--chunksize', type=int, default=16, help='Number of jobs sent to a worker at once.')
+def batch_diff_command(jobs, output, choice, strict_order, processes, chunksize):
+    """Diffs a JSON-lines file of {"expected", "live", "ignore"} jobs.
+
+    Writes one JSON line per job, in completion order, with the job's index,
+    which is its line number in the file, counting from 1, its mo money
+    variables, its differences and any error. Blank lines are skipped, and
+    a line that isn't a job gets a result with just the error.
+    """
+    bad_lines = []
+
+    def read_jobs():
+        for line_no, line in enumerate(jobs, 1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                yield line_no, job['expected'], job['live'], job.get('ignore')
+            except (ValueError, KeyError, TypeError) as exc:
+                bad_lines.append(gibson.BatchDiffResult(line_no, {}, [], 'Bad job: {0}: {1}'.format(
+                    type(exc).__name__, exc)))
+
+    def write(result):
+        output.write(json.dumps(result._asdict()))
+        output.write('\n')
+
+    parse = jsondiff.json_to_xml if choice == 'JSON' else etree.fromstring
+    for result in gibson.diff_xml_batch(read_jobs(), strict_order, processes, chunksize, parse, indexed=True):
+        while bad_lines:
+            write(bad_lines.pop(0))
+        write(result)
+    for result in bad_lines:
+        write(result)
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -67,35 +141,102 @@ def index():
 @app.route('/list-templates', methods=['GET'])
 def show_entries():
     db = get_db()
-    cur = db.execute('select filename, contents from templates order by id desc')
-    entries = cur.fetchall()
-    render_dict = {"templates": entries}
-    db.close()
+    render_dict = list_templates_page(db, request.args.get('before', type=int))
     return render_template('list_templates.html', entries=render_dict)
 
 
 @app.route('/list-templates/<template_name>', methods=['GET', 'POST'])
 def show_template(template_name):
     db = get_db()
-    cur = db.execute('select filename, contents from templates order by id desc')
-    entries = cur.fetchall()
-    render_dict = {"templates": entries}
+    render_dict = list_templates_page(db, request.args.get('before', type=int))
     if request.method == 'GET':
-        cur = db.execute("select filename, contents from templates where filename = '{0}'".format(template_name))
-        file_contents = cur.fetchone()['contents']
-        render_dict["template_contents"] = file_contents
+        cur = db.execute('select content_hash from templates where filename = ?', (template_name,))
+        row = cur.fetchone()
+        if row is None:
+            abort(404)
+        render_dict["template_contents"] = database.load_template_body(db, row['content_hash'])
     elif request.method == 'POST':
-        updated_template = request.form.get('output')
+        # A missing field is a 400, rather than None blowing up further down.
+        updated_template = request.form['output']
         print(type(updated_template))
-        db.execute("""update templates set contents = ? where filename = ?""",
-            (updated_template, template_name))
+        row = db.execute('select id, version, content_hash from templates where filename = ?',
+                         (template_name,)).fetchone()
+        if row is None:
+            abort(404)
+        previous_template = database.load_template_body(db, row['content_hash'])
+        content_hash = store_body(db, updated_template)
+        db.execute("""update templates set content_hash = ?, size = ?, version = version + 1, updated_at = ?,
+            variables = ?, referenced_templates = ? where filename = ?""",
+            (content_hash, len(updated_template.encode('utf-8')), time.time())
+            + analyze_for_db(updated_template) + (template_name,))
+        database.record_revision(db, row['id'], row['version'] + 1, updated_template, previous_template,
+                                 app.config['TEMPLATE_SNAPSHOT_EVERY'], app.config['TEMPLATE_COMPRESSION_LEVEL'])
+        database.drop_unused_body(db, row['content_hash'])
         db.commit()
         flash('Template successfully updated.')
         render_dict['template_contents'] = updated_template
-    db.close()
     return render_template('list_templates.html', entries=render_dict)
 
 
+@app.route('/list-templates/<template_name>/revisions', methods=['GET'])
+def show_revisions(template_name):
+    """Lists a template's revisions, newest first, as JSON."""
+    db = get_db()
+    template_id = get_template_id(db, template_name)
+    revisions = [dict(revision) for revision in database.list_revisions(db, template_id)]
+    return jsonify(filename=template_name, revisions=revisions)
+
+
+@app.route('/list-templates/<template_name>/revisions/<int:revision>', methods=['GET'])
+def show_revision(template_name, revision):
+    """Returns a template's body as of revision."""
+    db = get_db()
+    contents = database.get_revision(db, get_template_id(db, template_name), revision)
+    if contents is None:
+        abort(404)
+    return Response(contents, mimetype='text/plain')
+
+
+@app.route('/list-templates/<template_name>/diff/<int:from_revision>/<int:to_revision>', methods=['GET'])
+def diff_revisions(template_name, from_revision, to_revision):
+    """Returns a unified diff between two revisions of a template."""
+    db = get_db()
+    diff = database.diff_revisions(db, get_template_id(db, template_name), from_revision, to_revision,
+                                   template_name)
+    if diff is None:
+        abort(404)
+    return Response(''.join(diff), mimetype='text/plain')
+
+
+def get_template_id(db, template_name):
+    """Returns the id of the template called template_name, aborting with a 404 if there isn't one."""
+    row = db.execute('select id from templates where filename = ?', (template_name,)).fetchone()
+    if row is None:
+        abort(404)
+    return row['id']
+
+
+def list_templates_page(db, before=None):
+    """Returns a page of the template list, newest first, for list_templates.html.
+
+    Only the metadata is read, and the page is found by seeking the id index
+    to before rather than with an offset, so every page costs the same
+    however many templates there are. The page's next_before is the before
+    for the page after it, or None if it's the last one.
+    """
+    page_size = app.config['TEMPLATES_PER_PAGE']
+    if before is None:
+        cur = db.execute('select id, filename, size, updated_at from templates order by id desc limit ?',
+                         (page_size + 1,))
+    else:
+        cur = db.execute('select id, filename, size, updated_at from templates where id < ? order by id desc limit ?',
+                         (before, page_size + 1))
+    entries = cur.fetchall()
+    # The extra row is only there to find out whether there's another page.
+    next_before = entries[page_size - 1]['id'] if len(entries) > page_size else None
+    return {"templates": entries[:page_size], "next_before": next_before}
+
+
 @app.route('/upload', methods=['GET', 'POST'])
 def add_entry():
     error = None
@@ -109,10 +250,13 @@ def add_entry():
             db = get_db()
             if not is_in_db(filename, db):
                 a = file.stream.read().decode()
-                db.execute('insert into templates (filename, contents) values (?, ?)',
-                           [secure_filename(filename), a])
+                cur = db.execute('insert into templates '
+                                 '(filename, content_hash, size, updated_at, variables, referenced_templates) '
+                                 'values (?, ?, ?, ?, ?, ?)',
+                                 [secure_filename(filename), store_body(db, a), len(a.encode('utf-8')),
+                                  time.time()] + list(analyze_for_db(a)))
+                database.record_revision(db, cur.lastrowid, 1, a, level=app.config['TEMPLATE_COMPRESSION_LEVEL'])
                 db.commit()
-                db.close()
                 print(type(a))
                 print(a)
                 flash('New template {0} was successfully added'.format(filename))
@@ -127,12 +271,6 @@ def add_entry():
 def render_a_template():
     print(request)
     if request.method == 'POST':
-        env = jinj.Environment(loader=FunctionLoader(jinj.db_loader),
-                               undefined=jinj.KeepUndefined,
-                               block_start_string='{~',
-                               block_end_string='~}',
-                               comment_start_string='{!',
-                               comment_end_string='!}')
         form = {
         "string_to_render": request.form.get('string_to_render'),
         "test_map": request.form.get('map'),
@@ -147,17 +285,18 @@ def render_a_template():
             else:
                 jinja_map = {}
                 pretty_dumped = ''
-        except ValueError:
+        except ValueError as exc:
             flash('Map to render had a JSON exception! See below')
             pretty_dumped = 'Invalid JSON! \n %s' \
-                            % jinj.return_line_no_of_json_value_exc(request.form.get('map'))
+                            % jinj.return_line_no_of_json_value_exc(request.form.get('map'), exc)
             form['test_map'] = pretty_dumped
         else:
             print('FORM',[(k, v) for k,v in request.form.items()])
             if 'render' in request.form:
                 print("RENDERRRRR")
                 try:
-                    generated = jinj.render_string_with_jinja(request.form.get('string_to_render'), env, jinja_map)
+                    generated = jinj.render_string_with_jinja(request.form.get('string_to_render'), jinja_env,
+                                                              jinja_map)
 
                 except Exception as e:
                     # return string based on what type of exception it is.
@@ -171,7 +310,7 @@ def render_a_template():
                         flash('Incorrect {0} rendered!!'.format(request.form.get('choices')))
 
                         if isinstance(exc, ValueError):
-                            validated_generated = jinj.return_line_no_of_json_value_exc(generated)
+                            validated_generated = jinj.return_line_no_of_json_value_exc(generated, exc)
                         elif isinstance(exc, etree.ParseError):
                             line_no, _ = exc.position
                             validated_generated = jinj.return_exc_printed_nice(generated, line_no)
@@ -182,64 +321,138 @@ def render_a_template():
                     form['test_map'] = pretty_dumped
                     form['output'] = validated_generated
             elif 'check' in request.form:
-                compare_string = request.form.get('compare')
-                output_string = request.form.get('output')
-                choice = request.form.get('choices')
-                if not compare_string or not output_string or choice == 'other':
-                    flash('Need both an ouput and a string to compare to, as well as JSON or XML content-type!')
-                else:
-                    try:
-                        if choice == 'JSON':
-                            compare_xml = jsondiff.json_to_xml(compare_string)
-                            output_xml = jsondiff.json_to_xml(output_string)
-                        elif choice == 'XML':
-                            compare_xml = etree.fromstring(compare_string)
-                            output_xml = etree.fromstring(output_string)
-                    except (ValueError, etree.ParseError) as e:
-                        flash('Exception in loading strings in {0} format! Exception: {1}'.format(choice, e.args))
-                    else:
-                        _, compare_xml_objects, output_xml_objects = gibson.diff_xml(compare_xml, output_xml, False)
-                        if not compare_xml_objects and not output_xml_objects:
-                            flash('They match! Good job!')
-                        else:
-                            flash('There are differences! Check Below')
-                            diffs = gibson.pretty_print_differences(compare_xml_objects, output_xml_objects)
-                            form['failures'] = [diff for diff in diffs]
+                failures = compare_strings(request.form.get('compare'), request.form.get('output'),
+                                           request.form.get('choices'))
+                if failures:
+                    form['failures'] = failures
 
     else:
         return render_template('name.html')
     return render_template('name.html', entries=form)
 
-@app.route('/compare')
-def compare()
-    compare_string = request.form.get('compare')
-    output_string = request.form.get('output')
+@app.route('/render/stream', methods=['POST'])
+def render_a_template_streaming():
+    """Renders string_to_render with the map, streaming the output back as it's generated
+    instead of building it up in a page. With choices set to JSON or XML, the
+    output is validated on the fly, and an error marker is appended if it's invalid.
+    JSON comes out normalized and pretty printed, the same as from /render.
+    It's sent as text/plain either way, because of the error marker.
+    """
     choice = request.form.get('choices')
+    try:
+        jinja_map = json.loads(request.form.get('map') or '{}')
+    except ValueError as exc:
+        return Response('Map to render had a JSON exception!\n%s'
+                        % jinj.return_line_no_of_json_value_exc(request.form.get('map'), exc),
+                        status=400, mimetype='text/plain')
+    try:
+        chunks = jinj.generate_string_with_jinja(request.form.get('string_to_render') or '', jinja_env, jinja_map)
+    except Exception as e:
+        return Response(return_template_exc(e), status=400, mimetype='text/plain')
+    # Not application/json or xml, since an error marker can end up on the end of it.
+    return Response(stream_with_context(validate_stream(choice, chunks)), mimetype='text/plain')
+
+
+@app.route('/render/batch', methods=['POST'])
+def render_batch():
+    """Renders one template against a JSON-lines file of maps, one map per line.
+
+    The template is the stored one named by the template field, or else
+    string_to_render. The maps are the uploaded maps file, or the maps field.
+    Streams back one JSON line per map, in completion order, with the map's
+    index, its output and any error.
+    """
+    template_name = request.form.get('template') or None
+    string_value = request.form.get('string_to_render')
+    if template_name is None and not string_value:
+        return Response('Need a template name or a string to render!', status=400, mimetype='text/plain')
+    maps_file = request.files.get('maps')
+    if maps_file is not None:
+        lines = (line.decode('utf-8') for line in maps_file.stream)
+    else:
+        lines = iter((request.form.get('maps') or '').splitlines())
+    maps = (line for line in lines if line.strip())
+    try:
+        results = jinj.render_batch(maps, string_value, template_name, request.form.get('choices'),
+                                    app.config['DATABASE'])
+        # Start it here, so a template that won't compile is reported before the response starts.
+        first = next(results, None)
+    except Exception as e:
+        return Response(return_template_exc(e), status=400, mimetype='text/plain')
+
+    def generate():
+        if first is None:
+            return
+        yield json.dumps(first._asdict()) + '\n'
+        for result in results:
+            yield json.dumps(result._asdict()) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/compare', methods=['POST'])
+def compare():
+    form = {
+        "output": request.form.get('output'),
+        "compare": request.form.get('compare')
+    }
+    failures = compare_strings(form['compare'], form['output'], request.form.get('choices'))
+    if failures:
+        form['failures'] = failures
+    return render_template('name.html', entries=form)
+
+
+# Fingerprints of the strings compare_strings has seen, keyed by a hash of the raw string.
+# Most comparisons are of identical pairs, and these let a repeat be called a match unparsed.
+_fingerprints = {'JSON': gibson.FingerprintCache(), 'XML': gibson.FingerprintCache()}
+
+
+def compare_strings(compare_string, output_string, choice):
+    """Diffs the expected and rendered strings, flashing the outcome.
+
+    JSON is diffed natively by jsondiff.diff_json, XML by gibson.diff_xml.
+    Strings whose canonical fingerprints match are called a match without
+    diffing, and the fingerprints are cached, so a pair that's been seen
+    before doesn't even get parsed.
+    Returns the pretty printed differences, if there are any.
+    """
     if not compare_string or not output_string or choice == 'other':
         flash('Need both an ouput and a string to compare to, as well as JSON or XML content-type!')
+        return None
+    fingerprints = _fingerprints[choice]
+    compare_fingerprint = fingerprints.get(compare_string)
+    if compare_fingerprint is not None and compare_fingerprint == fingerprints.get(output_string):
+        flash('They match! Good job!')
+        return None
+    try:
+        if choice == 'JSON':
+            compare_obj = json.loads(compare_string)
+            output_obj = json.loads(output_string)
+        elif choice == 'XML':
+            compare_obj = etree.fromstring(compare_string)
+            output_obj = etree.fromstring(output_string)
+    except (ValueError, etree.ParseError) as e:
+        flash('Exception in loading strings in {0} format! Exception: {1}'.format(choice, e.args))
+        return None
+    fingerprint = jsondiff.json_fingerprint if choice == 'JSON' else gibson.xml_fingerprint
+    if compare_fingerprint is None:
+        compare_fingerprint = fingerprints.set(compare_string, fingerprint(compare_obj))
+    if compare_fingerprint == fingerprints.set(output_string, fingerprint(output_obj)):
+        flash('They match! Good job!')
+        return None
+    if choice == 'JSON':
+        _, compare_xml_objects, output_xml_objects = jsondiff.diff_json(compare_obj, output_obj)
     else:
-        try:
-            if choice == 'JSON':
-                compare_xml = jsondiff.json_to_xml(compare_string)
-                output_xml = jsondiff.json_to_xml(output_string)
-            elif choice == 'XML':
-                compare_xml = etree.fromstring(compare_string)
-                output_xml = etree.fromstring(output_string)
-        except (ValueError, etree.ParseError) as e:
-            flash('Exception in loading strings in {0} format! Exception: {1}'.format(choice, e.args))
-        else:
-            _, compare_xml_objects, output_xml_objects = gibson.diff_xml(compare_xml, output_xml, False)
-            if not compare_xml_objects and not output_xml_objects:
-                flash('They match! Good job!')
-            else:
-                flash('There are differences! Check Below')
-                diffs = gibson.pretty_print_differences(compare_xml_objects, output_xml_objects)
-                form['failures'] = [diff for diff in diffs]
+        _, compare_xml_objects, output_xml_objects = gibson.diff_xml(compare_obj, output_obj, False)
+    if not compare_xml_objects and not output_xml_objects:
+        flash('They match! Good job!')
+        return None
+    flash('There are differences! Check Below')
+    return gibson.pretty_print_differences(compare_xml_objects, output_xml_objects)
 
 
 def validate(string_type, string_value):
     if string_type == 'JSON':
-        json_safe = jinj.python_to_json(string_value)
         safe_value = jinj.check_then_dump_json([string_value])[0]
     elif string_type == 'XML':
         safe_value = jinj.pretty_print_xml_tostring(string_value).decode()
@@ -249,21 +462,82 @@ def validate(string_type, string_value):
     return safe_value
 
 
+# How much rendered output to gather up before sending it, since jinja generates lots of tiny pieces.
+STREAM_BUFFER_SIZE = 8192
+
+
+def validate_stream(string_type, chunks):
+    """Passes the rendered chunks through, checking that they make up valid JSON
+    or XML along the way, and appends an error marker if they don't.
+
+    JSON is normalized from Python reprs and pretty printed as it goes, the
+    way validate does it for /render. Only the parser's state is held on to,
+    never the whole document. Errors while rendering get the same marker.
+    """
+    pending = deque()
+    buffered = 0
+    try:
+        if string_type == 'JSON':
+            chunks = iter(chunks)
+            first = next((chunk for chunk in chunks if chunk), None)
+            # validate lets empty output through, so this does too.
+            chunks = jinj.iter_python_to_json(chain((first,), chunks), indent=4) if first is not None else ()
+            parser = None
+        else:
+            parser = etree.XMLPullParser(['end']) if string_type == 'XML' else None
+        for chunk in chunks:
+            # Kept before it's parsed, so the chunk that breaks the document still goes out ahead of the marker.
+            pending.append(chunk)
+            buffered += len(chunk)
+            if parser is not None:
+                parser.feed(chunk)
+                # Drop each element's contents once it's parsed, the parser only needs to know it was fine.
+                for _, elem in parser.read_events():
+                    elem.clear()
+            if buffered >= STREAM_BUFFER_SIZE:
+                yield ''.join(pending)
+                pending.clear()
+                buffered = 0
+        if parser is not None:
+            parser.close()
+        yield ''.join(pending)
+    except (ValueError, etree.ParseError) as exc:
+        yield ''.join(pending)
+        yield '\n>>>>>> Incorrect {0} rendered! {1}\n'.format(string_type, exc)
+    except Exception as exc:
+        yield ''.join(pending)
+        yield '\n>>>>>> {0}\n'.format(return_template_exc(exc))
+
+
+def store_body(db, contents):
+    """Stores a template body, compressed the way the config says, and returns its hash."""
+    return database.store_template_body(db, contents, app.config['TEMPLATE_CODEC'],
+                                        app.config['TEMPLATE_COMPRESSION_LEVEL'])
+
+
+def analyze_for_db(contents):
+    """Returns the (variables, referenced_templates) columns for a template's contents.
+    Both are None if it won't parse, so it gets analyzed again once it's fixed.
+    """
+    try:
+        analysis = jinj.analyze_template(jinja_env, contents)
+    except TemplateSyntaxError:
+        return None, None
+    return json.dumps(analysis.variables), json.dumps(analysis.references)
+
+
 def is_in_db(filename, db):
-    cur = db.execute("select filename from templates where filename='{0}'".format(filename))
-    results = cur.fetchall()
-    if len(results) == 0:
-        return False
-    return True
+    cur = db.execute('select 1 from templates where filename = ?', (filename,))
+    return cur.fetchone() is not None
 
 
 def return_template_exc(exception):
-    if isinstance(exception, TypeError):
+    if isinstance(exception, TemplateNotFound):
         return 'Your template could not be found in the database!'
-    elif isinstance(e, TemplateSyntaxError) or isinstance(e, UndefinedError):
-        return 'Jinja is not happy! There was an error in your template! \nDescription: %s' % e.args
+    elif isinstance(exception, TemplateSyntaxError) or isinstance(exception, UndefinedError):
+        return 'Jinja is not happy! There was an error in your template! \nDescription: %s' % exception.args
     else:
-        return 'Unexpected error! {0}'.format(e.args)
+        return 'Unexpected error! {0}'.format(exception.args)
 
 
 # Notes
@@ -272,4 +546,6 @@ def return_template_exc(exception):
 # http://www.jakowicz.com/flask-apache-wsgi/
 
 if __name__ == "__main__":
+    with app.app_context():
+        run_migrations()
     app.run()
\ No newline at end of file
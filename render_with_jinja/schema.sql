@@ -1,6 +1,47 @@
+-- The current schema, so a fresh database needs no migrations. Keep it, and the
+-- user_version, in step with database.MIGRATIONS.
+pragma user_version = 5;
+drop table if exists template_revisions;
 drop table if exists templates;
+drop table if exists template_blobs;
+create table template_blobs (
+    hash text primary key,
+    codec text not null,
+    size integer not null,
+    data blob not null
+);
+
 create table templates (
     id integer primary key autoincrement,
     filename text not null,
-    'contents' text not null
+    content_hash text not null references template_blobs (hash),
+    size integer not null default 0,
+    version integer not null default 1,
+    updated_at real not null default 0,
+    variables text,
+    referenced_templates text
+);
+create unique index templates_filename on templates (filename);
+create index templates_content_hash on templates (content_hash);
+
+create table template_revisions (
+    template_id integer not null references templates (id),
+    revision integer not null,
+    kind text not null,
+    data blob not null,
+    size integer not null,
+    created_at real not null,
+    primary key (template_id, revision)
+);
+
+drop table if exists bytecode_cache;
+create table bytecode_cache (
+    key text not null,
+    checksum text not null,
+    jinja_version text not null,
+    bytecode blob not null,
+    size integer not null,
+    created real not null,
+    last_used real not null,
+    primary key (key, checksum, jinja_version)
 );
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules import each other as top-level modules, the way the app runs, so they're imported the same way here.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'render_with_jinja'))
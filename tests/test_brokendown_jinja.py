@@ -0,0 +1,311 @@
+import json
+import os
+import random
+import sqlite3
+import time
+from collections import OrderedDict
+
+import pytest
+import jinja2
+from jinja2 import DictLoader, Environment
+
+import brokendown_jinja as jinj
+import database
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'render_with_jinja', 'schema.sql')
+
+
+def random_value(rng, depth=0):
+    choice = rng.random()
+    if depth < 3 and choice < 0.3:
+        return {rng.choice(['a', 'b c', "it's", 'say "hi"', 'café\n']): random_value(rng, depth + 1)
+                for _ in range(rng.randint(0, 4))}
+    if depth < 3 and choice < 0.5:
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+    return rng.choice([True, False, None, 0, -3, 12345678901234567890, 1.5, -2.25e-10, 1e100, '',
+                       'True, or not', 'None', "'quoted'", '"double"', 'back\\slash', 'tab\t', '☃ \U0001f600'])
+
+
+def random_chunks(rng, string):
+    cuts = sorted(rng.sample(range(len(string) + 1), min(len(string) + 1, rng.randint(0, 10))))
+    return [string[start:end] for start, end in zip([0] + cuts, cuts + [len(string)])]
+
+
+@pytest.mark.parametrize('indent', [None, 4])
+def test_python_to_json_matches_json_dumps(indent):
+    rng = random.Random(indent)
+    for _ in range(500):
+        value = random_value(rng)
+        # Python reprs, and JSON itself, in compact and pretty layouts.
+        for string in (repr(value), json.dumps(value), json.dumps(value, indent=2, ensure_ascii=False)):
+            assert jinj.python_to_json(string, indent) == json.dumps(value, indent=indent)
+            assert ''.join(jinj.iter_python_to_json(random_chunks(rng, string), indent)) == json.dumps(
+                value, indent=indent)
+
+
+def test_python_to_json_leaves_strings_alone():
+    assert jinj.python_to_json("{'a': 'True, None or False'}") == '{"a": "True, None or False"}'
+    assert jinj.python_to_json('["it\'s", \'say "hi"\']') == '["it\'s", "say \\"hi\\""]'
+
+
+@pytest.mark.parametrize('string', [
+    '',
+    '{',
+    "{'a': 1,}",
+    '[1 2]',
+    "{'a' 1}",
+    '{1: 2}',
+    '[1] [2]',
+    "'unterminated",
+    'undefined',
+    '[1, 2]\n]',
+    '{\n    "a": [\n        1,\n        2\n    ]\n    "b": 3\n}',
+])
+def test_python_to_json_errors(string):
+    with pytest.raises(json.JSONDecodeError) as whole:
+        jinj.python_to_json(string)
+    # In chunks, the error has to come out at the same place in the whole string.
+    for chunk_size in (1, 2, 5):
+        chunks = [string[i:i + chunk_size] for i in range(0, len(string), chunk_size)]
+        with pytest.raises(json.JSONDecodeError) as chunked:
+            ''.join(jinj.iter_python_to_json(chunks))
+        assert (chunked.value.msg, chunked.value.pos, chunked.value.lineno, chunked.value.colno) == (
+            whole.value.msg, whole.value.pos, whole.value.lineno, whole.value.colno)
+
+
+def test_iter_python_to_json_yields_as_it_reads():
+    chunks = iter(['[1, ', 'True, ', "'x'", ']'])
+    output = jinj.iter_python_to_json(chunks)
+    assert next(output) == '[1, '
+    assert next(output) == 'true, '
+
+
+def test_render_batch():
+    maps = ['{"name": "a"}', '{"name": "b", "extra": [1, 2]}', 'not json', '', '{"name": "c"}']
+    results = sorted(jinj.render_batch(maps, '<root><name>{{ name }}</name></root>', string_type='XML',
+                                       processes=2, chunksize=2))
+    assert [result.index for result in results] == [0, 1, 2, 3, 4]
+    assert results[0] == (0, '<root>\n    <name>a</name>\n</root>', None)
+    assert results[1].output == '<root>\n    <name>b</name>\n</root>' and results[1].error is None
+    assert results[2].output is None and results[2].error.startswith('JSONDecodeError')
+    # No map at all renders with nothing, and KeepUndefined leaves the variable as it was.
+    assert results[3].output == '<root>\n    <name>{{ name }}</name>\n</root>' and results[3].error is None
+    assert results[4].output == '<root>\n    <name>c</name>\n</root>'
+
+
+def test_render_batch_invalid_output():
+    maps = ['{"value": "True"}', '{"value": "1, 2"}']
+    results = sorted(jinj.render_batch(maps, "{'value': {{ value }}}", string_type='JSON', processes=1))
+    assert results[0] == (0, '{\n    "value": true\n}', None)
+    assert results[1].output == "{'value': 1, 2}" and results[1].error.startswith('JSONDecodeError')
+    results = list(jinj.render_batch(['{}'], '<root><unclosed></root>', string_type='XML', processes=1))
+    assert results[0].error.startswith('ParseError')
+
+
+def test_render_batch_worker_that_cannot_start(monkeypatch):
+    def broken_init(*args):
+        raise RuntimeError('no template for you')
+    monkeypatch.setattr(jinj, '_init_render_worker', broken_init)
+    maps = ['{{"n": {0}}}'.format(n) for n in range(5)]
+    results = sorted(jinj.render_batch(maps, '{{ n }}', processes=1, chunksize=2))
+    # Every map still gets a result, with the error, rather than the batch stopping part way.
+    assert [result.index for result in results] == [0, 1, 2, 3, 4]
+    assert all(result.output is None and result.error.startswith('BrokenProcessPool') for result in results)
+
+
+@pytest.fixture
+def compiled_templates(monkeypatch):
+    """An empty, small embedded template cache, so tests don't see each other's templates."""
+    monkeypatch.setattr(jinj, '_compiled_templates', OrderedDict())
+    monkeypatch.setattr(jinj, 'COMPILED_TEMPLATE_CACHE_SIZE', 2)
+    return jinj._compiled_templates
+
+
+def test_get_embedded_template_is_cached(compiled_templates):
+    jinja_env = jinj.make_environment()
+    template = jinj.get_embedded_template(jinja_env, '{~ if x ~}yes{~ endif ~}')
+    assert jinj.get_embedded_template(jinja_env, '{~ if x ~}yes{~ endif ~}') is template
+    assert template.render(x=True) == 'yes' and template.name == jinj.EMBEDDED_TEMPLATE_NAME
+    # Another environment gets its own Template, even with the same delimiters.
+    other = jinj.get_embedded_template(jinj.make_environment(), '{~ if x ~}yes{~ endif ~}')
+    assert other is not template and other.render(x=True) == 'yes'
+
+
+def test_get_embedded_template_is_keyed_by_delimiters(compiled_templates):
+    source = '{% if x %}a{% endif %}{~ if x ~}b{~ endif ~}'
+    test_case_env = jinj.make_environment()
+    default_env = Environment()
+    assert jinj._embedded_key(test_case_env, source)[1] != jinj._embedded_key(default_env, source)[1]
+    assert jinj.get_embedded_template(test_case_env, source).render(x=True) == '{% if x %}a{% endif %}b'
+    assert jinj.get_embedded_template(default_env, source).render(x=True) == 'a{~ if x ~}b{~ endif ~}'
+
+
+def test_get_embedded_template_evicts_least_recently_used(compiled_templates):
+    jinja_env = jinj.make_environment()
+    first = jinj.get_embedded_template(jinja_env, 'first')
+    second = jinj.get_embedded_template(jinja_env, 'second')
+    assert jinj.get_embedded_template(jinja_env, 'first') is first
+    jinj.get_embedded_template(jinja_env, 'third')
+    assert len(compiled_templates) == 2
+    assert jinj.get_embedded_template(jinja_env, 'first') is first
+    assert jinj.get_embedded_template(jinja_env, 'second') is not second
+
+
+def cached_rows(database):
+    with sqlite3.connect(database) as conn:
+        return conn.execute('select key, checksum, jinja_version from bytecode_cache order by key').fetchall()
+
+
+def test_sqlite_bytecode_cache_round_trip(tmp_path, monkeypatch):
+    database = str(tmp_path / 'cache.db')
+    templates = {'page': 'Hello {{ name }}!'}
+    jinja_env = Environment(loader=DictLoader(templates), bytecode_cache=jinj.SqliteBytecodeCache(database))
+    assert jinja_env.get_template('page').render(name='you') == 'Hello you!'
+    assert len(cached_rows(database)) == 1
+
+    # A fresh environment, like another worker's, loads the bytecode instead of compiling.
+    other_env = Environment(loader=DictLoader(templates), bytecode_cache=jinj.SqliteBytecodeCache(database))
+
+    def compile_again(*args, **kwargs):
+        raise AssertionError('compiled a template that was in the cache')
+
+    monkeypatch.setattr(other_env, 'compile', compile_again)
+    assert other_env.get_template('page').render(name='me') == 'Hello me!'
+
+
+def test_sqlite_bytecode_cache_invalidation(tmp_path, monkeypatch):
+    database = str(tmp_path / 'cache.db')
+    templates = {'page': 'Hello {{ name }}!'}
+
+    def render():
+        jinja_env = Environment(loader=DictLoader(templates), bytecode_cache=jinj.SqliteBytecodeCache(database))
+        return jinja_env.get_template('page').render(name='you')
+
+    render()
+    # A changed template is compiled again, rather than loading the old code.
+    templates['page'] = 'Bye {{ name }}!'
+    assert render() == 'Bye you!'
+    rows = cached_rows(database)
+    assert len(rows) == 2 and rows[0][0] == rows[1][0] and rows[0][1] != rows[1][1]
+    # So is one compiled by another jinja version.
+    jinja_version = jinja2.__version__
+    monkeypatch.setattr(jinja2, '__version__', '0.0.1')
+    assert render() == 'Bye you!'
+    assert sorted(row[2] for row in cached_rows(database)) == sorted(['0.0.1', jinja_version, jinja_version])
+
+
+def test_sqlite_bytecode_cache_eviction(tmp_path):
+    database = str(tmp_path / 'cache.db')
+    templates = {name: '{0} {{{{ x }}}}'.format(name) for name in ['a', 'b', 'c']}
+    bytecode_cache = jinj.SqliteBytecodeCache(database)
+    Environment(loader=DictLoader(templates), bytecode_cache=bytecode_cache).get_template('a')
+    with sqlite3.connect(database) as conn:
+        size, = conn.execute('select size from bytecode_cache').fetchone()
+
+    # Room for two templates' bytecode: the least recently used one goes.
+    bytecode_cache = jinj.SqliteBytecodeCache(database, max_size=size * 2 + size // 2)
+    for name in ['b', 'a', 'c']:
+        Environment(loader=DictLoader(templates), bytecode_cache=bytecode_cache).get_template(name)
+        time.sleep(0.01)
+    # Loading a bumped it, so b is the least recently used.
+    assert sorted(row[0] for row in cached_rows(database)) == sorted(bytecode_cache.get_cache_key(name)
+                                                                     for name in ['a', 'c'])
+
+    # Rows not used within max_age are dropped when something new is stored.
+    with sqlite3.connect(database) as conn:
+        conn.execute('update bytecode_cache set last_used = 0')
+    bytecode_cache = jinj.SqliteBytecodeCache(database, max_age=60)
+    Environment(loader=DictLoader(templates), bytecode_cache=bytecode_cache).get_template('b')
+    assert len(cached_rows(database)) == 1
+
+    bytecode_cache.clear()
+    assert cached_rows(database) == []
+
+
+def excerpt_by_splitting(string, exc_line_number, context):
+    """What return_exc_printed_nice gives, worked out by splitting up the whole string."""
+    lines = string.splitlines()
+    first, last = max(1, exc_line_number - context), exc_line_number + context
+    excerpt = lines[first - 1:last]
+    excerpt[exc_line_number - first] = '>>>>>>' + excerpt[exc_line_number - first].strip()
+    return '\n'.join((['...'] if first > 1 else []) + excerpt + (['...'] if last < len(lines) else []))
+
+
+def test_return_exc_printed_nice_matches_splitting(monkeypatch):
+    monkeypatch.setattr(jinj.os, 'linesep', '\n')
+    rng = random.Random(12)
+    for _ in range(500):
+        lines = ['  line {0} '.format(i) * rng.randint(1, 2) for i in range(rng.randint(1, 12))]
+        string = rng.choice(['\n', '\r\n']).join(lines) + rng.choice(['', '\n'])
+        exc_line_number = rng.randint(1, len(lines))
+        context = rng.randint(0, 4)
+        assert (jinj.return_exc_printed_nice(string, exc_line_number, context)
+                == excerpt_by_splitting(string, exc_line_number, context))
+
+
+def test_return_exc_printed_nice_bounds(monkeypatch):
+    monkeypatch.setattr(jinj.os, 'linesep', '\n')
+    string = '\n'.join('l{0}'.format(i) for i in range(1, 11))
+    assert jinj.return_exc_printed_nice(string, 1) == '>>>>>>l1\nl2\nl3\nl4\n...'
+    assert jinj.return_exc_printed_nice(string, 5) == '...\nl2\nl3\nl4\n>>>>>>l5\nl6\nl7\nl8\n...'
+    assert jinj.return_exc_printed_nice(string, 10) == '...\nl7\nl8\nl9\n>>>>>>l10'
+    assert jinj.return_exc_printed_nice(string, 4, context=0) == '...\n>>>>>>l4\n...'
+    assert jinj.return_exc_printed_nice('only', 1) == '>>>>>>only'
+    # A line number past the end, e.g. from a parser counting a missing line, doesn't mark anything.
+    assert '>>>>>>' not in jinj.return_exc_printed_nice(string, 12)
+
+
+@pytest.fixture
+def database_env(tmp_path):
+    """An environment loading from a scratch database, and a function to store templates in it."""
+    path = str(tmp_path / 'render.db')
+    conn = sqlite3.connect(path)
+    with open(SCHEMA) as f:
+        database.init_db(conn, f.read())
+
+    def store(filename, contents):
+        content_hash = database.store_template_body(conn, contents)
+        conn.execute('insert into templates (filename, content_hash, size) values (?, ?, ?)',
+                      (filename, content_hash, len(contents)))
+        conn.commit()
+
+    yield jinj.make_environment(jinj.DatabaseLoader(path)), store
+    conn.close()
+
+
+def test_prune_map_without_references():
+    jinja_env = jinj.make_environment()
+    analysis, pruned = jinj.prune_map(jinja_env, '{{ a }} {~ if b ~}{{ c.d }}{~ endif ~}', {'a': 1, 'c': 2, 'z': 3})
+    assert analysis == jinj.TemplateAnalysis(['a', 'b', 'c'], [])
+    assert pruned == {'a': 1, 'c': 2}
+    # Anything that isn't a dict is left alone.
+    assert jinj.prune_map(jinja_env, '{{ a }}', [('a', 1)])[1] == [('a', 1)]
+
+
+def test_prune_map_follows_includes(database_env):
+    jinja_env, store = database_env
+    store('outer.json', '{~ include "inner.json" ~} {{ outer }}')
+    store('inner.json', '{{ inner }} {~ include "innermost.json" ~}')
+    store('innermost.json', '{{ innermost }}')
+    jinja_map = {'top': 1, 'outer': 2, 'inner': 3, 'innermost': 4, 'unused': 5}
+    analysis, pruned = jinj.prune_map(jinja_env, '{{ top }} {~ include "outer.json" ~}', jinja_map)
+    assert analysis.references == ['outer.json']
+    assert pruned == {'top': 1, 'outer': 2, 'inner': 3, 'innermost': 4}
+    assert jinj.render_string_with_jinja('{{ top }} {~ include "outer.json" ~}', jinja_env, jinja_map) == '1 3 4 2'
+
+
+@pytest.mark.parametrize('source', ['{~ include "missing.json" ~}{{ a }}', '{~ include name ~}{{ a }}',
+                                    '{~ include "broken.json" ~}{{ a }}'])
+def test_prune_map_keeps_everything_when_includes_are_unknown(database_env, source):
+    jinja_env, store = database_env
+    store('broken.json', '{~ if ~}')
+    jinja_map = {'a': 1, 'b': 2}
+    assert jinj.prune_map(jinja_env, source, jinja_map)[1] == jinja_map
+
+
+def test_prune_map_include_cycle(database_env):
+    jinja_env, store = database_env
+    store('ping.json', '{{ ping }}{~ if False ~}{~ include "pong.json" ~}{~ endif ~}')
+    store('pong.json', '{{ pong }}{~ include "ping.json" ~}')
+    assert jinj.prune_map(jinja_env, '{~ include "ping.json" ~}', {'ping': 1, 'pong': 2, 'x': 3})[1] == {
+        'ping': 1, 'pong': 2}
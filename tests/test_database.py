@@ -0,0 +1,203 @@
+import os
+import sqlite3
+import threading
+
+import pytest
+
+import database
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'render_with_jinja', 'schema.sql')
+
+# schema.sql as it was before there were any migrations.
+VERSION_0_SCHEMA = """
+drop table if exists templates;
+create table templates (
+    id integer primary key autoincrement,
+    filename text not null,
+    'contents' text not null
+);
+"""
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'render.db'))
+    yield conn
+    conn.close()
+
+
+def test_migrate_from_version_0(conn):
+    conn.executescript(VERSION_0_SCHEMA)
+    templates = {'first.json': '{"a": {{ a }}}', 'second.json': '{"café": "☃"}', 'copy.json': '{"a": {{ a }}}'}
+    conn.executemany('insert into templates (filename, contents) values (?, ?)', templates.items())
+    conn.commit()
+
+    assert database.migrate(conn) == (0, len(database.MIGRATIONS))
+    assert database.get_schema_version(conn) == len(database.MIGRATIONS) == 5
+
+    rows = conn.execute('select id, filename, content_hash, size, version, variables from templates').fetchall()
+    assert len(rows) == len(templates)
+    for template_id, filename, content_hash, size, version, variables in rows:
+        assert database.load_template_body(conn, content_hash) == templates[filename]
+        assert size == len(templates[filename].encode('utf-8'))
+        assert version == 1
+        # Analyzed lazily, the first time the loader needs it.
+        assert variables is None
+        assert database.get_revision(conn, template_id, 1) == templates[filename]
+    # The same body is only stored once.
+    assert conn.execute('select count(*) from template_blobs').fetchone()[0] == 2
+
+    # There's nothing left to do a second time.
+    assert database.migrate(conn) == (5, 5)
+
+
+def read_schema():
+    with open(SCHEMA) as f:
+        return f.read()
+
+
+def test_init_db_twice(conn):
+    assert database.init_db(conn, read_schema()) == (5, 5)
+    content_hash = database.store_template_body(conn, 'hello {{ name }}')
+    conn.execute('insert into templates (filename, content_hash) values (?, ?)', ('hello.txt', content_hash))
+    conn.commit()
+
+    # A second initdb starts over, rather than replaying migrations over the tables that are already there.
+    assert database.init_db(conn, read_schema()) == (5, 5)
+    assert conn.execute('select count(*) from templates').fetchone()[0] == 0
+    assert conn.execute('select count(*) from template_blobs').fetchone()[0] == 0
+
+
+def test_init_db_makes_the_migrated_schema(conn, tmp_path):
+    database.init_db(conn, read_schema())
+    migrated = sqlite3.connect(str(tmp_path / 'migrated.db'))
+    migrated.executescript(VERSION_0_SCHEMA)
+    database.migrate(migrated)
+    for table in ('templates', 'template_blobs', 'template_revisions'):
+        columns = [row[1:3] for row in conn.execute('pragma table_info({0})'.format(table))]
+        assert columns == [row[1:3] for row in migrated.execute('pragma table_info({0})'.format(table))]
+    indexes = "select name from sqlite_master where type = 'index' and name not like 'sqlite_%' order by name"
+    assert conn.execute(indexes).fetchall() == migrated.execute(indexes).fetchall()
+    migrated.close()
+
+
+def save_template(conn, template_id, revision, contents, previous, snapshot_every):
+    content_hash = database.store_template_body(conn, contents)
+    conn.execute('update templates set content_hash = ?, version = ? where id = ?',
+                 (content_hash, revision, template_id))
+    database.record_revision(conn, template_id, revision, contents, previous, snapshot_every)
+
+
+@pytest.mark.parametrize('snapshot_every', [1, 3, 10])
+def test_revisions_round_trip(conn, snapshot_every):
+    database.init_db(conn, read_schema())
+    contents = ''.join('line {0}\n'.format(i) for i in range(50))
+    cur = conn.execute('insert into templates (filename, content_hash) values (?, ?)',
+                       ('history.txt', database.store_template_body(conn, contents)))
+    template_id = cur.lastrowid
+    database.record_revision(conn, template_id, 1, contents, snapshot_every=snapshot_every)
+    history = {1: contents}
+    for revision in range(2, 26):
+        lines = contents.splitlines(True)
+        lines.insert(revision % len(lines), 'inserted at {0}\n'.format(revision))
+        del lines[(revision * 7) % len(lines)]
+        if revision % 4 == 0:
+            # Without a newline at the end, and with some unicode.
+            lines[-1] = lines[-1].rstrip('\n') + ' ☃'
+        previous, contents = contents, ''.join(lines)
+        save_template(conn, template_id, revision, contents, previous, snapshot_every)
+        history[revision] = contents
+    conn.commit()
+
+    for revision, expected in history.items():
+        assert database.get_revision(conn, template_id, revision) == expected
+    assert database.get_revision(conn, template_id) == history[25]
+    assert database.get_revision(conn, template_id, 26) is None
+    assert database.get_revision(conn, template_id + 1) is None
+
+    kinds = {row[0]: row[1] for row in database.list_revisions(conn, template_id)}
+    assert sorted(kinds) == list(range(1, 26))
+    assert kinds[1] == 'snapshot'
+    assert all(kinds[revision] == 'snapshot' for revision in kinds if revision % snapshot_every == 0)
+    if snapshot_every > 1:
+        assert 'delta' in kinds.values()
+
+
+def test_diff_revisions(conn):
+    database.init_db(conn, read_schema())
+    cur = conn.execute('insert into templates (filename, content_hash) values (?, ?)',
+                       ('diff.txt', database.store_template_body(conn, 'a\nb\nc\n')))
+    database.record_revision(conn, cur.lastrowid, 1, 'a\nb\nc\n')
+    save_template(conn, cur.lastrowid, 2, 'a\nB\nc\n', 'a\nb\nc\n', 10)
+    assert database.diff_revisions(conn, cur.lastrowid, 1, 2, 'diff.txt') == [
+        '--- diff.txt@1\n', '+++ diff.txt@2\n', '@@ -1,3 +1,3 @@\n', ' a\n', '-b\n', '+B\n', ' c\n']
+    assert database.diff_revisions(conn, cur.lastrowid, 1, 3) is None
+
+
+def test_connection_manager_closes_connections_of_finished_threads(tmp_path):
+    connections = database.ConnectionManager(str(tmp_path / 'render.db'))
+    main = connections.connection()
+    assert connections.connection() is main
+    opened = []
+
+    def request():
+        conn = connections.connection()
+        conn.execute('select 1')
+        opened.append(conn)
+        connections.release()
+
+    for _ in range(20):
+        thread = threading.Thread(target=request)
+        thread.start()
+        thread.join()
+    connections.release()
+
+    # Only this thread's is left, the rest were closed once their threads finished.
+    assert len(connections) == 1
+    assert len(set(map(id, opened))) == 20
+    for conn in opened:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute('select 1')
+    assert main.execute('pragma journal_mode').fetchone()[0] == 'wal'
+
+    connections.close_all()
+    assert len(connections) == 0
+    with pytest.raises(sqlite3.ProgrammingError):
+        main.execute('select 1')
+
+
+@pytest.mark.parametrize('attempt', range(10))
+def test_concurrent_migrations(tmp_path, attempt):
+    path = str(tmp_path / 'render.db')
+    conn = sqlite3.connect(path)
+    conn.executescript(VERSION_0_SCHEMA)
+    conn.execute("insert into templates (filename, contents) values ('a.json', '{}')")
+    conn.commit()
+    conn.close()
+
+    # Every worker process starting on the same old database at once.
+    barrier = threading.Barrier(4)
+    results = []
+    errors = []
+
+    def worker():
+        worker_conn = sqlite3.connect(path, timeout=30)
+        try:
+            barrier.wait()
+            results.append(database.migrate(worker_conn))
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            worker_conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert sorted(results) == [(0, 5)] + [(5, 5)] * 3
+    conn = sqlite3.connect(path)
+    assert database.get_schema_version(conn) == 5
+    assert conn.execute('select count(*) from template_revisions').fetchone()[0] == 1
+    conn.close()
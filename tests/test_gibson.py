@@ -0,0 +1,518 @@
+import copy
+import datetime
+import io
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+import gibson
+import jsondiff
+
+
+def lcs_length(seq_a, seq_b):
+    """Plain dynamic programming longest common subsequence, to check align_sequences against."""
+    previous = [0] * (len(seq_b) + 1)
+    for a in seq_a:
+        current = [0]
+        for j, b in enumerate(seq_b):
+            current.append(previous[j] + 1 if a == b else max(previous[j + 1], current[j]))
+        previous = current
+    return previous[-1]
+
+
+def random_sequence_pairs(count, seed=0):
+    rng = random.Random(seed)
+    for _ in range(count):
+        seq_a = [rng.choice('abcd') for _ in range(rng.randint(0, 30))]
+        seq_b = list(seq_a)
+        for _ in range(rng.randint(0, 8)):
+            position = rng.randint(0, len(seq_b))
+            if seq_b and rng.random() < 0.5:
+                del seq_b[min(position, len(seq_b) - 1)]
+            else:
+                seq_b.insert(position, rng.choice('abcde'))
+        yield seq_a, seq_b
+
+
+def check_edit_script(seq_a, seq_b, deleted, inserted):
+    assert deleted == sorted(set(deleted)) and inserted == sorted(set(inserted))
+    deleted, inserted = set(deleted), set(inserted)
+    kept_a = [a for i, a in enumerate(seq_a) if i not in deleted]
+    kept_b = [b for j, b in enumerate(seq_b) if j not in inserted]
+    assert kept_a == kept_b
+
+
+@pytest.mark.parametrize('seq_a, seq_b', [
+    ([], []),
+    ([], list('abc')),
+    (list('abc'), []),
+    (list('abc'), list('abc')),
+    (list('abc'), list('xyz')),
+    (list('abcabba'), list('cbabac')),
+])
+def test_align_sequences_small_cases(seq_a, seq_b):
+    deleted, inserted = gibson.align_sequences(seq_a, seq_b)
+    check_edit_script(seq_a, seq_b, deleted, inserted)
+    assert len(deleted) + len(inserted) == len(seq_a) + len(seq_b) - 2 * lcs_length(seq_a, seq_b)
+
+
+def test_align_sequences_is_a_shortest_edit_script():
+    for seq_a, seq_b in random_sequence_pairs(500):
+        deleted, inserted = gibson.align_sequences(seq_a, seq_b)
+        check_edit_script(seq_a, seq_b, deleted, inserted)
+        assert len(deleted) + len(inserted) == len(seq_a) + len(seq_b) - 2 * lcs_length(seq_a, seq_b)
+
+
+def test_align_sequences_capped():
+    for seq_a, seq_b in random_sequence_pairs(500, seed=1):
+        distance = len(seq_a) + len(seq_b) - 2 * lcs_length(seq_a, seq_b)
+        for max_differences in (0, distance - 1, distance, distance + 3):
+            if max_differences < 0:
+                continue
+            aligned = gibson.align_sequences(seq_a, seq_b, max_differences)
+            if distance > max_differences:
+                assert aligned is None
+            else:
+                deleted, inserted = aligned
+                check_edit_script(seq_a, seq_b, deleted, inserted)
+                assert len(deleted) + len(inserted) == distance
+
+
+def test_align_sequences_too_expensive_still_valid():
+    # A tiny budget makes nearly every range fall back to the furthest point, the script just has to be right.
+    for seq_a, seq_b in random_sequence_pairs(500, seed=2):
+        deleted, inserted = gibson.align_sequences(seq_a, seq_b, too_expensive=1)
+        check_edit_script(seq_a, seq_b, deleted, inserted)
+
+
+def records(stamp, count=10000):
+    root = gibson.etree.Element('root')
+    for i in range(count):
+        record = gibson.etree.SubElement(root, 'record')
+        for field in ('id', 'name', 'kind', 'value'):
+            gibson.etree.SubElement(record, field).text = '{0}{1}'.format(field, i)
+        gibson.etree.SubElement(record, 'timestamp').text = '{0}-{1}'.format(stamp, i)
+    return root
+
+
+def test_strict_order_many_differences_is_fast():
+    # 50k leaves, every 5th of them different, like a timestamp in every record.
+    start = time.perf_counter()
+    _, expected_leftovers, live_leftovers = gibson.diff_xml(records('expected'), records('live'), True)
+    assert time.perf_counter() - start < 15
+    assert len(expected_leftovers) == len(live_leftovers) == 10000
+    assert all(leftover[-1][0] == 'timestamp' for leftover in expected_leftovers + live_leftovers)
+
+
+def test_align_sequences_disjoint_is_fast():
+    start = time.perf_counter()
+    deleted, inserted = gibson.align_sequences(list(range(10000)), list(range(10000, 20000)))
+    assert time.perf_counter() - start < 5
+    assert deleted == list(range(10000)) and inserted == list(range(10000))
+
+
+def test_element_path_behaves_like_a_list_of_nodes():
+    path_cache = {}
+    root = gibson.make_element_path(None, ('root', {}), path_cache)
+    parent = gibson.make_element_path(root, ('a', {'kind': 'x'}), path_cache)
+    leaf = gibson.make_element_path(parent, ('b', {}, '1'), path_cache)
+    nodes = [('root', {}), ('a', {'kind': 'x'}), ('b', {}, '1')]
+    assert list(leaf) == nodes and leaf == nodes and len(leaf) == 3
+    assert leaf[-1] == ('b', {}, '1') and leaf[:2] == nodes[:2] and leaf[1] == ('a', {'kind': 'x'})
+    assert repr(leaf) == repr(nodes)
+
+
+def test_element_paths_share_ancestors_through_the_cache():
+    path_cache = {}
+    first = gibson.make_element_path(gibson.make_element_path(None, ('root', {}), path_cache), ('a', {}, '1'),
+                                     path_cache)
+    second = gibson.make_element_path(gibson.make_element_path(None, ('root', {}), path_cache), ('a', {}, '1'),
+                                      path_cache)
+    assert first is second
+    # Built without the cache, equal paths are still equal and hash the same.
+    uncached = gibson.make_element_path(gibson.make_element_path(None, ('root', {})), ('a', {}, '1'))
+    assert uncached is not first and uncached == first and hash(uncached) == hash(first)
+    for node in [('a', {}, '2'), ('a', {'kind': 'x'}, '1'), ('b', {}, '1'), ('a', {})]:
+        other = gibson.make_element_path(first.parent, node, path_cache)
+        assert other != first
+    assert gibson.make_element_path(None, ('a', {}, '1')) != first
+
+
+def remove_based_compare(list_a, list_b):
+    """What compare_lists_strict did before it counted: list.remove() each match out of a copy of list_b."""
+    list_b = list(list_b)
+    leftovers = []
+    for a_obj in list_a:
+        if a_obj in list_b:
+            list_b.remove(a_obj)
+        else:
+            leftovers.append(a_obj)
+    return leftovers, list_b
+
+
+def random_leaves(rng, count, path_cache=None):
+    """ElementPaths with plenty of duplicates, some built separately and some sharing ancestors."""
+    root = gibson.make_element_path(None, ('root', {}), path_cache)
+    parents = [gibson.make_element_path(root, (tag, attrib), path_cache)
+               for tag in 'ab' for attrib in ({}, {'kind': 'x'})]
+    return [gibson.make_element_path(rng.choice(parents), (rng.choice('cd'), {}, rng.choice(['1', '2', None])),
+                                     path_cache) for _ in range(count)]
+
+
+def test_compare_lists_strict_unordered_matches_remove_based():
+    rng = random.Random(4)
+    path_cache = {}
+    for _ in range(300):
+        list_a = random_leaves(rng, rng.randint(0, 12), path_cache)
+        list_b = random_leaves(rng, rng.randint(0, 12), rng.choice([path_cache, None]))
+        leftovers = gibson.compare_lists_strict(list_a, list_b)
+        # Same leftovers, in the same order, duplicates and all.
+        assert leftovers == remove_based_compare(list_a, list_b)
+        assert [type(leaf) for leaf in leftovers[0] + leftovers[1]] == [gibson.ElementPath] * sum(map(len, leftovers))
+
+
+def test_compare_lists_strict_duplicates():
+    one, two = random_leaves(random.Random(5), 2)
+    assert gibson.compare_lists_strict([one, one, two], [one, two, two]) == ([one], [two])
+    assert gibson.compare_lists_strict([one, one], [one]) == ([one], [])
+    assert gibson.compare_lists_strict([one, one], [one, one]) == ([], [])
+
+
+def test_compare_lists_strict_old_leaf_format():
+    # Lists of (tag, attrib, text) tuples, as get_comparison_objects used to return, still work.
+    leaf = [('root', {}), ('a', {'kind': 'x'}, '1')]
+    other = [('root', {}), ('a', {'kind': 'y'}, '1')]
+    assert gibson.compare_lists_strict([leaf, leaf, other], [other, leaf]) == ([leaf], [])
+    assert gibson.compare_lists_strict([leaf, other], [other, leaf], True) in (([leaf], [leaf]), ([other], [other]))
+
+
+def test_compare_lists_strict_ordered_leftovers_keep_their_order():
+    root = gibson.make_element_path(None, ('root', {}))
+    leaves = [gibson.make_element_path(root, ('a', {}, str(i))) for i in range(30)]
+    moved = leaves[5:8]
+    live = leaves[:5] + leaves[8:25] + moved + leaves[25:]
+    expected_leftovers, live_leftovers = gibson.compare_lists_strict(leaves, live, True)
+    # Only the moved leaves are left over, on both sides, in document order.
+    assert (expected_leftovers, live_leftovers) == (moved, moved)
+    assert gibson.compare_lists_strict(leaves, live) == ([], [])
+
+
+def random_tree(rng, depth=0):
+    element = gibson.etree.Element(rng.choice(['a', 'b', 'c']))
+    if rng.random() < 0.3:
+        element.set('kind', rng.choice(['x', 'y']))
+    if depth < 3 and rng.random() < 0.7:
+        for _ in range(rng.randint(1, 4)):
+            element.append(random_tree(rng, depth + 1))
+    else:
+        element.text = rng.choice(['1', '2', 'three'])
+    return element
+
+
+def mutate(rng, root):
+    live = copy.deepcopy(root)
+    elements = list(live.iter())
+    for _ in range(rng.randint(0, 3)):
+        element = rng.choice(elements)
+        change = rng.random()
+        if change < 0.4 and len(element) == 0:
+            element.text = rng.choice(['1', '2', 'four'])
+        elif change < 0.7 and len(element):
+            element.remove(rng.choice(list(element)))
+        else:
+            element.append(random_tree(rng, 3))
+    return live
+
+
+def random_document_pairs(count, seed=0):
+    rng = random.Random(seed)
+    for _ in range(count):
+        expected = gibson.etree.Element('root')
+        for _ in range(rng.randint(1, 4)):
+            expected.append(random_tree(rng))
+        live = mutate(rng, expected)
+        # Some mo money, for get_mo_money to match up.
+        leaves = [element for element in expected.iter() if len(element) == 0]
+        if rng.random() < 0.3:
+            rng.choice(leaves).text = '$${variable}'
+        yield expected, live
+
+
+def differences(diff, *args, **kwargs):
+    """The mo money and pretty printed differences diff finds, or the error it raises."""
+    try:
+        result = diff(*args, **kwargs)
+    except ValueError as exc:
+        return exc.args
+    mo_money, expected_leftovers, live_leftovers = result[:3]
+    return mo_money, sorted(gibson.pretty_print_differences(expected_leftovers, live_leftovers))
+
+
+def test_diff_xml_pruning_matches_plain_diff():
+    for expected, live in random_document_pairs(300):
+        assert (differences(gibson.diff_xml, expected, live, False, prune_identical=True)
+                == differences(gibson.diff_xml, expected, live, False))
+
+
+def test_diff_xml_pruning_with_ignored_xpaths():
+    for expected, live in random_document_pairs(100, seed=1):
+        assert (differences(gibson.diff_xml, expected, live, False, ['.//b'], prune_identical=True)
+                == differences(gibson.diff_xml, expected, live, False, ['.//b']))
+
+
+def test_diff_xml_pruning_identical_documents():
+    for expected, _ in random_document_pairs(50, seed=2):
+        live = copy.deepcopy(expected)
+        assert gibson.diff_xml(expected, live, False, prune_identical=True) == ({}, [], [])
+
+
+@pytest.mark.parametrize('xpaths', [[], ['a'], ['.//b'], ['a/b', './/c[@kind]'], ["*/*[@kind='x']"], ['.']])
+def test_comparison_objects_agree_across_walks(xpaths):
+    for expected, _ in random_document_pairs(100, seed=3):
+        objects = gibson.get_comparison_objects(expected, xpaths)
+        streamed = gibson.iter_comparison_objects(io.BytesIO(gibson.etree.tostring(expected)), xpaths)
+        planned, _ = gibson.ComparisonPlan(xpaths).get_comparison_objects(expected, expected)
+        assert list(streamed) == objects and planned == objects
+
+
+@pytest.mark.parametrize('xpath', ['a', 'a/b', './/b', './a//c', '*', '*/*', 'a[@kind]', ".//*[@kind='y']",
+                                   './/b/c', '.'])
+def test_compile_streaming_xpath_matches_findall(xpath):
+    steps = gibson.compile_streaming_xpath(xpath)
+    for expected, _ in random_document_pairs(50, seed=7):
+        matched = set()
+        stack = [(expected, {0})]
+        while stack:
+            element, states = stack.pop()
+            if len(steps) in states:
+                matched.add(element)
+            for child in element:
+                stack.append((child, gibson.advance_xpath_states(steps, states, child.tag, child.attrib)))
+        assert matched == set(expected.findall(xpath))
+
+
+@pytest.mark.parametrize('xpath', ['a/..', 'a[1]', 'a[b]', '/a', 'a/', 'a//', 'a[@kind!="x"]', '{*}a', 'a/./b'])
+def test_compile_streaming_xpath_unsupported(xpath):
+    with pytest.raises(ValueError):
+        gibson.compile_streaming_xpath(xpath)
+
+
+def test_compile_streaming_xpath_namespaces():
+    document = gibson.etree.fromstring('<r xmlns:n="urn:n"><n:a><b/></n:a><a><b/></a></r>')
+    streamed = gibson.iter_comparison_objects(io.BytesIO(gibson.etree.tostring(document)), ['{urn:n}a'])
+    assert list(streamed) == gibson.get_comparison_objects(document, ['{urn:n}a'])
+    assert len(gibson.get_comparison_objects(document, ['{urn:n}a'])) == 1
+
+
+@pytest.mark.parametrize('xpaths', [None, ['.//b']])
+@pytest.mark.parametrize('validate_strict_order', [False, True])
+def test_diff_xml_stream_matches_diff_xml(xpaths, validate_strict_order):
+    for expected, live in random_document_pairs(100, seed=8):
+        streamed = differences(gibson.diff_xml_stream, io.BytesIO(gibson.etree.tostring(expected)),
+                               io.BytesIO(gibson.etree.tostring(live)), validate_strict_order, xpaths)
+        assert streamed == differences(gibson.diff_xml, expected, live, validate_strict_order, xpaths)
+
+
+def test_diff_xml_stream_unsupported_xpath():
+    with pytest.raises(ValueError):
+        gibson.diff_xml_stream(io.BytesIO(b'<r><a/></r>'), io.BytesIO(b'<r><a/></r>'), False, ['a[1]'])
+
+
+@pytest.mark.parametrize('validate_strict_order', [False, True])
+def test_diff_xml_limited_within_budget_matches_diff_xml(validate_strict_order):
+    for expected, live in random_document_pairs(300, seed=3):
+        plain = differences(gibson.diff_xml, expected, live, validate_strict_order)
+        assert differences(gibson.diff_xml_limited, expected, live, validate_strict_order) == plain
+        if isinstance(plain[0], str):
+            continue
+        count = len(plain[1])
+        for max_differences in (count, count + 5):
+            assert gibson.diff_xml_limited(expected, live, validate_strict_order,
+                                           max_differences=max_differences)[3] is False
+            assert differences(gibson.diff_xml_limited, expected, live, validate_strict_order,
+                               max_differences=max_differences) == plain
+
+
+@pytest.mark.parametrize('validate_strict_order', [False, True])
+def test_diff_xml_limited_over_budget(validate_strict_order):
+    for expected, live in random_document_pairs(300, seed=4):
+        plain = differences(gibson.diff_xml, expected, live, validate_strict_order)
+        if isinstance(plain[0], str) or not plain[1]:
+            continue
+        for max_differences in range(len(plain[1])):
+            _, expected_leftovers, live_leftovers, truncated = gibson.diff_xml_limited(
+                expected, live, validate_strict_order, max_differences=max_differences)
+            assert truncated is True
+            assert len(expected_leftovers) + len(live_leftovers) <= max_differences
+
+
+@pytest.mark.parametrize('validate_strict_order', [False, True])
+def test_diff_xml_limited_match_only(validate_strict_order):
+    for expected, live in random_document_pairs(300, seed=5):
+        plain = differences(gibson.diff_xml, expected, live, validate_strict_order)
+        if isinstance(plain[0], str):
+            continue
+        _, expected_leftovers, live_leftovers, truncated = gibson.diff_xml_limited(
+            expected, live, validate_strict_order, match_only=True)
+        assert truncated is bool(plain[1])
+        assert expected_leftovers == [] and live_leftovers == []
+
+
+def _exit_on_negative(chunk):
+    """Worker for test_iter_chunked_results_survives_dead_workers."""
+    if any(item[1] < 0 for item in chunk):
+        os._exit(1)
+    return [(item[0], item[1] * 2) for item in chunk]
+
+
+def test_iter_chunked_results_survives_dead_workers():
+    items = [(index, -1 if index == 3 else index) for index in range(10)]
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        results = sorted(gibson.iter_chunked_results(executor, 2, iter(items), 2,
+                                                     lambda index, exc: (index, type(exc).__name__),
+                                                     _exit_on_negative))
+    # Whatever finished before the worker died is kept, and everything else is an error, nothing is lost.
+    assert [result[0] for result in results] == list(range(10))
+    assert results[3] == (3, 'BrokenProcessPool')
+    assert all(result in ((index, index * 2), (index, 'BrokenProcessPool')) for index, result in enumerate(results))
+
+
+def tolerance_documents(expected_count, live_count):
+    template = '<r><id>1</id><count>{0}</count><when>2020-01-01T00:00:00</when></r>'
+    return tuple(gibson.etree.fromstring(template.format(count)) for count in (expected_count, live_count))
+
+
+def test_comparison_plan_number_tolerance():
+    plan = gibson.ComparisonPlan(xpaths_range_for_num_date=['count,NUMBER:5'])
+    assert gibson.diff_xml(*tolerance_documents(10, 14), False, plan=plan) == ({}, [], [])
+    _, expected_leftovers, live_leftovers = gibson.diff_xml(*tolerance_documents(10, 16), False, plan=plan)
+    assert expected_leftovers[0][-1][2] == '10' and live_leftovers[0][-1][2] == '16'
+
+
+@pytest.mark.parametrize('spec', ['count,NUMBER:five', 'when,DATE:soon'])
+def test_comparison_plan_rejects_bad_ranges_up_front(spec):
+    with pytest.raises(ValueError):
+        gibson.ComparisonPlan(xpaths_range_for_num_date=[spec])
+
+
+def test_comparison_plan_date_range_parses():
+    plan = gibson.ComparisonPlan(xpaths_range_for_num_date=['when,DATE:1T02:03:04'])
+    assert plan.tolerances[0].date_range == datetime.timedelta(days=1, hours=2, minutes=3, seconds=4)
+
+
+def mo_money(expected, live):
+    """Diffs two XML strings, returning the mo money and the pretty printed differences."""
+    mo_money, expected_leftovers, live_leftovers = gibson.diff_xml(gibson.etree.fromstring(expected),
+                                                                   gibson.etree.fromstring(live), False)
+    return mo_money, gibson.pretty_print_differences(expected_leftovers, live_leftovers)
+
+
+def test_get_mo_money_several_variables_in_one_text():
+    assert mo_money('<r><a>ID-$${id}-$${rev}</a><b>$${name}</b></r>',
+                    '<r><a>ID-12-3</a><b>bob</b></r>') == ({'id': '12', 'rev': '3', 'name': 'bob'}, [])
+
+
+def test_get_mo_money_whole_text_variable_keeps_the_live_text():
+    assert mo_money('<r><a> $${v} </a></r>', '<r><a>  spaced out </a></r>') == ({'v': '  spaced out '}, [])
+
+
+def test_get_mo_money_matches_positionally():
+    # The first candidate's literal parts don't fit, so the second one is matched.
+    mo_money_found, differences_found = mo_money('<r><a>ID-$${id}.</a></r>', '<r><a>XX-1.</a><a>ID-2.</a></r>')
+    assert mo_money_found == {'id': '2'} and len(differences_found) == 1 and 'XX-1.' in differences_found[0]
+    assert mo_money('<r><a>$${x}=$${y}</a></r>', '<r><a>a=b=c</a></r>') == ({'x': 'a', 'y': 'b=c'}, [])
+    assert mo_money('<r><a>$${v}-$${v}</a></r>', '<r><a>1-1</a></r>') == ({'v': '1'}, [])
+
+
+@pytest.mark.parametrize('expected, live', [
+    ('<r><a>ID-$${id}</a></r>', '<r><a>NO-12</a></r>'),
+    ('<r><a>$${v}-$${v}</a></r>', '<r><a>1-2</a></r>'),
+    ('<r><a>$${v}</a></r>', '<r><b>1</b></r>'),
+])
+def test_get_mo_money_no_match(expected, live):
+    with pytest.raises(ValueError):
+        mo_money(expected, live)
+
+
+def test_get_mo_money_unclosed_variable_is_just_text():
+    mo_money_found, differences_found = mo_money('<r><a>$${oops</a></r>', '<r><a>1</a></r>')
+    assert mo_money_found == {} and len(differences_found) == 2
+
+
+def test_mo_money_matcher():
+    assert gibson._mo_money_matcher('$${v}') == (['v'], None)
+    keys, pattern = gibson._mo_money_matcher('a.$${x}*$${y}$${x}')
+    assert keys == ['x', 'y']
+    assert pattern.fullmatch('a.1*221').groups() == ('1', '22')
+    assert pattern.fullmatch('aX1*221') is None
+    assert gibson._mo_money_matcher('no variables') == ([], None)
+
+
+def test_diff_xml_batch_matches_diff_xml():
+    pairs = list(random_document_pairs(40, seed=9))
+    jobs = [(gibson.etree.tostring(expected), gibson.etree.tostring(live), xpaths)
+            for (expected, live), xpaths in zip(pairs, [None, ['.//b']] * 20)]
+    results = sorted(gibson.diff_xml_batch(jobs, processes=2, chunksize=3))
+    assert [result.index for result in results] == list(range(40))
+    for (expected, live), job, result in zip(pairs, jobs, results):
+        expected_differences = differences(gibson.diff_xml, expected, live, False, job[2])
+        if result.error is None:
+            assert (result.mo_money, sorted(result.differences)) == expected_differences
+        else:
+            # The only thing that goes wrong with these is an unmatched mo money variable.
+            assert result.error.startswith('ValueError') and expected_differences[0].startswith('Could not find')
+
+
+def test_diff_xml_batch_errors_are_per_job():
+    jobs = [(10, '<r><a>1</a></r>', '<r><a>2</a></r>', None),
+            (20, '<r><a>1</a>', '<r/>', None),
+            (30, '{"a": 1}', '{"a": 1}', None)]
+    results = sorted(gibson.diff_xml_batch(jobs, processes=1, indexed=True))
+    assert [result.index for result in results] == [10, 20, 30]
+    assert results[0].error is None and len(results[0].differences) == 2
+    assert results[1].error.startswith('ParseError') and results[1].differences == []
+    assert results[2].error.startswith('ParseError')
+
+
+def test_diff_xml_batch_json():
+    jobs = [('{"a": [1, 2], "b": "$${b}"}', '{"a": [2, 1], "b": "x"}', None)]
+    results = list(gibson.diff_xml_batch(jobs, processes=1, parse=jsondiff.json_to_xml))
+    assert results == [gibson.BatchDiffResult(0, {'b': 'x'}, [], None)]
+
+
+def test_fingerprint_cache_evicts_least_recently_used():
+    cache = gibson.FingerprintCache(maxsize=2)
+    assert cache.get('a') is None
+    assert cache.set('a', b'1') == b'1'
+    cache.set(b'b', b'2')
+    # Text and the same text encoded as UTF-8 are the same payload.
+    assert cache.get(b'a') == b'1' and cache.get('b') == b'2'
+    cache.get('a')
+    cache.set('c', b'3')
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (b'1', None, b'3')
+    cache.set('a', b'4')
+    cache.set('d', b'5')
+    assert (cache.get('a'), cache.get('c'), cache.get('d')) == (b'4', None, b'5')
+    cache.clear()
+    assert cache.get('a') is None and cache.get('d') is None
+
+
+def test_xml_fingerprint_ignores_formatting():
+    fingerprint = gibson.xml_fingerprint(gibson.etree.fromstring('<r><a x="1" y="2">t</a><b/></r>'))
+    for same in ['<r>\n  <b/>tail\n  <a y="2" x="1">t</a>\n</r>', "<r><a y='2' x='1'>t</a><b></b></r>"]:
+        assert gibson.xml_fingerprint(gibson.etree.fromstring(same)) == fingerprint
+    for different in ['<r><a x="1" y="2"> t</a><b/></r>', '<r><a x="1">t</a><b/></r>', '<r><a x="1" y="2">t</a></r>',
+                      '<r><a x="1" y="2">t</a><c/></r>', '<q><a x="1" y="2">t</a><b/></q>']:
+        assert gibson.xml_fingerprint(gibson.etree.fromstring(different)) != fingerprint
+
+
+def test_xml_fingerprint_equal_means_no_differences():
+    equal = 0
+    for expected, live in random_document_pairs(300, seed=10):
+        if gibson.xml_fingerprint(expected) == gibson.xml_fingerprint(live):
+            equal += 1
+            assert gibson.diff_xml(expected, live, False) == ({}, [], [])
+    assert equal
@@ -0,0 +1,200 @@
+import io
+import json
+import random
+import xml.etree.ElementTree as ETree
+
+import pytest
+
+import gibson
+import jsondiff
+
+
+def random_json(rng, depth=0):
+    choice = rng.random()
+    if depth < 3 and choice < 0.3:
+        return {rng.choice(['a', 'b', 'c', 'd']): random_json(rng, depth + 1) for _ in range(rng.randint(1, 4))}
+    if depth < 3 and choice < 0.5:
+        return [random_json(rng, depth + 1) for _ in range(rng.randint(1, 4))]
+    return rng.choice([True, False, None, 0, 1, -2.5, 'x', 'y', 'two words'])
+
+
+def mutate(rng, value):
+    """A copy of value with a few leaves changed, dropped or added."""
+    if isinstance(value, dict):
+        value = {key: mutate(rng, child) for key, child in value.items()}
+        if value and rng.random() < 0.1:
+            del value[rng.choice(list(value))]
+        if rng.random() < 0.1:
+            value[rng.choice(['a', 'e'])] = random_json(rng, 3)
+        return value
+    if isinstance(value, list):
+        value = [mutate(rng, child) for child in value]
+        if value and rng.random() < 0.1:
+            del value[rng.randrange(len(value))]
+        if rng.random() < 0.1:
+            value.insert(rng.randint(0, len(value)), random_json(rng, 3))
+        return value
+    return random_json(rng, 3) if rng.random() < 0.1 else value
+
+
+def random_json_pairs(count, seed=0):
+    rng = random.Random(seed)
+    for _ in range(count):
+        expected = {'body': random_json(rng)}
+        yield expected, mutate(rng, expected)
+
+
+def differences(diff, *args):
+    try:
+        mo_money, expected_leftovers, live_leftovers = diff(*args)
+    except ValueError as exc:
+        return exc.args
+    return mo_money, sorted(gibson.pretty_print_differences(expected_leftovers, live_leftovers))
+
+
+@pytest.mark.parametrize('validate_strict_order', [False, True])
+def test_diff_json_matches_diff_xml_of_json_to_xml(validate_strict_order):
+    for expected, live in random_json_pairs(300):
+        via_xml = differences(gibson.diff_xml, jsondiff.json_to_xml(json.dumps(expected)),
+                              jsondiff.json_to_xml(json.dumps(live)), validate_strict_order)
+        assert differences(jsondiff.diff_json, expected, live, validate_strict_order) == via_xml
+
+
+def test_diff_json_mo_money():
+    expected = {'id': '$${id}', 'items': [{'name': 'a'}, {'name': 'b'}]}
+    live = {'id': '1234', 'items': [{'name': 'a'}, {'name': 'c'}]}
+    mo_money, expected_leftovers, live_leftovers = jsondiff.diff_json(expected, live)
+    assert mo_money == {'id': '1234'}
+    assert differences(jsondiff.diff_json, expected, live) == differences(
+        gibson.diff_xml, jsondiff.json_to_xml(json.dumps(expected)), jsondiff.json_to_xml(json.dumps(live)), False)
+    assert len(expected_leftovers) == len(live_leftovers) == 1
+
+
+def events_of(value):
+    """The events iter_json_events should give for the JSON text of value."""
+    if isinstance(value, dict):
+        yield 'start_map', None
+        for key, child in value.items():
+            yield 'map_key', key
+            yield from events_of(child)
+        yield 'end_map', None
+    elif isinstance(value, list):
+        yield 'start_array', None
+        for child in value:
+            yield from events_of(child)
+        yield 'end_array', None
+    else:
+        yield 'value', value
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 65536])
+def test_iter_json_events_across_chunks(chunk_size):
+    rng = random.Random(chunk_size)
+    documents = [random_json(rng) for _ in range(100)] + [
+        {'unicode': 'café ☃ \U0001f600', 'escapes': 'a\\"b\n\u0000'},
+        [12345678901234567890, -0.5e-10, 1E+3, 0],
+        [],
+        {},
+    ]
+    for document in documents:
+        for text in (json.dumps(document), json.dumps(document, indent=2, ensure_ascii=False)):
+            expected = list(events_of(json.loads(text)))
+            assert list(jsondiff.iter_json_events(io.StringIO(text), chunk_size)) == expected
+            # Bytes too, where a chunk can end in the middle of a character.
+            assert list(jsondiff.iter_json_events(io.BytesIO(text.encode('utf-8')), chunk_size)) == expected
+
+
+@pytest.mark.parametrize('text', [
+    '',
+    '   ',
+    '{',
+    '[1, 2',
+    '[1,]',
+    '{"a" 1}',
+    '{"a": 1,}',
+    '{1: 2}',
+    '[1] [2]',
+    '"unterminated',
+    '"bad \\x escape"',
+    'tru',
+    'True',
+    '[01]',
+    '[1.]',
+    '-',
+    "{'a': 1}",
+])
+@pytest.mark.parametrize('chunk_size', [1, 3, 65536])
+def test_iter_json_events_invalid(text, chunk_size):
+    with pytest.raises(ValueError):
+        json.loads(text)
+    with pytest.raises(ValueError):
+        list(jsondiff.iter_json_events(io.StringIO(text), chunk_size))
+
+
+def test_stream_json_to_xml_matches_json_to_xml():
+    rng = random.Random(0)
+    for _ in range(100):
+        text = json.dumps({'body': random_json(rng)})
+        streamed = jsondiff.stream_json_to_xml(io.StringIO(text))
+        assert ETree.tostring(streamed) == ETree.tostring(jsondiff.json_to_xml(text))
+
+
+@pytest.mark.parametrize('threshold', [jsondiff.STREAM_JSON_THRESHOLD, 0])
+def test_json_to_xml_repeated_keys_keep_the_last_value(monkeypatch, threshold):
+    monkeypatch.setattr(jsondiff, 'STREAM_JSON_THRESHOLD', threshold)
+    text = '{"a": 1, "b": {"c": 2, "c": [3, 4]}, "a": {"d": 5}, "e": [{"f": 6, "f": 7}]}'
+    expected = ETree.Element('testResponseHttpBody')
+    jsondiff._fill_xml(expected, json.loads(text))
+    assert ETree.tostring(jsondiff.json_to_xml(text)) == ETree.tostring(expected)
+    assert [elem.tag for elem in jsondiff.json_to_xml(text)] == ['a', 'b', 'e']
+
+
+def test_iter_json_paths():
+    paths = list(jsondiff.iter_json_paths({'a': [1, {'b': True}], 'c': {}, 'd': [], 'e': [[]]}))
+    assert paths == [('a', None, 1), ('a', None, 'b', True), ('c', jsondiff.EMPTY_OBJECT), ('d', jsondiff.EMPTY_ARRAY),
+                     ('e', None, jsondiff.EMPTY_ARRAY)]
+    assert repr(paths[2]) == "('c', {})" and repr(paths[3]) == "('d', [])"
+
+
+def test_diff_strings():
+    assert jsondiff.diff_strings('{"a": [1, 2], "b": "x"}', '{"b": "x", "a": [2, 1]}') == ([], [])
+    assert jsondiff.diff_strings('{"a": [1, 1, 2]}', '{"a": [1, 2, 3]}') == ([('a', None, 1)], [('a', None, 3)])
+    # true and 1, and 1 and 1.0, are different values even though Python says they're equal.
+    assert jsondiff.diff_strings('[true, 1]', '[1.0, 1]') == ([(None, True)], [(None, 1.0)])
+
+
+def test_diff_strings_empty_containers():
+    assert jsondiff.diff_strings('{"a": {}, "b": []}', '{"a": {}, "b": []}') == ([], [])
+    assert jsondiff.diff_strings('{"a": {}}', '{"a": []}') == ([('a', jsondiff.EMPTY_OBJECT)],
+                                                             [('a', jsondiff.EMPTY_ARRAY)])
+    # An empty container isn't the string that reads the same.
+    assert jsondiff.diff_strings('{"a": {}, "b": []}', '{"a": "{}", "b": "[]"}') == (
+        [('a', jsondiff.EMPTY_OBJECT), ('b', jsondiff.EMPTY_ARRAY)], [('a', '{}'), ('b', '[]')])
+    assert jsondiff.diff_strings('{}', '[]') == ([(jsondiff.EMPTY_OBJECT,)], [(jsondiff.EMPTY_ARRAY,)])
+
+
+def test_subtract_paths_with_repeated_paths():
+    paths = [('a', 1), ('b', 2), ('a', 1), ('a', 1), ('b', 2)]
+    other_paths = [('a', 1), ('b', 2), ('a', 1), ('c', 3)]
+    assert jsondiff._subtract_paths(paths, other_paths) == [('a', 1), ('b', 2)]
+    assert jsondiff._subtract_paths(other_paths, paths) == [('c', 3)]
+    assert jsondiff._subtract_paths(paths, []) == paths
+
+
+def test_json_fingerprint():
+    fingerprint = jsondiff.json_fingerprint(json.loads('{"a": [1, true, null], "b": {"c": 1e2}}'))
+    assert jsondiff.json_fingerprint(json.loads('{ "b":{"c":100.0},\n "a":[1,true,null] }')) == fingerprint
+    for different in ['{"a": [true, 1, null], "b": {"c": 1e2}}', '{"a": [1, 1, null], "b": {"c": 1e2}}',
+                      '{"a": [1, true, null], "b": {"c": 100}}', '{"a": [1, true, null], "b": {"c": "1e2"}}']:
+        assert jsondiff.json_fingerprint(json.loads(different)) != fingerprint
+
+
+def test_json_fingerprint_equal_means_no_differences():
+    rng = random.Random(11)
+    for _ in range(300):
+        a = random_json(rng)
+        b = random_json(rng) if rng.random() < 0.5 else json.loads(json.dumps(a))
+        if not isinstance(a, (dict, list)) or not isinstance(b, (dict, list)):
+            continue
+        if jsondiff.json_fingerprint(a) == jsondiff.json_fingerprint(b):
+            assert jsondiff.diff_json(a, b) == ({}, [], [])
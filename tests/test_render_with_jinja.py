@@ -0,0 +1,182 @@
+import importlib
+import json
+import os
+
+import pytest
+
+pytest.importorskip('flask')
+
+
+@pytest.fixture(scope='module')
+def app_module(tmp_path_factory):
+    """render_with_jinja, pointed at a scratch database instead of the one in the repo."""
+    settings = tmp_path_factory.mktemp('settings') / 'settings.py'
+    settings.write_text('DATABASE = {0!r}\nTEMPLATES_PER_PAGE = 3\n'.format(str(settings.parent / 'render.db')))
+    old_settings = os.environ.get('FLASKR_SETTINGS')
+    os.environ['FLASKR_SETTINGS'] = str(settings)
+    try:
+        module = importlib.import_module('render_with_jinja')
+    finally:
+        if old_settings is None:
+            del os.environ['FLASKR_SETTINGS']
+        else:
+            os.environ['FLASKR_SETTINGS'] = old_settings
+    assert module.app.config['DATABASE'] == str(settings.parent / 'render.db')
+    with module.app.app_context():
+        module.init_db()
+    return module
+
+
+def batch_diff(app_module, tmp_path, lines, *args):
+    jobs = tmp_path / 'jobs.jsonl'
+    jobs.write_text(''.join(line + '\n' for line in lines))
+    result = app_module.app.test_cli_runner().invoke(args=['batch-diff', str(jobs), '--processes', '1'] + list(args))
+    assert result.exit_code == 0, result.output
+    return sorted((json.loads(line) for line in result.output.splitlines()), key=lambda result: result['index'])
+
+
+def test_batch_diff(app_module, tmp_path):
+    results = batch_diff(app_module, tmp_path, [
+        json.dumps({'expected': '<r><a>1</a><b>$${b}</b></r>', 'live': '<r><a>1</a><b>2</b></r>'}),
+        '',
+        json.dumps({'expected': '<r><a>1</a></r>', 'live': '<r><a>2</a></r>', 'ignore': None}),
+        json.dumps({'expected': '<r><a>1</a><c/></r>', 'live': '<r><a>2</a><c/></r>', 'ignore': ['a']}),
+    ])
+    # Indexes are line numbers, so the blank line is skipped over.
+    assert [result['index'] for result in results] == [1, 3, 4]
+    assert results[0] == {'index': 1, 'mo_money': {'b': '2'}, 'differences': [], 'error': None}
+    assert len(results[1]['differences']) == 2 and results[1]['error'] is None
+    assert results[2]['differences'] == [] and results[2]['error'] is None
+
+
+def test_batch_diff_bad_lines(app_module, tmp_path):
+    results = batch_diff(app_module, tmp_path, [
+        'not json',
+        json.dumps({'expected': '<r/>'}),
+        json.dumps(['<r/>', '<r/>']),
+        json.dumps({'expected': '<r><a>1</a>', 'live': '<r/>'}),
+        json.dumps({'expected': '<r/>', 'live': '<r/>'}),
+    ])
+    assert [result['index'] for result in results] == [1, 2, 3, 4, 5]
+    assert [result['error'].split(':')[0] for result in results[:3]] == ['Bad job'] * 3
+    assert 'JSONDecodeError' in results[0]['error'] and 'KeyError' in results[1]['error']
+    assert results[3]['error'].startswith('ParseError')
+    assert results[4] == {'index': 5, 'mo_money': {}, 'differences': [], 'error': None}
+
+
+def test_batch_diff_json(app_module, tmp_path):
+    results = batch_diff(app_module, tmp_path, [json.dumps({'expected': '{"a": [1, 2]}', 'live': '{"a": [2, 3]}'})],
+                         '--choice', 'JSON')
+    assert len(results) == 1 and results[0]['error'] is None and len(results[0]['differences']) == 2
+
+
+def validate_stream(app_module, string_type, chunks):
+    return ''.join(app_module.validate_stream(string_type, iter(chunks)))
+
+
+@pytest.mark.parametrize('chunks', [
+    ['{"a": [1, 2], ', '"b": {"c": tr', 'ue}}'],
+    ["{'a': [1, 2], ", "'b': None}"],
+    ['', '', '[1,', ' 2]'],
+])
+def test_validate_stream_json(app_module, chunks):
+    output = validate_stream(app_module, 'JSON', chunks)
+    assert '>>>>>>' not in output
+    assert json.loads(output) in ({'a': [1, 2], 'b': {'c': True}}, {'a': [1, 2], 'b': None}, [1, 2])
+
+
+@pytest.mark.parametrize('chunks', [
+    ['{"a": [1, 2], ', '"b": {"c": tr'],
+    ['{"a": [1, 2]'],
+    ['{"a": "unterminated'],
+    ['[1, 2] [3]'],
+])
+def test_validate_stream_truncated_json(app_module, chunks):
+    output = validate_stream(app_module, 'JSON', chunks)
+    assert output.count('>>>>>> Incorrect JSON rendered!') == 1 and output.endswith('\n')
+
+
+def test_validate_stream_empty_output(app_module):
+    assert validate_stream(app_module, 'JSON', ['', '']) == ''
+
+
+@pytest.mark.parametrize('chunks', [['<r><a>1</a>', '<b/></r>'], ['<r/>']])
+def test_validate_stream_xml(app_module, chunks):
+    assert validate_stream(app_module, 'XML', chunks) == ''.join(chunks)
+
+
+@pytest.mark.parametrize('chunks', [['<r><a>1</a>', '<b/>'], ['<r><a>1</'], ['<r></q>'], ['']])
+def test_validate_stream_truncated_xml(app_module, chunks):
+    output = validate_stream(app_module, 'XML', chunks)
+    # Whatever was rendered still goes out, followed by the marker.
+    assert output.startswith(''.join(chunks)) and output.count('>>>>>> Incorrect XML rendered!') == 1
+
+
+def test_validate_stream_passes_big_output_through_in_pieces(app_module):
+    chunks = ['<r>'] + ['<a>{0}</a>'.format(i) for i in range(5000)] + ['</r>']
+    pieces = list(app_module.validate_stream('XML', iter(chunks)))
+    assert ''.join(pieces) == ''.join(chunks) and len(pieces) > 1
+
+
+def test_validate_stream_render_error(app_module):
+    def chunks():
+        yield '<r>'
+        raise app_module.UndefinedError('oops')
+
+    output = ''.join(app_module.validate_stream('XML', chunks()))
+    assert output.startswith('<r>\n>>>>>> Jinja is not happy!')
+
+
+def pages(app_module, db, before=None):
+    """Every page of the template list from before on, following next_before."""
+    result = []
+    while True:
+        page = app_module.list_templates_page(db, before)
+        result.append([row['filename'] for row in page['templates']])
+        before = page['next_before']
+        if before is None:
+            return result
+
+
+@pytest.fixture
+def app_db(app_module):
+    with app_module.app.app_context():
+        db = app_module.get_db()
+        db.execute('delete from templates')
+        db.commit()
+        yield db
+
+
+def add_templates(app_module, db, count):
+    content_hash = app_module.store_body(db, 'body')
+    ids = [db.execute('insert into templates (filename, content_hash) values (?, ?)',
+                      ('t{0}'.format(i), content_hash)).lastrowid for i in range(count)]
+    db.commit()
+    return ids
+
+
+def test_list_templates_page_empty(app_module, app_db):
+    assert app_module.list_templates_page(app_db) == {'templates': [], 'next_before': None}
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 4, 6, 7])
+def test_list_templates_page_cursor(app_module, app_db, count):
+    add_templates(app_module, app_db, count)
+    names = ['t{0}'.format(i) for i in reversed(range(count))]
+    # Three a page, newest first, and no empty page after a full last one.
+    assert pages(app_module, app_db) == [names[start:start + 3] for start in range(0, count, 3)]
+
+
+def test_list_templates_page_before_edges(app_module, app_db):
+    ids = add_templates(app_module, app_db, 5)
+    page = app_module.list_templates_page(app_db)
+    assert page['next_before'] == ids[2]
+    # before is exclusive, past the newest it's the first page, and at the oldest there's nothing left.
+    assert [row['id'] for row in app_module.list_templates_page(app_db, ids[2])['templates']] == ids[1::-1]
+    assert app_module.list_templates_page(app_db, ids[-1] + 100) == page
+    assert app_module.list_templates_page(app_db, ids[0]) == {'templates': [], 'next_before': None}
+    # Deleted templates leave gaps in the ids, which the cursor steps over.
+    app_db.execute('delete from templates where id in (?, ?)', (ids[1], ids[3]))
+    app_db.commit()
+    assert pages(app_module, app_db) == [['t4', 't2', 't0']]
+    assert pages(app_module, app_db, ids[4]) == [['t2', 't0']]